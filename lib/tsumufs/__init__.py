@@ -25,15 +25,27 @@ import threading
 # rule.
 
 from debuggable import *
+from tokenbucket import *
+from linkestimator import *
+from settletracker import *
+from openfileregistry import *
+from workingset import *
+from checkpointthread import *
 from cachemanager import *
+from cachefill import *
+from cacherefresher import *
 from viewsmanager import *
 from synclog import *
 from fusefile import *
 from fusethread import *
 from syncthread import *
+from deltaengine import *
 from inodechange import *
 from syncitem import *
 from mutablestat import *
+from localstore import *
+from metadatabridge import *
+from cachedrevisionindex import *
 from filesystemoverlay import *
 from extendedattributes import *
 from metrics import *
@@ -77,10 +89,21 @@ fsType        = 'nfs4'
 fsName        = 'TsumuFS'
 fsMountMethod = 'default'
 
+attrTimeout  = 1.0              # in seconds
+entryTimeout = 1.0              # in seconds
+
 cacheBaseDir = '/var/cache/tsumufs'
 cacheSpecDir = '/var/lib/tsumufs/cachespec'
 cachePoint   = None
 cacheManager = None
+snapshotDir  = None
+signatureDir = None
+
+metadataStore = 'sqlite'        # Backend of the client-private metadata.
+metadataPath  = None
+documentsPath = None
+
+workingSetPath = None
 
 viewsPoint = ''
 viewsManager = None
@@ -90,10 +113,21 @@ conflictDir  = '/.tsumufs-conflicts'
 defaultModeMask   = 0077
 defaultCacheMode  = 0600        # readable only by the user
 checkpointTimeout = 30          # in seconds
+settleTime        = 5.0         # in seconds
+
+uploadRate   = 0                # in KiB/s, 0 for unlimited
+downloadRate = 0                # in KiB/s, 0 for unlimited
 
 syncLog   = None
 fsOverlay = None
 
+checkpointThread = None
+cacheRefresher   = None
+
+refreshConcurrency = 2          # Number of files refreshed at once.
+prefetchCount      = 100        # Number of files of the working set
+                                # prefetched at mount time.
+
 unmounted         = EventNotifier(UnmountedNotification)
 fsAvailable       = EventNotifier(ConnectionNotification)
 syncPause         = EventNotifier(SyncPauseNotification)
@@ -101,6 +135,13 @@ syncWork          = EventNotifier(SyncWorkNotification)
 forceDisconnect   = threading.Event()
 remoteReplication = threading.Event()
 
+uploadBucket      = TokenBucket()
+downloadBucket    = TokenBucket()
+linkEstimator     = LinkEstimator()
+settleTracker     = SettleTracker()
+openFileRegistry  = OpenFileRegistry()
+workingSet        = WorkingSet()
+
 
 def syslogCurrentException():
   '''
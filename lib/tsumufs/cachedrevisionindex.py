@@ -0,0 +1,152 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import threading
+
+import tsumufs
+
+
+def _compact(value):
+  '''
+  Document ids and revisions are ascii: store them as byte strings, which
+  take a quarter of the memory of unicode strings.
+  '''
+
+  if isinstance(value, unicode):
+    try:
+      return str(value)
+    except UnicodeError:
+      pass
+
+  return value
+
+
+class CachedRevision(object):
+  '''
+  Revision and mtime of the cached copy of a file.
+  '''
+
+  __slots__ = ('revision', 'mtime')
+
+  def __init__(self, revision, mtime):
+    self.revision = revision
+    self.mtime = mtime
+
+
+class CachedRevisionIndex(tsumufs.Debuggable):
+  '''
+  In-memory table of the revisions of the cached copies of the files, by
+  file id, so that looking them up never hits the database.
+
+  The table is loaded from a revision store at mount time, and every change
+  is written through to the store, which persists it at the next
+  checkpoint.
+  '''
+
+  def __init__(self, store):
+    self._store = store
+    self._lock = threading.Lock()
+    self._records = {}
+
+    for fileid, revision, mtime in store.items():
+      self._records[_compact(fileid)] = CachedRevision(_compact(revision),
+                                                       mtime)
+
+    self._debug('Loaded %d cached revisions.' % len(self._records))
+
+  def __len__(self):
+    return len(self._records)
+
+  def __contains__(self, fileid):
+    return fileid in self._records
+
+  def fileids(self):
+    '''
+    Return the list of the ids of the cached files.
+    '''
+
+    return self._records.keys()
+
+  def get(self, fileid):
+    '''
+    Return the revision and the mtime of the cached copy of a file.
+
+    Returns:
+      A (revision, mtime) tuple.
+
+    Raises:
+      KeyError
+    '''
+
+    record = self._records[fileid]
+    return record.revision, record.mtime
+
+  def set(self, fileid, revision, mtime):
+    '''
+    Update or create the revision of the cached copy of a file.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      self._store.set(fileid, revision, mtime)
+
+      record = self._records.get(fileid)
+
+      if record is None:
+        self._records[_compact(fileid)] = CachedRevision(_compact(revision),
+                                                         mtime)
+      else:
+        record.revision = _compact(revision)
+        record.mtime = mtime
+
+    finally:
+      self._lock.release()
+
+  def remove(self, fileid):
+    '''
+    Remove the revision of the cached copy of a file.
+
+    Returns:
+      The (revision, mtime) tuple removed.
+
+    Raises:
+      KeyError
+    '''
+
+    self._lock.acquire()
+
+    try:
+      record = self._records.pop(fileid)
+
+      try:
+        self._store.remove(fileid)
+      except KeyError, e:
+        pass
+
+      return record.revision, record.mtime
+
+    finally:
+      self._lock.release()
+
+  def commit(self):
+    '''
+    Commit the changes written to the store to disk.
+    '''
+
+    self._store.commit()
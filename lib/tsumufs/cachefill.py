@@ -0,0 +1,294 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import os
+import os.path
+import sys
+import errno
+import random
+import threading
+
+import tsumufs
+
+
+class CacheFill(tsumufs.Debuggable, threading.Thread):
+  '''
+  Thread that copies a file from the fs mount to the cache.
+
+  The data is downloaded into a temporary file located next to the cached
+  copy, and atomically renamed in place once complete. Readers of the
+  ranges that are already downloaded are served from the temporary file, so
+  that they do not have to wait for the whole file.
+  '''
+
+  _running = 0                # Number of fills copying data.
+  _waiting  = set()           # Fills waiting for a slot.
+  _slots    = threading.Condition()
+
+  backgroundTransfers = False # Whether nobody waits for the copy, in which
+                              # case it yields the bandwidth to the FUSE
+                              # threads.
+
+  fusepath  = None
+  document  = None
+  cachepath = None
+  tmppath   = None
+
+  size      = 0               # Number of bytes downloaded so far.
+  done      = False
+  cancelled = False
+  error     = None
+
+  def __init__(self, fusepath, document, background=False, callback=None):
+    threading.Thread.__init__(self, name='CacheFill <%s>' % fusepath)
+    self.setDaemon(True)
+    self._setName('CacheFill <%s>' % fusepath)
+
+    self.fusepath  = fusepath
+    self.document  = document
+    self.backgroundTransfers = background
+    self.cachepath = tsumufs.cachePathOf(fusepath)
+    self.tmppath   = os.path.join(os.path.dirname(self.cachepath),
+                                  '.%s.tsumufs-fill-%06x' %
+                                  (os.path.basename(self.cachepath),
+                                   random.randint(0, 0xffffff)))
+
+    self._callback  = callback
+    self._condition = threading.Condition()
+
+  def run(self):
+    self._debug('Caching file %s to disk.' % self.fusepath)
+
+    # Install our custom exception handler so that any exceptions are
+    # output to the syslog rather than to /dev/null.
+    sys.excepthook = tsumufs.syslogExceptHook
+
+    try:
+      try:
+        self._acquireSlot()
+
+        try:
+          self._copy()
+        finally:
+          self._releaseSlot()
+
+      except (IOError, OSError), e:
+        self._debug('Caught error while caching %s: %s' % (self.fusepath, e))
+        self.error = e
+
+        if e.errno in (errno.EIO, errno.ESTALE):
+          self._debug('Triggering a disconnect.')
+          tsumufs.fsAvailable.clear()
+
+    finally:
+      self._finish()
+
+  def _mayStart(self):
+    limit = tsumufs.linkEstimator.concurrency()
+
+    if not self.backgroundTransfers:
+      return CacheFill._running < limit
+
+    # Keep a slot for the fills somebody waits for, and let them go first.
+    for fill in CacheFill._waiting:
+      if not fill.backgroundTransfers:
+        return False
+
+    return CacheFill._running < limit - 1
+
+  def _acquireSlot(self):
+    '''
+    Wait for the number of running fills to drop below the concurrency level
+    suited to the link to the fs mount. The fills nobody waits for leave a
+    slot free, and give way to the other ones.
+    '''
+
+    self._slots.acquire()
+
+    try:
+      CacheFill._waiting.add(self)
+
+      try:
+        # The fill may be waited for meanwhile, check again from time to
+        # time.
+        while not self._mayStart() and not self.cancelled:
+          self._slots.wait(0.5)
+
+      finally:
+        CacheFill._waiting.discard(self)
+
+      CacheFill._running += 1
+
+    finally:
+      self._slots.release()
+
+  def _releaseSlot(self):
+    self._slots.acquire()
+
+    try:
+      CacheFill._running -= 1
+      self._slots.notifyAll()
+
+    finally:
+      self._slots.release()
+
+  def _copy(self):
+    '''
+    Copy the content of the file from the fs mount to the temporary file.
+    '''
+
+    try:
+      source = tsumufs.fsMount.open(self.fusepath, os.O_RDONLY | os.O_BINARY)
+    except AttributeError, e:
+      source = tsumufs.fsMount.open(self.fusepath, os.O_RDONLY)
+
+    try:
+      target = open(self.tmppath, 'wb')
+
+      try:
+        while not self.cancelled:
+          buf = source.read(tsumufs.linkEstimator.chunkSize())
+          if not buf:
+            break
+
+          target.write(buf)
+          target.flush()
+
+          self._condition.acquire()
+          try:
+            self.size += len(buf)
+            self._condition.notifyAll()
+          finally:
+            self._condition.release()
+
+      finally:
+        target.close()
+
+    finally:
+      source.close()
+
+  def _finish(self):
+    '''
+    Move the downloaded file in place and mark the cached revision, then
+    call the callback and wake up the waiting readers.
+    '''
+
+    self._condition.acquire()
+
+    try:
+      try:
+        if self.error or self.cancelled:
+          self._removeTemporaryFile()
+
+        else:
+          os.rename(self.tmppath, self.cachepath)
+          tsumufs.fsOverlay.setCachedRevision(self.document.id,
+                                              self.document.rev,
+                                              self.document.stats.st_mtime)
+
+          self._debug('File %s cached to disk (%d bytes).'
+                      % (self.fusepath, self.size))
+
+      except (IOError, OSError), e:
+        self._debug('Unable to move %s in place: %s' % (self.tmppath, e))
+        self.error = e
+        self._removeTemporaryFile()
+
+    finally:
+      if self._callback:
+        self._callback(self)
+
+      self.done = True
+      self._condition.notifyAll()
+      self._condition.release()
+
+  def _removeTemporaryFile(self):
+    try:
+      os.unlink(self.tmppath)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def cancel(self):
+    '''
+    Stop the copy and discard the downloaded data, then wait for the thread to
+    complete.
+    '''
+
+    self._debug('Cancelling cache fill of %s' % self.fusepath)
+    self.cancelled = True
+
+    try:
+      self.wait()
+    except (IOError, OSError), e:
+      pass
+
+  def wait(self):
+    '''
+    Wait for the whole file to be cached.
+
+    Raises:
+      The error that interrupted the copy, if any.
+    '''
+
+    self._condition.acquire()
+
+    try:
+      while not self.done:
+        self._condition.wait()
+
+      if self.error:
+        raise self.error
+
+    finally:
+      self._condition.release()
+
+  def read(self, offset, length):
+    '''
+    Read a chunk of data from the partially downloaded file. Blocks until the
+    requested range has been downloaded.
+
+    Returns:
+      The data requested, or None if the fill is over, in which case the
+      data has to be read from the cached copy.
+
+    Raises:
+      The error that interrupted the copy, if any.
+    '''
+
+    self._condition.acquire()
+
+    try:
+      while not self.done and self.size < offset + length:
+        self._condition.wait()
+
+      if self.error:
+        raise self.error
+
+      if self.done:
+        return None
+
+      fp = open(self.tmppath, 'rb')
+      try:
+        fp.seek(offset)
+        return fp.read(length)
+      finally:
+        fp.close()
+
+    finally:
+      self._condition.release()
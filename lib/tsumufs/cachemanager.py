@@ -27,11 +27,20 @@ import thread
 import threading
 import time
 import random
+import itertools
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
 
 import tsumufs
 from tsumufs.extendedattributes import extendedattribute
 from tsumufs.metrics import benchmark
 from tsumufs.fusefile import FuseFile
+from tsumufs.cachefill import CacheFill
+
+FICLONE = 0x40049409        # ioctl sharing the data blocks of two files.
 
 class CacheManager(tsumufs.Debuggable):
   '''
@@ -45,6 +54,36 @@ class CacheManager(tsumufs.Debuggable):
   _cacheSpec = {}           # A hash of paths to bools to remember the policy of
                             # whether files or parent directories (recursively)
 
+  _pageCacheRevisions = {}  # A hash of file ids to the cached revision seen at
+                            # the last open, to know whether the kernel page
+                            # cache of the file is still valid.
+
+  _cacheFills = {}          # A hash of paths to the CacheFill threads currently
+                            # copying files from the fs mount to the cache.
+
+  _cacheFillsLock = threading.Lock()
+
+  _minFreeRatio = 0.1       # Part of the filesystem of the cache left free
+                            # by the background copies.
+
+  _reconciledDirs = {}      # A hash of paths to the mtime and ctime of the
+                            # directories of the fs mount at their last
+                            # comparison with the database, for populateDb.
+
+  _primedStats = {}         # A hash of directory paths to the time they were
+                            # listed and the stats of their entries, to serve
+                            # the getattr calls that follow a readdir.
+
+  _primedStatsLock = threading.Lock()
+
+  _snapshotIds = itertools.count()
+  _linkedSnapshots = {}     # A hash of the snapshots that are hardlinks to
+                            # cached files to the (st_dev, st_ino) of the
+                            # files, whose links are to be broken on the next
+                            # write to the files.
+
+  _reflinkSupported = (fcntl is not None)
+
   @benchmark
   def __init__(self):
     # Install our custom exception handler so that any exceptions are
@@ -73,6 +112,15 @@ class CacheManager(tsumufs.Debuggable):
                        os.strerror(e.errno)))
         raise e
 
+    # Snapshots left by a previous run are not used anymore. The snapshot
+    # dir is only set once mounted, see FuseThread.fsInit.
+    if tsumufs.snapshotDir:
+      if os.path.isdir(tsumufs.snapshotDir):
+        for filename in os.listdir(tsumufs.snapshotDir):
+          os.unlink(os.path.join(tsumufs.snapshotDir, filename))
+      else:
+        os.mkdir(tsumufs.snapshotDir, 0700)
+
   @benchmark
   def _checkForFSDisconnect(self, exception, opcodes):
     '''
@@ -105,13 +153,19 @@ class CacheManager(tsumufs.Debuggable):
     Raises:
       OSError if there was a problem getting the stat.
     '''
+
+    stats = self._primedStat(fusepath)
+    if stats is not None:
+      self._debug('Returning primed stats of %s.' % fusepath)
+      return stats
+
     self.lockFile(fusepath)
 
     try:
       opcodes = self._genCacheOpcodes(fusepath, for_stat=True)
       self._debug('Opcodes are: %s' % str(opcodes))
 
-      self._validateCache(fusepath, opcodes)
+      self._validateCache(fusepath, opcodes, wait=False)
 
       if 'enoent' in opcodes:
         raise OSError(errno.ENOENT, fusepath, os.strerror(errno.ENOENT))
@@ -134,7 +188,7 @@ class CacheManager(tsumufs.Debuggable):
       opcodes = self._genCacheOpcodes(fusepath, for_stat=True)
       self._debug('Opcodes are: %s' % str(opcodes))
 
-      self._validateCache(fusepath, opcodes)
+      self._validateCache(fusepath, opcodes, wait=False)
 
       if 'enoent' in opcodes:
         raise OSError(errno.ENOENT, fusepath, os.strerror(errno.ENOENT))
@@ -150,7 +204,7 @@ class CacheManager(tsumufs.Debuggable):
     Attempt to open a file on the local disk.
 
     Returns:
-      None
+      The list of opcodes used to open the file.
 
     Raises:
       OSError on problems opening the file.
@@ -173,6 +227,13 @@ class CacheManager(tsumufs.Debuggable):
     #
     #   O_TRUNC            - Open an existing file, truncate the contents.
     #
+    # Read only opens do not wait for the file to be cached, the data being
+    # read from the cache fill as it arrives. Other opens wait for the cache
+    # fill to complete, without holding the file lock.
+
+    readonly = self._isReadOnly(flags)
+    if not readonly:
+      self._awaitCacheFill(fusepath)
 
     self.lockFile(fusepath)
 
@@ -189,7 +250,7 @@ class CacheManager(tsumufs.Debuggable):
           self._debug('Opcodes are now %s' % opcodes)
 
       try:
-        self._validateCache(fusepath, opcodes)
+        self._validateCache(fusepath, opcodes, wait=not readonly)
       except OSError, e:
         if e.errno != errno.ENOENT:
           raise
@@ -201,8 +262,15 @@ class CacheManager(tsumufs.Debuggable):
           self._debug('Couldn\'t find %s -- raising ENOENT' % fusepath)
           raise
 
+      if readonly and self._getCacheFill(fusepath):
+        self._debug('%s is being cached, skipping the open.' % fusepath)
+        return opcodes
+
       self._debug('Attempting open of %s.' % fusepath)
 
+      if flags & os.O_TRUNC:
+        self._breakSnapshotLink(fusepath)
+
       try:
         self._debug('Opening file')
         if mode:
@@ -220,6 +288,8 @@ class CacheManager(tsumufs.Debuggable):
       self._debug('Closing file.')
       fp.close(release=False)
 
+      return opcodes
+
     finally:
       self._debug('Unlocking file.')
       self.unlockFile(fusepath)
@@ -245,14 +315,138 @@ class CacheManager(tsumufs.Debuggable):
     finally:
       self.unlockFile(fusepath)
 
+    # If fs not available, files not cached to disk are not displayed. Scan the
+    # cache directory once instead of stating each entry separately.
+    if not tsumufs.fsAvailable.isSet():
+      cached = self._listCachedNames(fusepath)
+      dirents = ( doc for doc in dirents if doc.filename in cached )
+
+    # Keep the stats of the entries for the getattr calls that usually
+    # follow.
+    stats = self._primeStats(fusepath)
+
     for doc in dirents:
-      # If fs not available and file not cached to disk, do not display it
-      if (not tsumufs.fsAvailable.isSet()
-          and not self.isCachedToDisk(os.path.join(fusepath, doc.filename))):
-        continue
+      filename = doc.filename
+      if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
 
+      stats[filename] = doc.stats
       yield doc
 
+  def _primeStats(self, fusepath):
+    '''
+    Register the listing of the directory fusepath, for attrTimeout seconds.
+
+    Returns:
+      The hash of the names of the entries to their stats, to fill.
+    '''
+
+    stats = {}
+
+    self._primedStatsLock.acquire()
+
+    try:
+      now = time.time()
+
+      for dirpath, (stamp, entries) in self._primedStats.items():
+        if now - stamp > tsumufs.attrTimeout:
+          del self._primedStats[dirpath]
+
+      self._primedStats[fusepath] = (now, stats)
+
+    finally:
+      self._primedStatsLock.release()
+
+    return stats
+
+  def _primedStat(self, fusepath):
+    '''
+    Return the stats of fusepath recorded by the last listing of its
+    directory, if it is recent enough.
+
+    Returns:
+      A stat result, or None.
+    '''
+
+    if not self._primedStats:
+      return None
+
+    dirpath, filename = os.path.split(fusepath)
+
+    self._primedStatsLock.acquire()
+
+    try:
+      listing = self._primedStats.get(dirpath)
+      if listing is None:
+        return None
+
+      stamp, stats = listing
+      if time.time() - stamp > tsumufs.attrTimeout:
+        del self._primedStats[dirpath]
+        return None
+
+      return stats.get(filename)
+
+    finally:
+      self._primedStatsLock.release()
+
+  def _forgetPrimedStats(self, fusepath):
+    '''
+    Drop the primed stats of fusepath, and of the files under it.
+    '''
+
+    dirpath, filename = os.path.split(fusepath)
+
+    self._primedStatsLock.acquire()
+
+    try:
+      listing = self._primedStats.get(dirpath)
+      if listing is not None:
+        listing[1].pop(filename, None)
+
+      for dirpath in self._primedStats.keys():
+        if dirpath == fusepath or dirpath.startswith(fusepath + '/'):
+          del self._primedStats[dirpath]
+
+    finally:
+      self._primedStatsLock.release()
+
+  @benchmark
+  def _listCachedNames(self, fusepath):
+    '''
+    Return the names of the entries of a directory that are cached to
+    disk, using a single listing of the cache directory.
+
+    Returns:
+      A set of filenames.
+
+    Raises:
+      OSError if there was an issue listing the cache directory, aside
+      from ENOENT.
+    '''
+
+    try:
+      names = set()
+
+      # Documents filenames are unicode, so keep the decoded form of each
+      # name as well as the raw one.
+      for name in os.listdir(tsumufs.cachePathOf(fusepath)):
+        names.add(name)
+        try:
+          names.add(name.decode('utf-8'))
+        except UnicodeError:
+          pass
+
+      return names
+
+    except OSError, e:
+      if e.errno in (errno.ENOENT, errno.ENOTDIR):
+        return set()
+
+      self._debug('_listCachedNames: Caught OSError: errno %d: %s'
+                  % (e.errno, e.strerror))
+      raise
+
   @benchmark
   def _flagsToStdioMode(self, flags):
     '''
@@ -281,6 +475,10 @@ class CacheManager(tsumufs.Debuggable):
     try:
       self.lockFile(fusepath)
 
+      if self._isReadOnly(flags) and self._getCacheFill(fusepath):
+        self._debug('%s is being cached, nothing to release.' % fusepath)
+        return False
+
       opcodes = self._genCacheOpcodes(fusepath)
 
       # Open a file in write mode and close it to raise
@@ -288,10 +486,84 @@ class CacheManager(tsumufs.Debuggable):
       tsumufs.fsOverlay.open(fusepath, flags,
                              usefs=('use-fs' in opcodes)).close()
 
+      # Our own writes went through the kernel page cache, so it is still
+      # valid for the revision that has just been written.
+      if 'use-fs' not in opcodes:
+        self._recordPageCacheRevision(fusepath)
+
       return ('use-fs' not in opcodes)
     finally:
       self.unlockFile(fusepath)
 
+  @benchmark
+  def keepPageCache(self, fusepath):
+    '''
+    Check whether the kernel page cache of a file opened from the cache can
+    be kept, ie. if the cached revision of the file is the same as the one
+    recorded at the previous open. Records the current cached revision for
+    the next open.
+
+    Returns:
+      Boolean
+
+    Raises:
+      Nothing
+    '''
+
+    try:
+      fileid = tsumufs.fsOverlay[fusepath].id
+      previous = self._pageCacheRevisions.get(fileid)
+
+      return (previous is not None and
+              previous == self._recordPageCacheRevision(fusepath))
+
+    except (OSError, KeyError), e:
+      return False
+
+  @benchmark
+  def invalidatePageCache(self, fileid, revision=None):
+    '''
+    Forget the cached revision recorded at the last open of a file, so that
+    the next open drops the kernel page cache of the file. If revision is
+    given, nothing is done when it is the revision already recorded.
+
+    Returns:
+      None
+
+    Raises:
+      Nothing
+    '''
+
+    if revision is None or self._pageCacheRevisions.get(fileid) != revision:
+      self._debug('Invalidating page cache of file %s' % fileid)
+      self._pageCacheRevisions.pop(fileid, None)
+
+  def _recordPageCacheRevision(self, fusepath):
+    '''
+    Record the cached revision of a file as the one the kernel page cache of
+    the file holds.
+
+    Returns:
+      The recorded revision string, or None if the file is not cached.
+
+    Raises:
+      Nothing
+    '''
+
+    try:
+      fileid = tsumufs.fsOverlay[fusepath].id
+    except (OSError, KeyError), e:
+      return None
+
+    try:
+      revision = tsumufs.fsOverlay.getCachedRevision(fileid)[0]
+    except KeyError, e:
+      self._pageCacheRevisions.pop(fileid, None)
+      return None
+
+    self._pageCacheRevisions[fileid] = revision
+    return revision
+
   @benchmark
   def readFile(self, fusepath, offset, length, flags, mode=0700):
     '''
@@ -310,6 +582,10 @@ class CacheManager(tsumufs.Debuggable):
 
     Otherwise, fs reads are done directly.
 
+    While the file is being cached, the data is read from the cache fill
+    as soon as the requested range is downloaded, without holding the
+    file lock.
+
     Returns:
       The data requested.
 
@@ -317,31 +593,59 @@ class CacheManager(tsumufs.Debuggable):
       OSError on error reading the data.
     '''
 
+    tsumufs.workingSet.noteAccess(fusepath, length)
+
     self.lockFile(fusepath)
 
     try:
       opcodes = self._genCacheOpcodes(fusepath)
-      self._validateCache(fusepath, opcodes)
+      self._validateCache(fusepath, opcodes, wait=False)
 
-      self._debug('Reading file contents from %s [ofs: %d, len: %d]'
-                  % (fusepath, offset, length))
+      fill = None
+      if 'use-fs' not in opcodes:
+        fill = self._getCacheFill(fusepath)
 
-      # TODO(jtg): Validate permissions here
+      if not fill:
+        return self._readFile(fusepath, offset, length, flags, mode, opcodes)
 
-      fp = tsumufs.fsOverlay.open(fusepath, flags, mode=mode,
-                                  usefs=('use-fs' in opcodes))
+    finally:
+      self.unlockFile(fusepath)
 
-      fp.seek(0)
-      fp.seek(offset)
-      result = fp.read(length)
-      fp.close(release=False)
+    self._debug('Reading file contents from cache fill of %s [ofs: %d, len: %d]'
+                % (fusepath, offset, length))
 
-      self._debug('Read %s' % repr(result))
-      return result
+    # Somebody is waiting for the copy now, stop yielding.
+    fill.backgroundTransfers = False
+    result = fill.read(offset, length)
+
+    if result is None:
+      # The fill completed in the meantime, read from the cached copy.
+      return self.readFile(fusepath, offset, length, flags, mode)
+
+    return result
+
+  def _readFile(self, fusepath, offset, length, flags, mode, opcodes):
+    '''
+    Read a chunk of data from the cached copy or the fs copy of the file,
+    depending on opcodes. The file has to be locked.
+    '''
+
+    self._debug('Reading file contents from %s [ofs: %d, len: %d]'
+                % (fusepath, offset, length))
+
+    # TODO(jtg): Validate permissions here
+
+    fp = tsumufs.fsOverlay.open(fusepath, flags, mode=mode,
+                                usefs=('use-fs' in opcodes))
+
+    fp.seek(0)
+    fp.seek(offset)
+    result = fp.read(length)
+    fp.close(release=False)
+
+    self._debug('Read %s' % repr(result))
+    return result
 
-    finally:
-      self.unlockFile(fusepath)
-      
   @benchmark
   def writeFile(self, fusepath, offset, buf, flags, mode=None):
     '''
@@ -365,6 +669,7 @@ class CacheManager(tsumufs.Debuggable):
       IOError on error writing the data.
     '''
 
+    self._awaitCacheFill(fusepath)
     self.lockFile(fusepath)
 
     try:
@@ -374,6 +679,8 @@ class CacheManager(tsumufs.Debuggable):
       self._debug('Writing to file %s at offset %d with buffer length of %d '
                   'and mode %s' % (fusepath, offset, len(buf), mode))
 
+      self._breakSnapshotLink(fusepath)
+
       # TODO(jtg): Validate permissions here, too
 
       fp = tsumufs.fsOverlay.open(fusepath, flags, mode=mode,
@@ -392,6 +699,44 @@ class CacheManager(tsumufs.Debuggable):
     finally:
       self.unlockFile(fusepath)
 
+  @benchmark
+  def syncFile(self, fusepath, datasync=False):
+    '''
+    Flush the data of the file referred to by fusepath to the disk it is
+    stored on, as fsync(2) does, or fdatasync(2) if datasync is set.
+
+    Returns:
+      Nothing
+
+    Raises:
+      OSError on error flushing the data.
+    '''
+
+    self.lockFile(fusepath)
+
+    try:
+      opcodes = self._genCacheOpcodes(fusepath)
+
+      if 'use-fs' in opcodes:
+        path = tsumufs.fsPathOf(fusepath)
+      else:
+        path = tsumufs.cachePathOf(fusepath)
+
+      self._debug('Flushing %s to disk.' % path)
+
+      fd = os.open(path, os.O_RDONLY)
+
+      try:
+        if datasync:
+          os.fdatasync(fd)
+        else:
+          os.fsync(fd)
+      finally:
+        os.close(fd)
+
+    finally:
+      self.unlockFile(fusepath)
+
   @benchmark
   def truncateFile(self, fusepath, size):
     '''
@@ -399,6 +744,8 @@ class CacheManager(tsumufs.Debuggable):
     access.
     '''
 
+    self._awaitCacheFill(fusepath)
+
     try:
       self.lockFile(fusepath)
 
@@ -407,6 +754,8 @@ class CacheManager(tsumufs.Debuggable):
 
       self._debug('Truncating %s to %d bytes.' % (fusepath, size))
 
+      self._breakSnapshotLink(fusepath)
+
       fp = tsumufs.fsOverlay.open(fusepath, os.O_RDWR,
                                   usefs=('use-fs' in opcodes))
 
@@ -574,7 +923,7 @@ class CacheManager(tsumufs.Debuggable):
       opcodes = self._genCacheOpcodes(fusepath, for_stat=True)
       self._debug(' Opcodes are: %s' % str(opcodes))
 
-      self._validateCache(fusepath, opcodes)
+      self._validateCache(fusepath, opcodes, wait=False)
 
       if 'enoent' in opcodes:
         raise OSError(errno.ENOENT, os.strerror(errno.ENOENT))
@@ -628,7 +977,7 @@ class CacheManager(tsumufs.Debuggable):
 
     try:
       opcodes = self._genCacheOpcodes(fusepath)
-      self._validateCache(fusepath, opcodes)
+      self._validateCache(fusepath, opcodes, wait=False)
 
       mode = self.statFile(fusepath).st_mode
     
@@ -692,6 +1041,10 @@ class CacheManager(tsumufs.Debuggable):
     self.lockFile(newpath)
 
     try:
+      # Cache fills would move their data to the old paths.
+      self._cancelCacheFill(fusepath)
+      self._cancelCacheFill(newpath)
+
       srcopcodes = self._genCacheOpcodes(fusepath)
       self._validateCache(fusepath, srcopcodes)
 
@@ -736,7 +1089,7 @@ class CacheManager(tsumufs.Debuggable):
 
     try:
       opcodes = self._genCacheOpcodes(fusepath)
-      self._validateCache(fusepath, opcodes)
+      self._validateCache(fusepath, opcodes, wait=False)
 
       # TODO(cleanup): make the above chunk of code into a decorator for crying
       # out loud. We do this in every public method and it adds confusion. =o(
@@ -842,15 +1195,27 @@ class CacheManager(tsumufs.Debuggable):
       # created bypassing the CouchedFilesystem api, directly on the filesystem.
       # The performance overhead raised by this operation increase when the number
       # of file to add to database is higher.
+      # The directory is only compared again once its mtime or ctime changed
+      # on the fs mount.
       if tsumufs.populateDb:
         try:
+          fsstat = os.stat(fspath)
+          stamp = (fsstat.st_mtime, fsstat.st_ctime)
+
+          if self._reconciledDirs.get(fusepath) == stamp:
+            self._debug('Directory %s unchanged since its last discovery.'
+                        % fusepath)
+            return
+
           self._debug('Discovering directory %s contents and populate database.' % fusepath)
-          dirents = [ doc.filename for doc in tsumufs.fsOverlay.listdir(fusepath) ]
+          dirents = set([ doc.filename for doc in tsumufs.fsOverlay.listdir(fusepath) ])
 
           for filename in os.listdir(fspath):
             if filename not in dirents:
               tsumufs.fsOverlay.populate(os.path.join(fusepath, filename))
 
+          self._reconciledDirs[fusepath] = stamp
+
         except OSError, e:
           self._debug('Cannot list directory %s (%s)' % (fusepath, e.strerror))
 
@@ -858,14 +1223,16 @@ class CacheManager(tsumufs.Debuggable):
       self.unlockFile(fusepath)
 
   @benchmark
-  def _cacheFile(self, fusepath):
+  def _cacheFile(self, fusepath, wait=True, background=False):
     '''
     Cache the file referenced by path.
 
     This method locks the file for reading, determines what type it
-    is, and attempts to cache it. Note that if there was an issue
-    reading from the fsMount, this method will mark the fs mount as
-    being unavailble.
+    is, and attempts to cache it. Regular files are copied in the
+    background by a CacheFill thread, only one copy of a file being run
+    at a time. The file lock is not held during the copy. Note that if
+    there was an issue reading from the fsMount, this method will mark
+    the fs mount as being unavailble.
 
     Note: The touch cache isn't implemented here at the moment. As a
     result, the entire cache is considered permacache for now.
@@ -874,16 +1241,21 @@ class CacheManager(tsumufs.Debuggable):
     moment. Any errors that would ordinarily shut down the fs mount
     are just reported as normal OSErrors, aside from ENOENT.
 
+    If background is set, the copy yields the bandwidth and the transfer
+    slots to the FUSE threads until someone waits for it.
+
     Returns:
-      Nothing.
+      The CacheFill copying the file, or None if the file has been cached
+      synchronously.
 
     Raises:
       OSError if there was an issue attempting to copy the file
-      across to cache.
+      across to cache, and wait is True.
     '''
 
     # TODO(jtg): Add support for storing the UID/GID
 
+    fill = None
     self.lockFile(fusepath)
 
     try:
@@ -896,41 +1268,327 @@ class CacheManager(tsumufs.Debuggable):
         # Caching a directory to disk -- call cacheDir instead.
         self._debug('Request to cache a directory -- calling _cacheDir')
         self._cacheDir(fusepath)
+        tsumufs.fsOverlay.setCachedRevision(document.id, document.rev,
+                                            document.stats.st_mtime)
+
+      elif stat.S_ISLNK(document.mode):
+        self._debug('Caching symlink %s to disk.' % fusepath)
+
+        dest = os.readlink(fspath)
+
+        try:
+          os.unlink(cachepath)
+        except OSError, e:
+          if e.errno != errno.ENOENT:
+            raise
+
+        os.symlink(dest, cachepath)
+        #os.lchown(cachepath, curstat.st_uid, curstat.st_gid)
+        #os.lutimes(cachepath, (curstat.st_atime, curstat.st_mtime))
+
+        tsumufs.fsOverlay.setCachedRevision(document.id, document.rev,
+                                            document.stats.st_mtime)
 
       else:
-        self._debug('Caching file %s to disk.' % fusepath)
+        fill = self._startCacheFill(fusepath, document, background)
+
+    finally:
+      self.unlockFile(fusepath)
+
+    if fill and wait:
+      fill.wait()
+
+    return fill
+
+  @benchmark
+  def _startCacheFill(self, fusepath, document, background=False):
+    '''
+    Start a CacheFill thread to copy the file to the cache, unless a copy
+    of the same revision is already running.
+
+    Returns:
+      The CacheFill thread.
+
+    Raises:
+      Nothing
+    '''
+
+    self._cacheFillsLock.acquire()
+
+    try:
+      fill = self._cacheFills.get(fusepath)
+
+      if (fill and not fill.cancelled and
+          fill.document.rev == document.rev):
+        self._debug('%s is already being cached.' % fusepath)
+
+        if not background:
+          fill.backgroundTransfers = False
+
+        return fill
+
+      if fill:
+        # The file changed upstream in the meantime, drop the outdated copy
+        # once done.
+        fill.cancelled = True
+
+      fill = CacheFill(fusepath, document, background,
+                       callback=self._cacheFillFinished)
+      self._cacheFills[fusepath] = fill
+      fill.start()
+
+      return fill
+
+    finally:
+      self._cacheFillsLock.release()
+
+  def _cacheFillFinished(self, fill):
+    '''
+    Callback passed to the CacheFill threads, called once done.
+    '''
+
+    self._cacheFillsLock.acquire()
+
+    try:
+      if self._cacheFills.get(fill.fusepath) is fill:
+        del self._cacheFills[fill.fusepath]
+    finally:
+      self._cacheFillsLock.release()
+
+  def _getCacheFill(self, fusepath):
+    '''
+    Return the CacheFill thread copying fusepath, if any.
+    '''
+
+    self._cacheFillsLock.acquire()
 
-        if (stat.S_ISREG(document.mode)  or
-            stat.S_ISFIFO(document.mode) or
-            stat.S_ISSOCK(document.mode) or
-            stat.S_ISCHR(document.mode)  or
-            stat.S_ISBLK(document.mode)):
+    try:
+      return self._cacheFills.get(fusepath)
+    finally:
+      self._cacheFillsLock.release()
 
-          try:
-              shutil.copyfileobj(tsumufs.fsMount.open(fusepath, os.O_RDONLY | os.O_BINARY),
-                                 open(cachepath, "wb"))
-          except AttributeError, e:
-              shutil.copyfileobj(tsumufs.fsMount.open(fusepath, os.O_RDONLY),
-                                 open(cachepath, "w"))
+  @benchmark
+  def _cancelCacheFill(self, fusepath):
+    '''
+    Cancel the copy of fusepath to the cache, if any, and wait for the
+    CacheFill thread to complete.
+    '''
 
-        elif stat.S_ISLNK(document.mode):
-          dest = os.readlink(fspath)
+    fill = self._getCacheFill(fusepath)
 
-          try:
-            os.unlink(cachepath)
-          except OSError, e:
-            if e.errno != errno.ENOENT:
-              raise
+    if fill:
+      fill.cancel()
 
-          os.symlink(dest, cachepath)
-          #os.lchown(cachepath, curstat.st_uid, curstat.st_gid)
-          #os.lutimes(cachepath, (curstat.st_atime, curstat.st_mtime))
+  @benchmark
+  def _awaitCacheFill(self, fusepath):
+    '''
+    Start the copy of fusepath to the cache if required, and wait for it to
+    complete without holding the file lock, so that the other operations on
+    the file are not blocked meanwhile.
 
-      tsumufs.fsOverlay.setCachedRevision(document.id, document.rev, document.stats.st_mtime)
+    Returns:
+      None
+
+    Raises:
+      OSError if there was an issue attempting to copy the file
+      across to cache, aside from ENOENT.
+    '''
+
+    fill = None
+    self.lockFile(fusepath)
+
+    try:
+      try:
+        if 'cache-file' in self._genCacheOpcodes(fusepath):
+          fill = self._cacheFile(fusepath, wait=False)
+
+        else:
+          fill = self._getCacheFill(fusepath)
+
+      except OSError, e:
+        # Creation of a new file, left to the caller.
+        if e.errno != errno.ENOENT:
+          raise
 
     finally:
       self.unlockFile(fusepath)
 
+    if fill:
+      # Somebody is waiting for the copy now, stop yielding the bandwidth.
+      fill.backgroundTransfers = False
+      fill.wait()
+
+  @benchmark
+  def refreshFile(self, fusepath):
+    '''
+    Start the copy of fusepath to the cache in the background if its cached
+    copy is outdated, or if it is not cached yet but should be and the
+    cache has room for it. The files open for writing are left alone.
+
+    Returns:
+      The CacheFill thread copying the file, or None.
+
+    Raises:
+      Nothing
+    '''
+
+    if tsumufs.openFileRegistry.isOpen(fusepath):
+      return None
+
+    self.lockFile(fusepath)
+
+    try:
+      try:
+        if 'cache-file' not in self._genCacheOpcodes(fusepath):
+          return None
+
+        if (not self.isCachedToDisk(fusepath) and
+            not self._hasRoomFor(tsumufs.fsOverlay[fusepath].stats.st_size)):
+          self._debug('No room left in the cache for %s.' % fusepath)
+          return None
+
+        self._debug('Refreshing %s in the background.' % fusepath)
+        return self._cacheFile(fusepath, wait=False, background=True)
+
+      except (IOError, OSError), e:
+        self._debug('Unable to refresh %s: %s' % (fusepath, str(e)))
+        return None
+
+    finally:
+      self.unlockFile(fusepath)
+
+  def _hasRoomFor(self, size):
+    '''
+    Check to see if size bytes can be added to the cache, while keeping
+    _minFreeRatio of its filesystem free.
+    '''
+
+    fsstat = os.statvfs(tsumufs.cachePoint)
+
+    free  = fsstat.f_bavail * fsstat.f_frsize
+    total = fsstat.f_blocks * fsstat.f_frsize
+
+    return free - size >= total * self._minFreeRatio
+
+  def _isReadOnly(self, flags):
+    return not (flags & (os.O_WRONLY | os.O_RDWR | os.O_CREAT | os.O_TRUNC))
+
+  @benchmark
+  def snapshotFile(self, fusepath):
+    '''
+    Take a point-in-time copy of the cached file, so that the sync thread can
+    read it without holding the file lock. The copy shares the data blocks of
+    the cached file: it is a reflink where the cache filesystem supports it,
+    otherwise a hardlink that is broken by the next write to the cached file.
+
+    Returns:
+      The path of the snapshot, to be given to releaseSnapshot once done.
+
+    Raises:
+      OSError if there was an issue creating the snapshot.
+    '''
+
+    self.lockFile(fusepath)
+
+    try:
+      cachepath = tsumufs.cachePathOf(fusepath)
+      snapshot = os.path.join(tsumufs.snapshotDir,
+                              'snapshot-%d' % self._snapshotIds.next())
+
+      if self._reflinkSupported:
+        try:
+          self._reflink(cachepath, snapshot)
+          self._debug('Reflinked %s to %s' % (fusepath, snapshot))
+          return snapshot
+
+        except (IOError, OSError), e:
+          if e.errno not in (errno.EOPNOTSUPP, errno.EXDEV, errno.EINVAL,
+                             errno.ENOTTY, errno.ENOSYS):
+            raise
+
+          self._debug('Reflinks are not supported by the cache filesystem '
+                      '(%s) -- using hardlinks.' % os.strerror(e.errno))
+          self._reflinkSupported = False
+
+      if hasattr(os, 'link'):
+        os.link(cachepath, snapshot)
+
+        stats = os.lstat(snapshot)
+        self._linkedSnapshots[snapshot] = (stats.st_dev, stats.st_ino)
+        self._debug('Linked %s to %s' % (fusepath, snapshot))
+
+      else:
+        shutil.copyfile(cachepath, snapshot)
+        self._debug('Copied %s to %s' % (fusepath, snapshot))
+
+      return snapshot
+
+    finally:
+      self.unlockFile(fusepath)
+
+  @benchmark
+  def releaseSnapshot(self, snapshot):
+    '''
+    Remove a snapshot taken by snapshotFile.
+    '''
+
+    self._linkedSnapshots.pop(snapshot, None)
+
+    try:
+      os.unlink(snapshot)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def _reflink(self, source, target):
+    fdin = os.open(source, os.O_RDONLY)
+
+    try:
+      fdout = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+
+      try:
+        fcntl.ioctl(fdout, FICLONE, fdin)
+      except:
+        os.close(fdout)
+        os.unlink(target)
+        raise
+
+      os.close(fdout)
+
+    finally:
+      os.close(fdin)
+
+  def _breakSnapshotLink(self, fusepath):
+    '''
+    Replace the cached file by a copy of itself if it is hardlinked to a
+    snapshot, before modifying its data. The other hardlinks of the file are
+    left alone. The file has to be locked.
+    '''
+
+    if not self._linkedSnapshots:
+      return
+
+    cachepath = tsumufs.cachePathOf(fusepath)
+
+    try:
+      stats = os.lstat(cachepath)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        return
+      raise
+
+    if not stat.S_ISREG(stats.st_mode) or stats.st_nlink < 2:
+      return
+
+    if (stats.st_dev, stats.st_ino) not in self._linkedSnapshots.values():
+      return
+
+    self._debug('Breaking the snapshot link of %s' % fusepath)
+
+    tmppath = cachepath + '.tsumufs-cow'
+    shutil.copy2(cachepath, tmppath)
+    os.rename(tmppath, cachepath)
+
   @benchmark
   def removeCachedFile(self, fusepath, removeperm=False):
     '''
@@ -953,6 +1611,8 @@ class CacheManager(tsumufs.Debuggable):
     self.lockFile(fusepath)
 
     try:
+      self._cancelCacheFill(fusepath)
+
       opcodes = self._genCacheOpcodes(fusepath)
       document = tsumufs.fsOverlay[fusepath]
 
@@ -984,10 +1644,34 @@ class CacheManager(tsumufs.Debuggable):
         # Document never cached to disk
         pass
 
+      self.invalidatePageCache(document.id)
+
       return ('use-fs' not in opcodes)
     finally:
       self.unlockFile(fusepath)
 
+  @benchmark
+  def isPinned(self, fusepath):
+    '''
+    Check to see if the cachespec explicitly requires fusepath, or one of
+    its parent directories, to be cached.
+
+    Returns:
+      Boolean.
+
+    Raises:
+      None
+    '''
+
+    path = fusepath
+    while path != "/":
+      if self._cacheSpec.has_key(path):
+        return self._cacheSpec[path]
+
+      (path, base) = os.path.split(path)
+
+    return self._cacheSpec.get("/", False)
+
   @benchmark
   def _shouldCacheFile(self, fusepath):
     '''
@@ -1030,10 +1714,12 @@ class CacheManager(tsumufs.Debuggable):
     return True
 
   @benchmark
-  def _validateCache(self, fusepath, opcodes=None):
+  def _validateCache(self, fusepath, opcodes=None, wait=True):
     '''
     Validate that the cached copies of fusepath on local disk are the same as
     the copies upstream, based upon the opcodes geenrated by _genCacheOpcodes.
+    If wait is False, the file copy is run in the background, and yields to
+    the copies somebody waits for.
 
     Returns:
       None
@@ -1053,7 +1739,7 @@ class CacheManager(tsumufs.Debuggable):
         self.removeCachedFile(fusepath)
       if opcode == 'cache-file':
         self._debug('Updating cache of file %s' % fusepath)
-        self._cacheFile(fusepath)
+        self._cacheFile(fusepath, wait=wait, background=not wait)
       if opcode == 'merge-conflict':
         # TODO: handle a merge-conflict?
         self._debug('Merge/conflict on %s' % fusepath)
@@ -1308,6 +1994,10 @@ class CacheManager(tsumufs.Debuggable):
 #     self._debug('Unlocking file %s (from: %s(%d): in %s <%d>).'
 #                 % (fusepath, tb[0], tb[1], tb[2], thread.get_ident()))
 
+    # The file may have changed while it was locked.
+    if self._primedStats:
+      self._forgetPrimedStats(fusepath)
+
     self._fileLocks[fusepath].release()
 
   @benchmark
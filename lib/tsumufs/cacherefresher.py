@@ -0,0 +1,190 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import sys
+import threading
+
+import tsumufs
+
+
+class CacheRefresher(tsumufs.Debuggable, threading.Thread):
+  '''
+  Thread refreshing the outdated cached copies of files in the background,
+  so that the next opens find an up to date copy instead of waiting for the
+  download.
+
+  The files are refreshed in the order they were queued, with at most
+  refreshConcurrency copies running at once. The copies yield the bandwidth
+  to the FUSE threads.
+  '''
+
+  backgroundTransfers = True
+
+  _revalidate = False           # Whether a bulk revalidation of the cache is
+                                # requested.
+
+  def __init__(self):
+    self._debug('Initializing.')
+
+    threading.Thread.__init__(self, name='CacheRefresher')
+    self.setDaemon(True)
+
+    self._condition = threading.Condition()
+    self._queue = []
+    self._queued = set()
+
+  def refresh(self, fusepath):
+    '''
+    Queue the refresh of the cached copy of fusepath. Never waits.
+    '''
+
+    self._condition.acquire()
+
+    try:
+      if fusepath not in self._queued:
+        self._queued.add(fusepath)
+        self._queue.append(fusepath)
+        self._condition.notify()
+
+    finally:
+      self._condition.release()
+
+  def revalidate(self):
+    '''
+    Request the comparison of all the cached revisions with the ones of
+    their documents, typically once reconnected to the fs mount.
+    '''
+
+    self._condition.acquire()
+
+    try:
+      self._revalidate = True
+      self._condition.notify()
+
+    finally:
+      self._condition.release()
+
+  def _next(self):
+    '''
+    Wait for some work while the fs mount is available.
+
+    Returns:
+      A tuple (revalidate, fusepath), fusepath being the file to refresh or
+      None.
+    '''
+
+    self._condition.acquire()
+
+    try:
+      if (not (self._queue or self._revalidate) or
+          not tsumufs.fsAvailable.isSet()):
+        self._condition.wait(1)
+
+      if not tsumufs.fsAvailable.isSet():
+        return False, None
+
+      if self._revalidate:
+        self._revalidate = False
+        return True, None
+
+      if not self._queue:
+        return False, None
+
+      fusepath = self._queue.pop(0)
+      self._queued.discard(fusepath)
+
+      return False, fusepath
+
+    finally:
+      self._condition.release()
+
+  def _revalidateCache(self):
+    '''
+    Queue the prefetch of the working set, then the refresh of the outdated
+    files pinned by the cachespec. The other ones are refreshed on their next
+    access.
+    '''
+
+    self._prefetchWorkingSet()
+
+    outdated = tsumufs.fsOverlay.getOutdatedFiles()
+    pinned = [ fusepath for fusepath in outdated
+               if tsumufs.cacheManager.isPinned(fusepath) ]
+
+    self._debug('Revalidated the cache: %d files outdated, %d to refresh.'
+                % (len(outdated), len(pinned)))
+
+    for fusepath in pinned:
+      self.refresh(fusepath)
+
+  def _prefetchWorkingSet(self):
+    '''
+    Queue the content of the files of the working set, best first. Only the
+    reads are recorded in the working set, the metadata are not prefetched.
+    '''
+
+    for fusepath, size in tsumufs.workingSet.top(tsumufs.prefetchCount):
+      self.refresh(fusepath)
+
+  def _waitForSlot(self, fills):
+    '''
+    Wait for the number of copies running to drop below refreshConcurrency.
+
+    Returns:
+      The list of the copies still running.
+    '''
+
+    while True:
+      fills = [ fill for fill in fills if not fill.done ]
+
+      if len(fills) < tsumufs.refreshConcurrency:
+        return fills
+
+      try:
+        fills[0].wait()
+      except (IOError, OSError), e:
+        self._debug('Refresh of %s failed: %s' % (fills[0].fusepath, e))
+
+  def run(self):
+    # Install our custom exception handler so that any exceptions are
+    # output to the syslog rather than to /dev/null.
+    sys.excepthook = tsumufs.syslogExceptHook
+
+    fills = []
+
+    while not tsumufs.unmounted.isSet():
+      try:
+        revalidate, fusepath = self._next()
+
+        if revalidate:
+          self._revalidateCache()
+
+        if fusepath is None:
+          continue
+
+        fill = tsumufs.cacheManager.refreshFile(fusepath)
+
+        if fill:
+          fills.append(fill)
+          fills = self._waitForSlot(fills)
+
+      except Exception, e:
+        self._debug('Unable to refresh the cache -- caught an exception.')
+        tsumufs.syslogCurrentException()
+
+    self._debug('CacheRefresher shutdown complete.')
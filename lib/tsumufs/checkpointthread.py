@@ -0,0 +1,167 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import time
+import threading
+
+import tsumufs
+
+
+def noteBatchedWrite(count=1):
+  '''
+  Account for writes made through a batched DocumentHelper, so that the
+  checkpoint thread commits them early if too many are pending.
+  '''
+
+  if tsumufs.checkpointThread is not None:
+    tsumufs.checkpointThread.noteWrite(count)
+
+
+class CheckpointThread(tsumufs.Debuggable, threading.Thread):
+  '''
+  Thread committing the batched writes of the synclog, of its data regions
+  and of the cached revisions to disk, along with the working set.
+
+  The writes are group-committed every checkpointTimeout seconds, or as soon
+  as _maxPendingWrites of them are pending, or when a checkpoint is
+  requested. Committing a database commits all of its batched documents, so
+  a single checkpoint covers the writes of every DocumentHelper.
+  '''
+
+  _maxPendingWrites = 1000      # Number of batched writes triggering an early
+                                # checkpoint.
+
+  _pendingWrites = 0
+  _requested     = False
+  _started       = 0            # Number of checkpoints started.
+  _completed     = 0            # Number of checkpoints completed.
+  _failed        = 0            # Number of the last checkpoint that failed.
+
+  def __init__(self):
+    self._debug('Initializing.')
+
+    threading.Thread.__init__(self, name='CheckpointThread')
+    self.setDaemon(True)
+
+    self._condition = threading.Condition()
+
+  def noteWrite(self, count=1):
+    '''
+    Account for count batched writes, waking the thread up if the size
+    threshold is hit. Never waits for the checkpoint.
+    '''
+
+    self._condition.acquire()
+
+    try:
+      self._pendingWrites += count
+
+      if self._pendingWrites >= self._maxPendingWrites:
+        self._condition.notifyAll()
+
+    finally:
+      self._condition.release()
+
+  def requestCheckpoint(self, wait=False):
+    '''
+    Request a checkpoint, and wait for it to complete if wait is set.
+    Requests made while a checkpoint is running are merged into the next
+    one.
+
+    Returns:
+      True if the writes made before the request are on disk, False if the
+      checkpoint failed. Always True if wait is not set.
+
+    Raises:
+      Nothing
+    '''
+
+    self._condition.acquire()
+
+    try:
+      # The checkpoint running now may have missed the writes made just
+      # before the request, wait for the next one.
+      target = self._started + 1
+
+      self._requested = True
+      self._condition.notifyAll()
+
+      if not wait:
+        return True
+
+      while self._completed < target and self.isAlive():
+        self._condition.wait(1)
+
+      return self._completed >= target and self._failed < target
+
+    finally:
+      self._condition.release()
+
+  def _isDue(self, deadline):
+    return (self._requested or
+            self._pendingWrites >= self._maxPendingWrites or
+            time.time() >= deadline or
+            tsumufs.unmounted.isSet())
+
+  def _checkpoint(self):
+    tsumufs.syncLog.checkpoint()
+    tsumufs.fsOverlay.checkpoint()
+    tsumufs.workingSet.save(tsumufs.workingSetPath)
+
+  def run(self):
+    self._debug('Checkpointing every %d seconds.' % tsumufs.checkpointTimeout)
+
+    while True:
+      deadline = time.time() + tsumufs.checkpointTimeout
+
+      self._condition.acquire()
+
+      try:
+        while not self._isDue(deadline):
+          self._condition.wait(max(0, min(deadline - time.time(), 1)))
+
+        self._requested = False
+        self._pendingWrites = 0
+        self._started += 1
+        number = self._started
+
+      finally:
+        self._condition.release()
+
+      # Commit outside of the lock, so that the writers never wait for it.
+      try:
+        self._checkpoint()
+
+      except Exception, e:
+        self._debug('Unable to checkpoint -- caught an exception.')
+        tsumufs.syslogCurrentException()
+        self._failed = number
+
+      self._condition.acquire()
+
+      try:
+        self._completed = number
+        self._condition.notifyAll()
+
+      finally:
+        self._condition.release()
+
+      if tsumufs.unmounted.isSet():
+        break
+
+    self._debug('CheckpointThread shutdown complete.')
@@ -16,9 +16,22 @@
 
 '''TsumuFS is a disconnected, offline caching filesystem.'''
 
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5
+
 from ufo.database import Document, TextField, IntegerField, ViewField
 
 
+def checksum(data):
+  '''
+  Return the checksum of a chunk of data, as stored in the DataRegionDocuments.
+  '''
+
+  return md5(data).hexdigest()
+
+
 class RangeError(Exception):
   '''
   Exception for representing a range error.
@@ -65,10 +78,12 @@ class DataRegionDocument(Document):
   doctype       = TextField(default="DataRegionDocument")
   filechangeid  = TextField()
 
-  data   = TextField()
-  start  = IntegerField()
-  end    = IntegerField()
-  length = IntegerField()
+  data     = TextField()
+  start    = IntegerField()
+  end      = IntegerField()
+  length   = IntegerField()
+  checksum = TextField()      # Checksum of the data, used to detect conflicts
+                              # without comparing the data itself.
 
   def __len__(self):
     '''
@@ -111,8 +126,28 @@ class DataRegionDocument(Document):
 
       hargs['length'] = len(hargs['data'])
 
+      if not hargs.get('checksum'):
+        hargs['checksum'] = checksum(hargs['data'])
+
     Document.__init__(self, **hargs)
 
+  def getChecksum(self):
+    '''
+    Return the checksum of the data of the region.
+
+    Returns:
+      String
+
+    Raises:
+      None
+    '''
+
+    if self.checksum:
+      return self.checksum
+
+    # Region stored before the checksums were introduced.
+    return checksum(self.data)
+
   def canMerge(self, dataregion):
     if ((dataregion.start == self.start) and   # |---|
         (dataregion.end == self.end)):         # |===|
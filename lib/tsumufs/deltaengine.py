@@ -0,0 +1,326 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import os
+import os.path
+import sys
+import zlib
+import errno
+import cPickle
+
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5
+
+try:
+  import multiprocessing
+except ImportError:
+  multiprocessing = None
+
+import tsumufs
+
+
+def blockSignatures(path, start, end, blockSize):
+  '''
+  Compute the signatures of the blocks of a file in the range [start, end),
+  start being aligned on blockSize. Run in the worker processes of the
+  DeltaEngine.
+
+  Returns:
+    A list of (weak checksum, strong checksum) tuples, one per block.
+
+  Raises:
+    IOError, OSError if the file cannot be read.
+  '''
+
+  signatures = []
+
+  fp = open(path, 'rb')
+
+  try:
+    fp.seek(start)
+
+    while start < end:
+      data = fp.read(min(blockSize, end - start))
+      if not data:
+        break
+
+      signatures.append((zlib.adler32(data) & 0xffffffff,
+                         md5(data).digest()))
+      start += len(data)
+
+  finally:
+    fp.close()
+
+  return signatures
+
+def _blockSignatures(args):
+  return blockSignatures(*args)
+
+def changedBlocks(signatures, reference):
+  '''
+  Compare the signatures of the blocks of a file with the ones of a reference
+  version of the file, block by block.
+
+  Returns:
+    The list of the indexes of the blocks that differ from the reference.
+
+  Raises:
+    Nothing
+  '''
+
+  changed = []
+
+  for index, signature in enumerate(signatures):
+    if index >= len(reference):
+      changed.append(index)
+
+    # Compare the cheap weak checksums first.
+    elif (signature[0] != reference[index][0] or
+          signature[1] != reference[index][1]):
+      changed.append(index)
+
+  return changed
+
+def blocksToRanges(blocks, blockSize, size):
+  '''
+  Convert a sorted list of block indexes to a list of [start, end) ranges of
+  bytes, merging the contiguous blocks.
+  '''
+
+  ranges = []
+
+  for index in blocks:
+    start = index * blockSize
+    end = min(start + blockSize, size)
+
+    if ranges and ranges[-1][1] == start:
+      ranges[-1][1] = end
+    else:
+      ranges.append([start, end])
+
+  return ranges
+
+
+class DeltaEngine(tsumufs.Debuggable):
+  '''
+  Class computing the differences between the local copy of a file and the
+  copy on the fs mount, so that only the blocks that changed are uploaded.
+
+  The signatures of the blocks of the files are computed by a pool of worker
+  processes, to avoid stalling the FUSE threads on the GIL. The signatures of
+  the last version of a file synced to the fs mount are kept in a signature
+  file, valid as long as the size and mtime of the file on the fs mount do
+  not change. Otherwise the signatures of the copy on the fs mount are
+  computed.
+
+  As the fs mount can only be patched in place, only the blocks that did not
+  move in the file can be reused.
+  '''
+
+  blockSize = 64 * 1024         # Size of the blocks compared.
+  threshold = 1024 * 1024       # Files smaller than this are sent whole.
+
+  _blocksPerTask = 256          # Number of blocks hashed by a worker at once.
+
+  _pool = None
+
+  def __init__(self):
+    try:
+      os.mkdir(tsumufs.signatureDir, 0700)
+    except OSError, e:
+      if e.errno != errno.EEXIST:
+        raise
+
+  def _getPool(self):
+    if self._pool is None and multiprocessing is not None:
+      try:
+        self._pool = multiprocessing.Pool()
+      except (OSError, ImportError, NotImplementedError), e:
+        self._debug('Unable to start the signature workers (%s) -- '
+                    'computing signatures in process.' % str(e))
+        self._pool = False
+
+    return self._pool
+
+  def close(self):
+    '''
+    Stop the worker processes.
+    '''
+
+    if self._pool:
+      self._pool.terminate()
+      self._pool.join()
+
+    self._pool = None
+
+  def signatures(self, path, start=0, end=None):
+    '''
+    Compute the signatures of the blocks of the file in [start, end).
+
+    Returns:
+      A list of (weak checksum, strong checksum) tuples, one per block.
+
+    Raises:
+      IOError, OSError if the file cannot be read.
+    '''
+
+    if end is None:
+      end = os.stat(path).st_size
+
+    start -= start % self.blockSize
+    taskSize = self.blockSize * self._blocksPerTask
+
+    tasks = [ (path, offset, min(offset + taskSize, end), self.blockSize)
+              for offset in xrange(start, end, taskSize) ]
+
+    pool = self._getPool()
+    if pool and len(tasks) > 1:
+      results = pool.map(_blockSignatures, tasks)
+    else:
+      results = map(_blockSignatures, tasks)
+
+    signatures = []
+    for result in results:
+      signatures.extend(result)
+
+    return signatures
+
+  def changedRanges(self, path, reference):
+    '''
+    Compute the ranges of the file that differ from the reference
+    signatures.
+
+    Returns:
+      A tuple made of the list of [start, end) ranges that changed, and the
+      signatures of the file.
+
+    Raises:
+      IOError, OSError if the file cannot be read.
+    '''
+
+    size = os.stat(path).st_size
+    signatures = self.signatures(path, 0, size)
+    ranges = blocksToRanges(changedBlocks(signatures, reference),
+                            self.blockSize, size)
+
+    self._debug('%d bytes of %s changed in %d ranges.'
+                % (sum([ end - start for start, end in ranges ]),
+                   path, len(ranges)))
+
+    return ranges, signatures
+
+  def updateSignatures(self, signatures, path, ranges):
+    '''
+    Update the signatures of a file after the ranges of the file changed.
+
+    Returns:
+      The updated list of signatures.
+
+    Raises:
+      IOError, OSError if the file cannot be read.
+    '''
+
+    size = os.stat(path).st_size
+    signatures = signatures[:(size + self.blockSize - 1) / self.blockSize]
+
+    # The last block may have been partial, and blocks are appended if the
+    # file grew.
+    ranges = list(ranges)
+    ranges.append((max(len(signatures) - 1, 0) * self.blockSize, size))
+
+    for start, end in ranges:
+      start -= start % self.blockSize
+      end = min(size, end + (-end % self.blockSize))
+      if start >= end:
+        continue
+
+      index = start / self.blockSize
+      updated = self.signatures(path, start, end)
+      signatures[index:index + len(updated)] = updated
+
+    return signatures
+
+  def _signaturePathOf(self, fusepath):
+    if isinstance(fusepath, unicode):
+      fusepath = fusepath.encode('utf-8')
+
+    return os.path.join(tsumufs.signatureDir, md5(fusepath).hexdigest())
+
+  def loadSignatures(self, fusepath, fs_stat):
+    '''
+    Return the signatures of the file on the fs mount kept in the signature
+    file of fusepath, if still valid.
+
+    Returns:
+      A list of signatures or None.
+
+    Raises:
+      Nothing
+    '''
+
+    try:
+      fp = open(self._signaturePathOf(fusepath), 'rb')
+
+      try:
+        size, mtime, blockSize, signatures = cPickle.load(fp)
+      finally:
+        fp.close()
+
+    except (IOError, OSError, EOFError, ValueError, cPickle.UnpicklingError):
+      return None
+
+    if ((size, mtime, blockSize) !=
+        (fs_stat.st_size, fs_stat.st_mtime, self.blockSize)):
+      self._debug('Signatures of %s are outdated.' % fusepath)
+      return None
+
+    return signatures
+
+  def saveSignatures(self, fusepath, fs_stat, signatures):
+    '''
+    Keep the signatures of the file on the fs mount, along with its size and
+    mtime.
+    '''
+
+    path = self._signaturePathOf(fusepath)
+
+    fp = open(path + '.tmp', 'wb')
+
+    try:
+      cPickle.dump((fs_stat.st_size, fs_stat.st_mtime, self.blockSize,
+                    signatures), fp, cPickle.HIGHEST_PROTOCOL)
+    finally:
+      fp.close()
+
+    os.rename(path + '.tmp', path)
+
+  def removeSignatures(self, fusepath):
+    try:
+      os.unlink(self._signaturePathOf(fusepath))
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+  def renameSignatures(self, old, new):
+    try:
+      os.rename(self._signaturePathOf(old), self._signaturePathOf(new))
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
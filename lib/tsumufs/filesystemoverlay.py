@@ -24,13 +24,13 @@ import time
 import errno
 import exceptions
 import threading
+import posixpath
 import new
 
 import tsumufs
 from extendedattributes import extendedattribute
 
 from ufo.filesystem import SyncDocument, CouchedFileSystem
-from ufo.utils import CacheDict
 from ufo.database import *
 
 
@@ -54,6 +54,79 @@ class CachedRevisionDocument(UTF8Document):
             "}")
 
 
+class CouchedRevisionStore(tsumufs.Debuggable):
+  '''
+  Store of the revisions of the cached copies of the files, kept in
+  CachedRevisionDocuments of the local CouchDB database.
+  '''
+
+  def __init__(self):
+    self._revisions = DocumentHelper(CachedRevisionDocument, tsumufs.dbName,
+                                     batch=True)
+
+  def get(self, fileid):
+    try:
+      cached = self._revisions.by_fileid(key=fileid, pk=True)
+      return cached.revision, cached.mtime
+
+    except DocumentException, e:
+      raise KeyError(e.message)
+
+  def set(self, fileid, revision, mtime):
+    try:
+      cacherev = self._revisions.by_fileid(key=fileid, pk=True)
+      cacherev.revision = revision
+      cacherev.mtime = mtime
+
+      self._revisions.update(cacherev)
+
+    except DocumentException, e:
+      self._revisions.create(fileid=fileid, revision=revision, mtime=mtime)
+
+  def remove(self, fileid):
+    try:
+      local = self._revisions.by_fileid(key=fileid, pk=True)
+      self._revisions.delete(local)
+
+      return local.revision, local.mtime
+
+    except DocumentException, e:
+      raise KeyError(e.message)
+
+  def items(self):
+    return [ (doc.fileid, doc.revision, doc.mtime)
+             for doc in self._revisions.by_fileid() ]
+
+  def commit(self):
+    self._revisions.commit()
+
+
+def openRevisionStore():
+  '''
+  Open the store of the cached revisions selected by the metadatastore
+  mount option. The SQLite store is filled from the CachedRevisionDocuments
+  of a previous mount until a seeding has been committed, without
+  overwriting the revisions it already has.
+  '''
+
+  if tsumufs.metadataStore != 'sqlite':
+    return CouchedRevisionStore()
+
+  store = tsumufs.SQLiteRevisionStore(tsumufs.metadataPath)
+
+  if not store.isSeeded():
+    for fileid, revision, mtime in CouchedRevisionStore().items():
+      try:
+        store.get(fileid)
+      except KeyError, e:
+        store.set(fileid, revision, mtime)
+
+    store.markSeeded()
+    store.commit()
+
+  return store
+
+
 class FileSystemOverlay(tsumufs.Debuggable):
   '''
   The CouchedFileSytem api from the python-ufo library is middleware
@@ -69,9 +142,22 @@ class FileSystemOverlay(tsumufs.Debuggable):
 
   It also schedule read/write access to local/remote filesystem
   in function to the 'usefs' parameter.
+
+  With the sqlite metadatastore, the stats and the directory listings are
+  read from a local mirror of the documents kept by a MetadataBridge, once
+  it has caught up with the writes made through the overlay.
   '''
 
-  _localRevisions = None            # Revisions of the cached copies of documents.
+  _localRevisions = None            # Index of the revisions of the cached
+                                    # copies of documents.
+
+  _bulkSize = 1000                  # Number of documents queried at once.
+
+  _metadata       = None            # Local mirror of the SyncDocuments.
+  _metadataBridge = None            # Thread keeping the mirror up to date.
+
+  _mirroredCalls = ('stat', 'listdir')
+  _readCalls     = ('_get', 'stat', 'listdir', 'du', 'getxattr', 'listxattr')
 
   def __init__(self):
     self.replicationTaskId = 0
@@ -82,8 +168,56 @@ class FileSystemOverlay(tsumufs.Debuggable):
                                            tsumufs.dbName,
                                            db_metadatas=True)
 
-    self._localRevisions = DocumentHelper(CachedRevisionDocument, tsumufs.dbName,
-                                          batch=True)
+    self._localRevisions = tsumufs.CachedRevisionIndex(openRevisionStore())
+
+    if tsumufs.metadataStore == 'sqlite':
+      self._metadata = tsumufs.SQLiteDocumentStore(tsumufs.documentsPath)
+      self._metadataBridge = tsumufs.MetadataBridge(
+        self._metadata, DocumentHelper(SyncDocument, tsumufs.dbName))
+
+      # The mirror is not used before it catches up with the database.
+      self._noteMetadataWrite()
+
+  def startMetadataBridge(self):
+    if self._metadataBridge is not None:
+      self._metadataBridge.start()
+
+  def _noteMetadataWrite(self):
+    '''
+    Keep the metadata reads off the mirror until the bridge has applied the
+    changes made so far. The mirror is not used anymore if the sequence
+    number of the database cannot be known.
+    '''
+
+    if self._metadataBridge is None:
+      return
+
+    try:
+      seq = self._couchedLocal.doc_helper.database.info()['update_seq']
+
+    except Exception, e:
+      self._debug('Unable to get the update sequence: %s' % str(e))
+      seq = None
+
+    self._metadataBridge.require(seq)
+
+  def _readMirror(self, attr, fusepath):
+    '''
+    Serve a metadata read from the local mirror.
+
+    Raises:
+      KeyError, if the mirror is not current or does not know the file.
+    '''
+
+    if self._metadataBridge is None or not self._metadataBridge.isCurrent():
+      raise KeyError(fusepath)
+
+    if attr == 'stat':
+      dirpath, filename = posixpath.split(fusepath)
+      return SyncDocument.wrap(self._metadata.get(dirpath, filename)).stats
+
+    return ( SyncDocument.wrap(data)
+             for data in self._metadata.listdir(fusepath) )
 
   def startReplication(self):
     '''
@@ -129,36 +263,21 @@ class FileSystemOverlay(tsumufs.Debuggable):
 
     self._localRevisions.commit()
 
+    if self._metadata is not None:
+      self._metadata.commit()
+
   def getCachedRevision(self, fileid):
     '''
     Get the last cached revision number of a file.
 
     Returns:
-      A revision string
+      A (revision, mtime) tuple
 
     Raises:
       KeyError
     '''
 
-    try:
-      self._cachedRevisions.acquire()
-
-      # Use the in-memory cached copy of the revision if exists,
-      # otherwise get revision from database and cache it.
-      if self._cachedRevisions.isObsolete(fileid):
-        cached = self._localRevisions.by_fileid(key=fileid, pk=True)
-        revision, mtime = cached.revision, cached.mtime
-
-        self._debug('Caching revision in memory (%s -> %s, %s)' % (fileid, revision, mtime))
-        self._cachedRevisions.cache(fileid, (revision, mtime))
-
-      return self._cachedRevisions.get(fileid)
-
-    except DocumentException, e:
-      raise KeyError(e.message)
-
-    finally:
-      self._cachedRevisions.release()
+    return self._localRevisions.get(fileid)
 
   def setCachedRevision(self, fileid, revision, mtime):
     '''
@@ -171,53 +290,68 @@ class FileSystemOverlay(tsumufs.Debuggable):
       Nothing
     '''
 
-    try:
-      self._cachedRevisions.acquire()
+    self._localRevisions.set(fileid, revision, mtime)
+    tsumufs.noteBatchedWrite()
 
-      try:
-        cacherev = self._localRevisions.by_fileid(key=fileid, pk=True)
-        cacherev.revision = revision
-        cacherev.mtime = mtime
+  def removeCachedRevision(self, fileid):
+    '''
+    Remove the last cached revision number of a file.
 
-        self._localRevisions.update(cacherev)
+    Returns:
+      A (fileid, revision) tuple
 
-      except DocumentException, e:
-        self._localRevisions.create(fileid=fileid, revision=revision, mtime=mtime)
+    Raises:
+      KeyError
+    '''
 
-      # Update the in-memory cached copy
-      self._cachedRevisions.cache(fileid, (revision, mtime))
+    revision, mtime = self._localRevisions.remove(fileid)
+    tsumufs.noteBatchedWrite()
 
-    finally:
-      self._cachedRevisions.release()
+    return fileid, revision
 
-  def removeCachedRevision(self, fileid):
+  def getOutdatedFiles(self):
     '''
-    Remove the last cached revision number of a file.
+    Compare the revisions of all the cached copies of documents with the
+    current revisions of the documents, in bulk queries.
 
     Returns:
-      Nothing
+      A list of the paths of the files whose cached copy is outdated.
 
     Raises:
-      KeyError
+      Nothing
     '''
 
-    try:
-      self._cachedRevisions.acquire()
+    database = self._couchedLocal.doc_helper.database
+    fileids = self._localRevisions.fileids()
+    outdated = []
 
-      local = self._localRevisions.by_fileid(key=fileid,
-                                             pk=True)
+    for start in xrange(0, len(fileids), self._bulkSize):
+      stale = []
 
-      self._localRevisions.delete(local)
-      # Remove the in-memory cached copy
-      self._cachedRevisions.invalidate(fileid)
+      for row in database.view('_all_docs',
+                               keys=fileids[start:start + self._bulkSize]):
+        value = row.get('value')
 
-      return local.fileid, local.revision
+        # Removed files are handled by the synclog.
+        if not value or value.get('deleted'):
+          continue
 
-    except DocumentException, e:
-      raise KeyError(e.message)
+        try:
+          if self._localRevisions.get(row['key'])[0] != value['rev']:
+            stale.append(row['key'])
+        except KeyError, e:
+          pass
+
+      if not stale:
+        continue
+
+      for row in database.view('_all_docs', keys=stale, include_docs=True):
+        doc = row.get('doc')
+
+        if doc:
+          outdated.append(posixpath.join(doc['dirpath'], doc['filename']))
 
-    finally:
-      self._cachedRevisions.release()
+    return outdated
 
   def cachedFileOpWrapper(self, couchedfs, function, *args, **kws):
     '''
@@ -232,6 +366,8 @@ class FileSystemOverlay(tsumufs.Debuggable):
       for doc in documents:
         self.setCachedRevision(doc.id, doc.rev, doc.stats.st_mtime)
 
+      self._noteMetadataWrite()
+
   def __getitem__(self, fusepath):
     '''
     Accessor to get SyncDocument instance referenced
@@ -266,6 +402,14 @@ class FileSystemOverlay(tsumufs.Debuggable):
       member = getattr(couchedfs, attr)
       op = getattr(member, "op", "read")
 
+      # Serve the stats and the listings from the local mirror if it is
+      # current, and from CouchDB otherwise.
+      if couchedfs is self._couchedLocal and attr in self._mirroredCalls:
+        try:
+          return self._readMirror(attr, *args)
+        except KeyError, e:
+          pass
+
       # Return a CouchedFile object, and caching its document
       if attr in ('open'):
         path = args[0]
@@ -279,6 +423,7 @@ class FileSystemOverlay(tsumufs.Debuggable):
           self.setCachedRevision(couchedfile.document.id,
                                  couchedfile.document.rev,
                                  couchedfile.document.stats.st_mtime)
+          self._noteMetadataWrite()
 
         # Override the close method to be able to cache
         # the updated document if the file has been modified.
@@ -291,7 +436,10 @@ class FileSystemOverlay(tsumufs.Debuggable):
 
       # Create/update some documents
       elif op in ('update', 'create'):
-        updated = member(*args, **kws)
+        try:
+          updated = member(*args, **kws)
+        finally:
+          self._noteMetadataWrite()
 
         rename = False
         for doc in updated:
@@ -301,9 +449,15 @@ class FileSystemOverlay(tsumufs.Debuggable):
 
         return updated
 
-      else:
+      elif attr in self._readCalls:
         return member(*args, **kws)
 
+      else:
+        try:
+          return member(*args, **kws)
+        finally:
+          self._noteMetadataWrite()
+
     if hasattr(self._couchedLocal, attr) and \
          type(getattr(self._couchedLocal, attr)) == new.instancemethod:
       return cachedSysCallWrapper
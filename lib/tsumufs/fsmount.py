@@ -20,11 +20,13 @@ import os
 import errno
 import sys
 import stat
+import time
 import thread
 import threading
 import dataregion
 
 import tsumufs
+from extendedattributes import extendedattribute
 
 
 class FSMountError(Exception):
@@ -40,10 +42,67 @@ class FSMount(tsumufs.Debuggable):
   '''
 
   _fileLocks = {}
+  _transfers = threading.local()
 
   def __init__(self):
     pass
 
+  def open(self, filename, *args, **kwargs):
+    '''
+    Open a file of the fs mount. Reads and writes on the file object returned
+    are limited by the download and upload rates.
+    '''
+
+    fp = super(FSMount, self).open(filename, *args, **kwargs)
+
+    # Copies are already shaped and measured on their source.
+    if getattr(self._transfers, 'copying', False):
+      return fp
+
+    return tsumufs.ThrottledFile(tsumufs.MeteredFile(fp, tsumufs.linkEstimator),
+                                 tsumufs.downloadBucket, tsumufs.uploadBucket)
+
+  def copy(self, source, *args, **kwargs):
+    '''
+    Copy the content of the file object source to a file of the fs mount,
+    at the upload rate.
+    '''
+
+    source = tsumufs.ThrottledFile(source, tsumufs.uploadBucket)
+    start = time.time()
+
+    self._transfers.copying = True
+
+    try:
+      result = super(FSMount, self).copy(source, *args, **kwargs)
+    finally:
+      self._transfers.copying = False
+
+    try:
+      tsumufs.linkEstimator.noteTransfer(source.tell(), time.time() - start)
+    except (AttributeError, IOError):
+      pass
+
+    return result
+
+  def lstat(self, filename, *args, **kwargs):
+    '''
+    Stat a file of the fs mount, accounting for the round trip in the link
+    estimator.
+    '''
+
+    start = time.time()
+
+    try:
+      result = super(FSMount, self).lstat(filename, *args, **kwargs)
+    except OSError, e:
+      if e.errno == errno.ENOENT:
+        tsumufs.linkEstimator.noteLatency(time.time() - start)
+      raise
+
+    tsumufs.linkEstimator.noteLatency(time.time() - start)
+    return result
+
   def lockFile(self, filename):
     '''
     Method to lock a file. Blocks if the file is already locked.
@@ -168,9 +227,9 @@ class FSMount(tsumufs.Debuggable):
 
       try:
         try:
-            fp = self.open(filename, os.O_APPEND | os.O_BINARY)
+            fp = self.open(filename, os.O_WRONLY | os.O_BINARY)
         except AttributeError, e:
-            fp = self.open(filename, os.O_APPEND)
+            fp = self.open(filename, os.O_WRONLY)
 
         fp.seek(start)
         fp.write(data)
@@ -219,6 +278,56 @@ class FSMount(tsumufs.Debuggable):
     finally:
       self.unlockFile(fusepath)
 
+  def rmtree(self, fusepath):
+    '''
+    Remove the directory fusepath from the file system mount, along with
+    its whole subtree, in a single pass.
+
+    Raises:
+      FSMountError: An error occurred during an file system call.
+      OSError: Usually relating to permissions on the files.
+    '''
+
+    fspath = tsumufs.fsPathOf(fusepath)
+
+    def onerror(e):
+      raise e
+
+    try:
+      self.lockFile(fusepath)
+
+      try:
+        for dirpath, dirnames, filenames in os.walk(fspath, topdown=False,
+                                                    onerror=onerror):
+          dirfusepath = fusepath + dirpath[len(fspath):]
+
+          for filename in filenames:
+            self.unlink(os.path.join(dirfusepath, filename))
+
+          # Symlinks to directories are listed along with the directories.
+          for dirname in dirnames:
+            if os.path.islink(os.path.join(dirpath, dirname)):
+              self.unlink(os.path.join(dirfusepath, dirname))
+            else:
+              self.rmdir(os.path.join(dirfusepath, dirname))
+
+        self.rmdir(fusepath)
+
+      except OSError, e:
+        if e.errno in (errno.EIO, errno.ESTALE):
+          self._debug('Got %s while removing the tree %s.' %
+                      (str(e), fusepath))
+          self._debug('Triggering a disconnect.')
+
+          tsumufs.fsAvailable.clear()
+
+          raise tsumufs.FSMountError()
+        else:
+          raise
+
+    finally:
+      self.unlockFile(fusepath)
+
   def mount(self):
     '''
     Quick and dirty method to actually mount the real file system connection
@@ -305,3 +414,26 @@ class FSMount(tsumufs.Debuggable):
       self._debug('Unmount of file system succeeded.')
       return True
 
+
+def _xattrRate(name, bucket, value):
+  try:
+    if value != None:
+      rate = int(value)
+      if rate < 0:
+        return -errno.EOPNOTSUPP
+
+      setattr(tsumufs, name, rate)
+      bucket.setRate(rate * 1024)
+      return
+
+    return str(getattr(tsumufs, name))
+  except:
+    return -errno.EOPNOTSUPP
+
+@extendedattribute('root', 'tsumufs.upload-rate')
+def xattr_uploadRate(type_, path, value=None):
+  return _xattrRate('uploadRate', tsumufs.uploadBucket, value)
+
+@extendedattribute('root', 'tsumufs.download-rate')
+def xattr_downloadRate(type_, path, value=None):
+  return _xattrRate('downloadRate', tsumufs.downloadBucket, value)
@@ -45,8 +45,13 @@ class FuseFile(tsumufs.Debuggable):
   _gid       = None
   _pid       = None
 
-  _isNewFile    = False
-  _isSyncPauser = False
+  _isNewFile  = False
+  _openHandle = None            # The handle of the file in the
+                                # openFileRegistry, if opened for writing.
+
+  # Caching hints read by fuse-python once the file has been opened.
+  keep_cache = False
+  direct_io  = False
 
   @benchmark
   def __init__(self, path, flags, mode=None, uid=None, gid=None, pid=None):
@@ -90,12 +95,6 @@ class FuseFile(tsumufs.Debuggable):
     if self._fdFlags & (os.O_CREAT | os.O_RDWR |os.O_WRONLY | os.O_TRUNC | os.O_APPEND):
       access_mode |= os.W_OK
 
-      # Pause the synchronization thread while this thread
-      # is copying the file to the cache to preserve performance.
-      if not tsumufs.syncPause.isSet():
-        self._isSyncPauser = True
-        tsumufs.syncPause.set()
-
     if self._fdFlags & os.O_RDONLY:
       access_mode |= os.R_OK
 
@@ -108,8 +107,19 @@ class FuseFile(tsumufs.Debuggable):
       self._manager.access(self._uid, self._path, access_mode)
 
     self._debug('Calling fakeopen')
-    self._manager.fakeOpen(self._path, self._fdFlags, self._fdMode,
-                           self._uid, self._gid)
+    opcodes = self._manager.fakeOpen(self._path, self._fdFlags, self._fdMode,
+                                     self._uid, self._gid)
+
+    # Files read through from the fs mount bypass the kernel page cache, while
+    # cached files keep it as long as their cached revision did not change
+    # since the last open.
+    if 'use-fs' in opcodes:
+      self.direct_io = True
+    elif not self._fdFlags & os.O_TRUNC:
+      self.keep_cache = self._manager.keepPageCache(self._path)
+
+    self._debug('keep_cache: %s | direct_io: %s'
+                % (self.keep_cache, self.direct_io))
 
     if self._fdFlags & os.O_CREAT:
       self._debug('Adding a new change to the log as it\'s a new file')
@@ -120,6 +130,10 @@ class FuseFile(tsumufs.Debuggable):
     if self._fdFlags & os.O_TRUNC:
       self.ftruncate(0)
 
+    # Keep the sync thread away from the file until it is released.
+    if access_mode & os.W_OK:
+      self._openHandle = tsumufs.openFileRegistry.open(self._path)
+
     # Rip out any O_TRUNC options after we do the initial open -- O_TRUNC is
     # dangerous to do in this case, because if we get multiple write calls, we
     # just pass in the _fdMode raw, which causes multiple O_TRUNC calls to the
@@ -166,74 +180,92 @@ class FuseFile(tsumufs.Debuggable):
     self._debug('opcode: write | path: %s | offset: %d | buf: %s'
                 % (self._path, offset, repr(new_data)))
 
-    # Three cases here:
-    #   - The file didn't exist prior to our write.
-    #   - The file existed, but was extended.
-    #   - The file existed, and an existing block was overwritten.
-
-    fspath = tsumufs.fsPathOf(self._path)
-    statgoo = self._manager.statFile(self._path)
-
-    if not self._isNewFile:
-      self._debug('Reading offset %d, length %d from %s.'
-                  % (offset, len(new_data), self._path))
-      old_data = self._manager.readFile(self._path,
-                                        offset,
-                                        len(new_data),
-                                        os.O_RDONLY)
-      self._debug('From cacheManager.readFile got %s' % repr(old_data))
-
-      # Pad missing chunks on the old_data stream with NULLs, as fs
-      # would. Unfortunately during resyncing, we'll have to consider regions
-      # past the end of a file to be NULLs as well. This allows us to merge data
-      # regions cleanly without rehacking the model.
-
-      if len(old_data) < len(new_data):
-        self._debug(('New data is past end of file by %d bytes. '
-                     'Padding with nulls.')
-                    % (len(new_data) - len(old_data)))
-        old_data += '\x00' * (len(new_data) - len(old_data))
-
-    else:
-      self._debug('We\'re a new file -- not adding a change record to log.')
+    # Keep the file locked until the change is logged, so that the sync
+    # thread does not snapshot the file in between.
+    self._manager.lockFile(self._path)
 
     try:
-      if self._manager.writeFile(self._path, offset, new_data,
-                                 self._fdFlags, self._fdMode):
-        if not self._isNewFile:
-          self._debug('Adding change to synclog [ %s | %d | %d | %s ]'
-                % (self._path, offset, offset+len(new_data), repr(old_data)))
+      # Three cases here:
+      #   - The file didn't exist prior to our write.
+      #   - The file existed, but was extended.
+      #   - The file existed, and an existing block was overwritten.
+
+      fspath = tsumufs.fsPathOf(self._path)
+      statgoo = self._manager.statFile(self._path)
 
-          tsumufs.syncLog.addChange(self._path,
-                                    offset,
-                                    offset+len(new_data),
-                                    old_data)
+      # Once the sync thread started to propagate the new file, the following
+      # writes are logged as changes.
+      if self._isNewFile and tsumufs.syncLog.isSyncing(self._path):
+        self._isNewFile = False
+
+      if not self._isNewFile:
+        self._debug('Reading offset %d, length %d from %s.'
+                    % (offset, len(new_data), self._path))
+        old_data = self._manager.readFile(self._path,
+                                          offset,
+                                          len(new_data),
+                                          os.O_RDONLY)
+        self._debug('From cacheManager.readFile got %s' % repr(old_data))
+
+        # Pad missing chunks on the old_data stream with NULLs, as fs
+        # would. Unfortunately during resyncing, we'll have to consider regions
+        # past the end of a file to be NULLs as well. This allows us to merge data
+        # regions cleanly without rehacking the model.
+
+        if len(old_data) < len(new_data):
+          self._debug(('New data is past end of file by %d bytes. '
+                       'Padding with nulls.')
+                      % (len(new_data) - len(old_data)))
+          old_data += '\x00' * (len(new_data) - len(old_data))
+
+      else:
+        self._debug('We\'re a new file -- not adding a change record to log.')
+
+      try:
+        if self._manager.writeFile(self._path, offset, new_data,
+                                   self._fdFlags, self._fdMode):
+          if not self._isNewFile:
+            self._debug('Adding change to synclog [ %s | %d | %d | %s ]'
+                  % (self._path, offset, offset+len(new_data), repr(old_data)))
 
-      self._debug('Wrote %d bytes to cache.' % len(new_data))
+            tsumufs.syncLog.addChange(self._path,
+                                      offset,
+                                      offset+len(new_data),
+                                      old_data)
 
-      return len(new_data)
+          tsumufs.settleTracker.noteWrite(self._path)
 
-    except OSError, e:
-      self._debug('OSError caught: errno %d: %s'
-                  % (e.errno, e.strerror))
-      return -e.errno
+        self._debug('Wrote %d bytes to cache.' % len(new_data))
 
-    except IOError, e:
-      self._debug('IOError caught: %s' % str(e))
+        return len(new_data)
 
-      # TODO(jtg): Make this stop the fs Mount condition on error, rather than
-      # raising errno.
-      return -e.errno
+      except OSError, e:
+        self._debug('OSError caught: errno %d: %s'
+                    % (e.errno, e.strerror))
+        return -e.errno
+
+      except IOError, e:
+        self._debug('IOError caught: %s' % str(e))
+
+        # TODO(jtg): Make this stop the fs Mount condition on error, rather than
+        # raising errno.
+        return -e.errno
+
+    finally:
+      self._manager.unlockFile(self._path)
 
   @benchmark
   def release(self, flags):
     self._debug('opcode: release | flags: %s' % self._flagsToString(flags))
 
     try:
-        self._manager.releaseFile(self._path, flags)
+        try:
+            self._manager.releaseFile(self._path, flags)
 
-        if self._isSyncPauser:
-            tsumufs.syncPause.clear()
+        finally:
+            if self._openHandle is not None:
+                tsumufs.openFileRegistry.release(self._openHandle)
+                self._openHandle = None
 
     except Exception, e:
         exc_info = sys.exc_info()
@@ -253,6 +285,30 @@ class FuseFile(tsumufs.Debuggable):
     self._debug('opcode: fsync | path: %s | isfsyncfile: %d'
                 % (self._path, isfsyncfile))
 
+    try:
+      self._manager.syncFile(self._path, datasync=isfsyncfile)
+
+    except OSError, e:
+      self._debug('OSError caught: errno %d: %s'
+                  % (e.errno, e.strerror))
+      return -e.errno
+
+    # Commit the synclog entries of the writes, along with the ones of every
+    # other file fsynced meanwhile.
+    if tsumufs.checkpointThread is not None:
+      committed = tsumufs.checkpointThread.requestCheckpoint(wait=True)
+
+    else:
+      try:
+        tsumufs.syncLog.checkpoint()
+        committed = True
+      except Exception, e:
+        committed = False
+
+    if not committed:
+      self._debug('Unable to commit the synclog, returning EIO.')
+      return -errno.EIO
+
     self._debug('Returning 0')
     return 0
 
@@ -281,6 +337,9 @@ class FuseFile(tsumufs.Debuggable):
     try:
       statgoo = self._manager.statFile(self._path)
 
+      if self._isNewFile and tsumufs.syncLog.isSyncing(self._path):
+        self._isNewFile = False
+
       if size != statgoo.st_size:
         # Truncate the file...
         if self._manager.truncateFile(self._path, size):
@@ -295,6 +354,8 @@ class FuseFile(tsumufs.Debuggable):
               tsumufs.syncLog.addChange(self._path, statgoo.st_size, size,
                                         '\x00' * (size - statgoo.st_size))
 
+          tsumufs.settleTracker.noteWrite(self._path)
+
       return 0
 
     except OSError, e:
@@ -25,6 +25,8 @@ import statvfs
 import time
 import traceback
 import getpass
+import threading
+import itertools
 
 import fuse
 from fuse import Fuse
@@ -55,6 +57,15 @@ class FuseThread(tsumufs.Debuggable, Fuse):
   design docs.
   '''
 
+  _listings = {}            # A hash of the ids of the directory listings in
+                            # progress to the path, the time of the last read
+                            # and the entries of their snapshot.
+
+  _listingsLock   = threading.Lock()
+  _listingIds     = itertools.count()
+  _listingTimeout = 60      # Number of seconds after which an unfinished
+                            # listing not read anymore is dropped.
+
   def __init__(self, *args, **kw):
     '''
     Initializer. Prepares the object for initial use.
@@ -195,6 +206,8 @@ class FuseThread(tsumufs.Debuggable, Fuse):
     self._debug('Initializing sync thread.')
     try:
       self._syncThread = tsumufs.SyncThread()
+      tsumufs.checkpointThread = tsumufs.CheckpointThread()
+      tsumufs.cacheRefresher = tsumufs.CacheRefresher()
     except:
       # TODO(jtg): Same as above... We should really fix this.
       exc_info = sys.exc_info()
@@ -209,10 +222,22 @@ class FuseThread(tsumufs.Debuggable, Fuse):
 
       return False
 
+    self._debug('Loading the working set.')
+    tsumufs.workingSet.load(tsumufs.workingSetPath)
+
     # Start the threads
     self._debug('Starting sync thread.')
     self._syncThread.start()
 
+    self._debug('Starting checkpoint thread.')
+    tsumufs.checkpointThread.start()
+
+    self._debug('Starting cache refresher.')
+    tsumufs.cacheRefresher.start()
+
+    self._debug('Starting metadata bridge.')
+    tsumufs.fsOverlay.startMetadataBridge()
+
     self._debug('fsinit complete.')
     return True
 
@@ -279,6 +304,9 @@ class FuseThread(tsumufs.Debuggable, Fuse):
       self._debug('Waiting for the sync thread to finish.')
       self._syncThread.join()
 
+      self._debug('Waiting for the last checkpoint.')
+      tsumufs.checkpointThread.join()
+
       self._debug('Shutdown complete.')
       self._debug("---BEGIN-GEN-BENCHMARK-REPORT---")
 
@@ -373,6 +401,12 @@ class FuseThread(tsumufs.Debuggable, Fuse):
                            default='tsumufs',
                            help=('Set the database name for fs metadatas'
                                  '[default: tsumufs]'))
+    self.parser.add_option(mountopt='metadatastore',
+                           dest='metadataStore',
+                           default='sqlite',
+                           help=('Set the backend of the client-private '
+                                 'metadata, sqlite or couchdb '
+                                 '[default: %default]'))
     self.parser.add_option(mountopt='dbremote',
                            dest='dbRemote',
                            default=None,
@@ -400,6 +434,46 @@ class FuseThread(tsumufs.Debuggable, Fuse):
                            dest='fsName',
                            default='TsumuFS',
                            help=('Set the name of the fuse filesystem'))
+    self.parser.add_option(mountopt='attrtimeout',
+                           dest='attrTimeout',
+                           default=1.0,
+                           help=('Set the number of seconds the kernel caches '
+                                 'file attributes [default: %default]'))
+    self.parser.add_option(mountopt='entrytimeout',
+                           dest='entryTimeout',
+                           default=1.0,
+                           help=('Set the number of seconds the kernel caches '
+                                 'name lookups [default: %default]'))
+    self.parser.add_option(mountopt='settletime',
+                           dest='settleTime',
+                           default=5.0,
+                           help=('Set the number of seconds a file must not '
+                                 'be written before being synced '
+                                 '[default: %default]'))
+    self.parser.add_option(mountopt='uploadrate',
+                           dest='uploadRate',
+                           default=0,
+                           help=('Limit the rate of the data sent to the fs '
+                                 'mount, in KiB/s, 0 for unlimited '
+                                 '[default: %default]'))
+    self.parser.add_option(mountopt='refreshconcurrency',
+                           dest='refreshConcurrency',
+                           default=2,
+                           help=('Set the number of outdated cached files '
+                                 'refreshed at once in the background '
+                                 '[default: %default]'))
+    self.parser.add_option(mountopt='prefetchcount',
+                           dest='prefetchCount',
+                           default=100,
+                           help=('Set the number of the most used files '
+                                 'prefetched at mount time, 0 to disable '
+                                 '[default: %default]'))
+    self.parser.add_option(mountopt='downloadrate',
+                           dest='downloadRate',
+                           default=0,
+                           help=('Limit the rate of the data read from the fs '
+                                 'mount, in KiB/s, 0 for unlimited '
+                                 '[default: %default]'))
 
     self.parser.add_option('-S',
                            dest='mountSource',
@@ -497,6 +571,22 @@ class FuseThread(tsumufs.Debuggable, Fuse):
     # Shove the proper mountPoint into FUSE's mouth.
     self.fuse_args.mountpoint = tsumufs.mountPoint
 
+    # Let the kernel cache attributes and lookups for the requested time.
+    tsumufs.attrTimeout = float(tsumufs.attrTimeout)
+    tsumufs.entryTimeout = float(tsumufs.entryTimeout)
+    self.fuse_args.add('attr_timeout=%s' % tsumufs.attrTimeout)
+    self.fuse_args.add('entry_timeout=%s' % tsumufs.entryTimeout)
+
+    tsumufs.settleTime = float(tsumufs.settleTime)
+    tsumufs.refreshConcurrency = max(1, int(tsumufs.refreshConcurrency))
+    tsumufs.prefetchCount = max(0, int(tsumufs.prefetchCount))
+
+    # Shape the transfers with the fs mount.
+    tsumufs.uploadRate = int(tsumufs.uploadRate)
+    tsumufs.downloadRate = int(tsumufs.downloadRate)
+    tsumufs.uploadBucket.setRate(tsumufs.uploadRate * 1024)
+    tsumufs.downloadBucket.setRate(tsumufs.downloadRate * 1024)
+
     # Finally, calculate the runtime paths if they weren't specified already.
     if tsumufs.fsMountPoint == None:
       tsumufs.fsMountPoint = os.path.join(tsumufs.fsBaseDir,
@@ -506,6 +596,22 @@ class FuseThread(tsumufs.Debuggable, Fuse):
       tsumufs.cachePoint = os.path.join(tsumufs.cacheBaseDir,
                                         tsumufs.mountPoint.replace(':' + os.sep, '').replace(os.sep, '-'))
 
+    # Snapshots of the cached files have to be on the same filesystem.
+    if tsumufs.snapshotDir == None:
+      tsumufs.snapshotDir = os.path.normpath(tsumufs.cachePoint) + '.snapshots'
+
+    if tsumufs.signatureDir == None:
+      tsumufs.signatureDir = os.path.normpath(tsumufs.cachePoint) + '.signatures'
+
+    if tsumufs.metadataPath == None:
+      tsumufs.metadataPath = os.path.normpath(tsumufs.cachePoint) + '.metadata'
+
+    if tsumufs.documentsPath == None:
+      tsumufs.documentsPath = os.path.normpath(tsumufs.cachePoint) + '.documents'
+
+    if tsumufs.workingSetPath == None:
+      tsumufs.workingSetPath = os.path.normpath(tsumufs.cachePoint) + '.workingset'
+
     # Available on Windows(pywinfuse), MacOsX (macfuse)
     self.fsname = tsumufs.fsName
 
@@ -517,14 +623,27 @@ class FuseThread(tsumufs.Debuggable, Fuse):
     self._debug('fsMountCmd is %s' % tsumufs.fsMountCmd)
     self._debug('cacheBaseDir is %s' % tsumufs.cacheBaseDir)
     self._debug('cachePoint is %s' % tsumufs.cachePoint)
+    self._debug('snapshotDir is %s' % tsumufs.snapshotDir)
+    self._debug('signatureDir is %s' % tsumufs.signatureDir)
     self._debug('dbName is %s' % tsumufs.dbName)
     self._debug('dbRemote is %s' % tsumufs.dbRemote)
+    self._debug('metadataStore is %s' % tsumufs.metadataStore)
+    self._debug('metadataPath is %s' % tsumufs.metadataPath)
+    self._debug('documentsPath is %s' % tsumufs.documentsPath)
     self._debug('auth is %s' % tsumufs.auth)
     self._debug('viewsPoint is %s' % tsumufs.viewsPoint)
     self._debug('rootMode is %d' % tsumufs.rootMode)
     self._debug('rootUID is %d' % tsumufs.rootUID)
     self._debug('rootGID is %d' % tsumufs.rootGID)
     self._debug('mountOptions is %s' % tsumufs.mountOptions)
+    self._debug('attrTimeout is %s' % tsumufs.attrTimeout)
+    self._debug('entryTimeout is %s' % tsumufs.entryTimeout)
+    self._debug('settleTime is %s' % tsumufs.settleTime)
+    self._debug('uploadRate is %s' % tsumufs.uploadRate)
+    self._debug('downloadRate is %s' % tsumufs.downloadRate)
+    self._debug('refreshConcurrency is %s' % tsumufs.refreshConcurrency)
+    self._debug('prefetchCount is %s' % tsumufs.prefetchCount)
+    self._debug('workingSetPath is %s' % tsumufs.workingSetPath)
 
     if tsumufs.auth == "webauth":
         if tsumufs.cookie:
@@ -801,6 +920,13 @@ class FuseThread(tsumufs.Debuggable, Fuse):
     Generator callback that returns a fuse.Direntry object every time
     it is called. Similar to the C readdir() call.
 
+    The entries are read from a snapshot of the directory taken by the first
+    call, so that the following calls resume the listing at the offset
+    reached by the kernel. The offset of an entry holds the id of the
+    snapshot in its upper half and the index of the next entry in its lower
+    half. The snapshot is dropped by the call past its last entry, or once
+    it times out.
+
     Returns:
       A generator that yields a fuse.Direntry object, or an errno
       code on error.
@@ -809,33 +935,106 @@ class FuseThread(tsumufs.Debuggable, Fuse):
     self._debug('opcode: readdir | path: %s | offset: %d' % (path, offset))
 
     try:
-      for filename in [ '.', '..' ]:
-        dirent = fuse.Direntry(filename)
-        dirent.type = stat.S_IFDIR
-        dirent.offset = offset
+      start = offset & 0xffffffff
+      listing = self._getListing(path, offset >> 32, create=(start == 0))
 
-        yield dirent
+      if listing is None:
+        # The snapshot expired, resuming the listing in a new one would skip
+        # or repeat entries.
+        self._debug('readdir: Listing of %s at offset %d is gone.'
+                    % (path, offset))
+        return
+
+      listing, entries = listing
 
-      dociterators = [ tsumufs.getManager(path).getDirents(path) ]
+      if start >= len(entries):
+        # The listing is complete, the kernel does not come back for it.
+        self._dropListing(listing)
+        return
 
-      if path == tsumufs.viewsPoint:
-        # Append the root directories of views
-        dociterators.append(tsumufs.viewsManager.getRootDirs())
+      for index in xrange(start, len(entries)):
+        filename, type_ = entries[index]
 
-      for dociterator in dociterators:
-        for doc in dociterator:
-          dirent        = fuse.Direntry(str(doc.filename))
-          dirent.type   = stat.S_IFMT(doc.mode)
-          dirent.offset = offset
+        dirent        = fuse.Direntry(filename)
+        dirent.type   = type_
+        dirent.offset = (listing << 32) | (index + 1)
 
-          yield dirent
+        yield dirent
 
     except OSError, e:
       self._debug('readdir: Caught OSError on %s: errno %d: %s'
-                  % (filename, e.errno, e.strerror))
+                  % (path, e.errno, e.strerror))
 
       yield -e.errno
 
+  def _getListing(self, path, listing, create=True):
+    '''
+    Return the id and the entries of the snapshot listing of path. A new
+    snapshot is taken if it does not exist anymore and create is set.
+
+    Returns:
+      A tuple (listing, entries), entries being a list of (filename, type)
+      tuples, or None.
+
+    Raises:
+      OSError
+    '''
+
+    self._listingsLock.acquire()
+
+    try:
+      now = time.time()
+
+      for id_, (dirpath, stamp, entries) in self._listings.items():
+        if now - stamp > self._listingTimeout:
+          del self._listings[id_]
+
+      if self._listings.has_key(listing):
+        dirpath, stamp, entries = self._listings[listing]
+
+        if dirpath == path:
+          # The listing is still being read, keep it until it times out.
+          self._listings[listing] = (dirpath, now, entries)
+          return listing, entries
+
+    finally:
+      self._listingsLock.release()
+
+    if not create:
+      return None
+
+    entries = [ ('.', stat.S_IFDIR), ('..', stat.S_IFDIR) ]
+
+    dociterators = [ tsumufs.getManager(path).getDirents(path) ]
+
+    if path == tsumufs.viewsPoint:
+      # Append the root directories of views
+      dociterators.append(tsumufs.viewsManager.getRootDirs())
+
+    for dociterator in dociterators:
+      for doc in dociterator:
+        entries.append((str(doc.filename), stat.S_IFMT(doc.mode)))
+
+    self._listingsLock.acquire()
+
+    try:
+      listing = self._listingIds.next() % 0x7fffffff + 1
+      self._listings[listing] = (path, time.time(), entries)
+
+    finally:
+      self._listingsLock.release()
+
+    return listing, entries
+
+  def _dropListing(self, listing):
+    self._listingsLock.acquire()
+
+    try:
+      self._listings.pop(listing, None)
+
+    finally:
+      self._listingsLock.release()
+
   @benchmark
   def unlink(self, path):
     '''
@@ -853,8 +1052,10 @@ class FuseThread(tsumufs.Debuggable, Fuse):
                                                        os.path.dirname(path),
                                                        os.W_OK)
 
+      fileid = tsumufs.syncLog.fileIdOf(path)
+
       if tsumufs.getManager(path).removeCachedFile(path, removeperm=True):
-        tsumufs.syncLog.addUnlink(path, 'file')
+        tsumufs.syncLog.addUnlink(path, 'file', fileid=fileid)
 
       return 0
 
@@ -891,8 +1092,10 @@ class FuseThread(tsumufs.Debuggable, Fuse):
       context = self.GetContext()
       tsumufs.getManager(path).access(context['uid'], path, os.W_OK)
 
+      fileid = tsumufs.syncLog.fileIdOf(path)
+
       if tsumufs.getManager(path).removeCachedFile(path, removeperm=True):
-        tsumufs.syncLog.addUnlink(path, 'dir')
+        tsumufs.syncLog.addUnlink(path, 'dir', fileid=fileid)
 
       return 0
     except OSError, e:
@@ -971,7 +1174,27 @@ class FuseThread(tsumufs.Debuggable, Fuse):
       if tsumufs.viewsManager.isAnyViewPath(old):
         old = tsumufs.viewsManager.realFilePath(old)
 
+      # The file replaced by the rename, if any, is unlinked first, so that
+      # the synclog compaction knows the destination did exist. The unlink is
+      # kept from following the new file renamed over it by addRename.
+      replaced = None
+
+      if new != old:
+        try:
+          document = tsumufs.fsOverlay[new]
+
+          if stat.S_ISDIR(document.mode):
+            replaced = ('dir', document.id)
+          else:
+            replaced = ('file', document.id)
+
+        except (OSError, KeyError, tsumufs.DocumentException), e:
+          pass
+
       if tsumufs.getManager(new).rename(old, new):
+        if replaced:
+          tsumufs.syncLog.addUnlink(new, replaced[0], fileid=replaced[1])
+
         tsumufs.syncLog.addRename(old, new)
 
       return 0
@@ -0,0 +1,185 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import time
+import errno
+import threading
+
+import tsumufs
+from extendedattributes import extendedattribute
+
+
+def _powerOfTwo(value, minimum, maximum):
+  result = minimum
+  while result < value and result < maximum:
+    result *= 2
+
+  return result
+
+
+class LinkEstimator(tsumufs.Debuggable):
+  '''
+  Estimate the latency and the throughput of the link to the fs mount from
+  the operations made on it, as exponentially weighted moving averages.
+
+  The transfer parameters derive from the estimates: chunks are sized so
+  that each one takes about _chunkTime to transfer, and enough chunks are
+  kept in flight to cover the bandwidth-delay product of the link.
+  '''
+
+  alpha = 0.2                   # Weight of the new samples.
+
+  rtt        = None             # In seconds.
+  throughput = None             # In bytes per second.
+
+  _minSample      = 16 * 1024   # Smaller transfers only measure the latency.
+  _chunkTime      = 0.1         # Target duration of the transfer of a chunk.
+
+  _minChunkSize   = 16 * 1024
+  _maxChunkSize   = 4 * 1024 * 1024
+  _defaultChunkSize = 64 * 1024
+
+  _minConcurrency   = 2
+  _maxConcurrency   = 4
+  _maxPrefetchDepth = 16
+
+  def __init__(self):
+    self._lock = threading.Lock()
+
+  def _average(self, current, sample):
+    if current is None:
+      return sample
+
+    return (1 - self.alpha) * current + self.alpha * sample
+
+  def noteLatency(self, seconds):
+    '''
+    Account for the duration of a round trip to the fs mount.
+    '''
+
+    self._lock.acquire()
+    try:
+      self.rtt = self._average(self.rtt, seconds)
+    finally:
+      self._lock.release()
+
+  def noteTransfer(self, size, seconds):
+    '''
+    Account for the transfer of size bytes in the given duration.
+    '''
+
+    if size < self._minSample or seconds <= 0:
+      self.noteLatency(seconds)
+      return
+
+    self._lock.acquire()
+    try:
+      self.throughput = self._average(self.throughput, size / seconds)
+    finally:
+      self._lock.release()
+
+  def chunkSize(self):
+    '''
+    Return the size of the chunks of data to transfer at once.
+    '''
+
+    if not self.throughput:
+      return self._defaultChunkSize
+
+    return _powerOfTwo(self.throughput * self._chunkTime,
+                       self._minChunkSize, self._maxChunkSize)
+
+  def _chunksInFlight(self):
+    if not self.throughput or not self.rtt:
+      return 1
+
+    return 1 + int(self.throughput * self.rtt / self.chunkSize())
+
+  def concurrency(self):
+    '''
+    Return the number of transfers to run in parallel.
+    '''
+
+    return max(self._minConcurrency,
+               min(self._chunksInFlight(), self._maxConcurrency))
+
+  def prefetchDepth(self):
+    '''
+    Return the number of chunks to read ahead of the current position.
+    '''
+
+    return min(self._chunksInFlight(), self._maxPrefetchDepth)
+
+  def __str__(self):
+    if self.rtt is None:
+      rtt = 'unknown'
+    else:
+      rtt = '%.1fms' % (self.rtt * 1000)
+
+    if self.throughput is None:
+      throughput = 'unknown'
+    else:
+      throughput = '%.1fKiB/s' % (self.throughput / 1024)
+
+    return ('rtt: %s, throughput: %s, chunk size: %d, concurrency: %d, '
+            'prefetch depth: %d'
+            % (rtt, throughput, self.chunkSize(), self.concurrency(),
+               self.prefetchDepth()))
+
+
+class MeteredFile(object):
+  '''
+  File object proxy accounting the reads and writes of a file of the fs
+  mount in the link estimator.
+  '''
+
+  def __init__(self, fp, estimator):
+    self._fp = fp
+    self._estimator = estimator
+
+  def __getattr__(self, name):
+    return getattr(self._fp, name)
+
+  def __iter__(self):
+    return iter(self.readline, '')
+
+  def read(self, *args):
+    start = time.time()
+    data = self._fp.read(*args)
+
+    if data:
+      self._estimator.noteTransfer(len(data), time.time() - start)
+
+    return data
+
+  def write(self, data):
+    start = time.time()
+    result = self._fp.write(data)
+
+    if data:
+      self._estimator.noteTransfer(len(data), time.time() - start)
+
+    return result
+
+
+@extendedattribute('root', 'tsumufs.link-estimate')
+def xattr_linkEstimate(type_, path, value=None):
+  if value != None:
+    return -errno.EOPNOTSUPP
+
+  return str(tsumufs.linkEstimator)
@@ -0,0 +1,341 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import threading
+
+try:
+  import sqlite3
+except ImportError:
+  from pysqlite2 import dbapi2 as sqlite3
+
+try:
+  import json
+except ImportError:
+  import simplejson as json
+
+import tsumufs
+
+
+def _text(value):
+  if isinstance(value, str):
+    return value.decode('utf-8')
+
+  return value
+
+
+class SQLiteStore(tsumufs.Debuggable):
+  '''
+  Base class of the stores kept in an SQLite database in WAL mode next to
+  the cache point. The writes are batched in a transaction committed by
+  commit(), like the batched writes of the DocumentHelpers.
+  '''
+
+  def __init__(self, path):
+    self._lock = threading.Lock()
+    self._inTransaction = False
+
+    # Transactions are handled by hand, see _begin().
+    self._db = sqlite3.connect(path, check_same_thread=False,
+                               isolation_level=None)
+    self._db.execute('PRAGMA journal_mode=WAL')
+    self._db.execute('PRAGMA synchronous=NORMAL')
+    self._db.execute('CREATE TABLE IF NOT EXISTS meta ('
+                     '  key TEXT PRIMARY KEY,'
+                     '  value TEXT)')
+
+  def _begin(self):
+    if not self._inTransaction:
+      self._db.execute('BEGIN')
+      self._inTransaction = True
+
+  def _getMeta(self, key):
+    row = self._db.execute('SELECT value FROM meta WHERE key = ?',
+                           (key,)).fetchone()
+    if row is None:
+      return None
+
+    return row[0]
+
+  def _setMeta(self, key, value):
+    self._begin()
+    self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)',
+                     (key, value))
+
+  def commit(self):
+    '''
+    Commit the pending writes to disk.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      if self._inTransaction:
+        self._db.execute('COMMIT')
+        self._inTransaction = False
+
+    finally:
+      self._lock.release()
+
+  def close(self):
+    self.commit()
+    self._db.close()
+
+
+class SQLiteRevisionStore(SQLiteStore):
+  '''
+  Store of the revisions of the cached copies of the files.
+
+  The cached revisions are private to the client and never replicated, so
+  they do not need to go through CouchDB: lookups are in-process calls.
+  '''
+
+  def __init__(self, path):
+    SQLiteStore.__init__(self, path)
+
+    self._db.execute('CREATE TABLE IF NOT EXISTS cached_revisions ('
+                     '  fileid TEXT PRIMARY KEY,'
+                     '  revision TEXT,'
+                     '  mtime REAL)')
+
+  def isSeeded(self):
+    '''
+    Return whether the store has been filled with the cached revisions of a
+    previous mount. The marker is committed along with the revisions, so a
+    store left incomplete by a crash is seeded again.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      return self._getMeta('seeded') is not None
+
+    finally:
+      self._lock.release()
+
+  def markSeeded(self):
+    '''
+    Mark the store as seeded, once the next commit is done.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      self._setMeta('seeded', '1')
+
+    finally:
+      self._lock.release()
+
+  def get(self, fileid):
+    '''
+    Return the revision and the mtime of the cached copy of a file.
+
+    Returns:
+      A (revision, mtime) tuple.
+
+    Raises:
+      KeyError
+    '''
+
+    self._lock.acquire()
+
+    try:
+      row = self._db.execute('SELECT revision, mtime FROM cached_revisions '
+                             'WHERE fileid = ?', (fileid,)).fetchone()
+      if row is None:
+        raise KeyError(fileid)
+
+      return row[0], row[1]
+
+    finally:
+      self._lock.release()
+
+  def set(self, fileid, revision, mtime):
+    '''
+    Update or create the revision of the cached copy of a file.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      self._begin()
+      self._db.execute('INSERT OR REPLACE INTO cached_revisions '
+                       '(fileid, revision, mtime) VALUES (?, ?, ?)',
+                       (fileid, revision, mtime))
+
+    finally:
+      self._lock.release()
+
+  def remove(self, fileid):
+    '''
+    Remove the revision of the cached copy of a file.
+
+    Returns:
+      The (revision, mtime) tuple removed.
+
+    Raises:
+      KeyError
+    '''
+
+    self._lock.acquire()
+
+    try:
+      row = self._db.execute('SELECT revision, mtime FROM cached_revisions '
+                             'WHERE fileid = ?', (fileid,)).fetchone()
+      if row is None:
+        raise KeyError(fileid)
+
+      self._begin()
+      self._db.execute('DELETE FROM cached_revisions WHERE fileid = ?',
+                       (fileid,))
+
+      return row[0], row[1]
+
+    finally:
+      self._lock.release()
+
+  def items(self):
+    '''
+    Return the list of the (fileid, revision, mtime) tuples of the store.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      return self._db.execute('SELECT fileid, revision, mtime '
+                              'FROM cached_revisions').fetchall()
+
+    finally:
+      self._lock.release()
+
+
+class SQLiteDocumentStore(SQLiteStore):
+  '''
+  Local mirror of the SyncDocuments of the CouchDB database, kept up to date
+  by the MetadataBridge so that the metadata reads are in-process calls.
+
+  The documents are stored as they come from the changes feed, along with
+  the sequence number of the last change applied. Both are committed in the
+  same transaction, so the mirror resumes from a consistent point.
+  '''
+
+  def __init__(self, path):
+    SQLiteStore.__init__(self, path)
+
+    self._db.execute('CREATE TABLE IF NOT EXISTS documents ('
+                     '  id TEXT PRIMARY KEY,'
+                     '  dirpath TEXT,'
+                     '  filename TEXT,'
+                     '  data TEXT)')
+    self._db.execute('CREATE INDEX IF NOT EXISTS documents_by_path '
+                     'ON documents (dirpath, filename)')
+
+  def lastSeq(self):
+    '''
+    Return the sequence number of the last change applied to the mirror.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      return int(self._getMeta('seq') or 0)
+
+    finally:
+      self._lock.release()
+
+  def setLastSeq(self, seq):
+    self._lock.acquire()
+
+    try:
+      self._setMeta('seq', str(seq))
+
+    finally:
+      self._lock.release()
+
+  def get(self, dirpath, filename):
+    '''
+    Return the document of the file filename of the directory dirpath.
+
+    Returns:
+      The document, as a dict.
+
+    Raises:
+      KeyError
+    '''
+
+    self._lock.acquire()
+
+    try:
+      row = self._db.execute('SELECT data FROM documents '
+                             'WHERE dirpath = ? AND filename = ? LIMIT 1',
+                             (_text(dirpath), _text(filename))).fetchone()
+      if row is None:
+        raise KeyError((dirpath, filename))
+
+      return json.loads(row[0])
+
+    finally:
+      self._lock.release()
+
+  def listdir(self, dirpath):
+    '''
+    Return the list of the documents of the files of the directory dirpath,
+    sorted by filename.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      rows = self._db.execute('SELECT data FROM documents WHERE dirpath = ? '
+                              'ORDER BY filename',
+                              (_text(dirpath),)).fetchall()
+
+    finally:
+      self._lock.release()
+
+    return [ json.loads(row[0]) for row in rows ]
+
+  def put(self, document):
+    '''
+    Update or create a document, given as a dict.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      self._begin()
+      self._db.execute('INSERT OR REPLACE INTO documents '
+                       '(id, dirpath, filename, data) VALUES (?, ?, ?, ?)',
+                       (document['_id'], _text(document['dirpath']),
+                        _text(document['filename']), json.dumps(document)))
+
+    finally:
+      self._lock.release()
+
+  def remove(self, docid):
+    '''
+    Remove a document, if it is in the mirror.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      self._begin()
+      self._db.execute('DELETE FROM documents WHERE id = ?', (docid,))
+
+    finally:
+      self._lock.release()
@@ -0,0 +1,143 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import sys
+import time
+import threading
+
+import tsumufs
+
+
+class MetadataBridge(tsumufs.Debuggable, threading.Thread):
+  '''
+  Thread following the changes feed of the local CouchDB database into a
+  SQLiteDocumentStore, so that the metadata reads of the FileSystemOverlay
+  do not go through CouchDB. CouchDB is still where the metadata are
+  written, and replicated from and to the server by the continuous
+  replications of startReplication.
+
+  The mirror lags behind CouchDB, so it is current only once the changes up
+  to the sequence numbers required by the writers have been applied.
+  '''
+
+  _retryDelay = 5               # Seconds to wait before following the feed
+                                # again after an error.
+
+  _seq      = 0                 # Sequence number of the last change applied.
+  _required = 0                 # Sequence number the mirror has to reach to
+                                # be current, None if it cannot be trusted.
+
+  def __init__(self, store, documents):
+    self._debug('Initializing.')
+
+    threading.Thread.__init__(self, name='MetadataBridge')
+    self.setDaemon(True)
+
+    self._store = store
+    self._documents = documents
+    self._lock = threading.Lock()
+
+    self._seq = store.lastSeq()
+
+  def require(self, seq):
+    '''
+    Keep the mirror from being current until the change seq is applied. The
+    mirror is not trusted anymore if seq is None.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      if seq is None:
+        self._debug('The mirror cannot be trusted anymore.')
+        self._required = None
+
+      elif self._required is not None:
+        self._required = max(self._required, seq)
+
+    finally:
+      self._lock.release()
+
+  def isCurrent(self):
+    '''
+    Return whether the mirror has applied the changes required so far.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      return self._required is not None and self._seq >= self._required
+
+    finally:
+      self._lock.release()
+
+  def apply(self, event):
+    '''
+    Apply an event of the changes feed to the mirror.
+    '''
+
+    if not event.has_key('id'):
+      return
+
+    doc = event.get('doc') or {}
+
+    if event.get('deleted'):
+      self._store.remove(event['id'])
+    elif doc.get('doctype') == 'SyncDocument':
+      self._store.put(doc)
+
+    self._store.setLastSeq(event['seq'])
+    tsumufs.noteBatchedWrite()
+
+    self._lock.acquire()
+
+    try:
+      self._seq = event['seq']
+
+    finally:
+      self._lock.release()
+
+  def _follow(self):
+    since = self._seq
+
+    self._debug('Following the changes since seq %d' % since)
+
+    for event in self._documents.changes(feed="continuous",
+                                         since=since,
+                                         timeout=5000,
+                                         include_docs=True):
+      self.apply(event)
+
+      if tsumufs.unmounted.isSet():
+        break
+
+  def run(self):
+    # Install our custom exception handler so that any exceptions are
+    # output to the syslog rather than to /dev/null.
+    sys.excepthook = tsumufs.syslogExceptHook
+
+    while not tsumufs.unmounted.isSet():
+      try:
+        self._follow()
+
+      except Exception, e:
+        self._debug('Unable to follow the changes -- caught an exception.')
+        tsumufs.syslogCurrentException()
+        time.sleep(self._retryDelay)
+
+    self._debug('MetadataBridge shutdown complete.')
@@ -0,0 +1,134 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import itertools
+import threading
+
+import tsumufs
+
+
+class OpenFileRegistry(tsumufs.Debuggable):
+  '''
+  Class keeping count of the FUSE handles opened for writing on each file,
+  so that the sync thread leaves the files being written alone.
+
+  The handles are followed across renames, so that a file renamed while open
+  is left alone under its new name until released.
+  '''
+
+  _openCount = {}               # A hash of the number of handles opened for
+                                # writing per file.
+  _handles   = {}               # A hash of the handles to the current path of
+                                # their file.
+  _handleIds = itertools.count(1)
+
+  _lock = threading.Lock()
+
+  def open(self, fusepath):
+    '''
+    Account for a new handle opened for writing on fusepath.
+
+    Returns:
+      The handle to release once done.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      handle = self._handleIds.next()
+
+      self._handles[handle] = fusepath
+      self._openCount[fusepath] = self._openCount.get(fusepath, 0) + 1
+
+      return handle
+
+    finally:
+      self._lock.release()
+
+  def release(self, handle):
+    '''
+    Account for the release of a handle returned by open.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      fusepath = self._handles.pop(handle, None)
+      if fusepath is None:
+        return
+
+      count = self._openCount.get(fusepath, 0) - 1
+
+      if count > 0:
+        self._openCount[fusepath] = count
+      else:
+        self._openCount.pop(fusepath, None)
+
+    finally:
+      self._lock.release()
+
+  def noteRename(self, old, new):
+    '''
+    Carry the handles of the file old, and of the files under it, over to
+    new.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      for handle, fusepath in self._handles.items():
+        if fusepath == old or fusepath.startswith(old + '/'):
+          renamed = new + fusepath[len(old):]
+          self._handles[handle] = renamed
+
+          count = self._openCount.pop(fusepath) - 1
+          if count > 0:
+            self._openCount[fusepath] = count
+
+          self._openCount[renamed] = self._openCount.get(renamed, 0) + 1
+
+    finally:
+      self._lock.release()
+
+  def isOpen(self, fusepath, recursive=False):
+    '''
+    Check to see if fusepath, or any file under it if recursive is set, is
+    opened for writing.
+
+    Returns:
+      Boolean
+
+    Raises:
+      Nothing
+    '''
+
+    self._lock.acquire()
+
+    try:
+      if self._openCount.has_key(fusepath):
+        return True
+
+      if recursive:
+        for openpath in self._openCount:
+          if openpath.startswith(fusepath + '/'):
+            return True
+
+      return False
+
+    finally:
+      self._lock.release()
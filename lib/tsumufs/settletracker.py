@@ -0,0 +1,108 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import time
+import threading
+
+import tsumufs
+
+
+class SettleTracker(tsumufs.Debuggable):
+  '''
+  Class keeping track of the files being written, so that the sync thread
+  waits for them to settle before uploading them.
+
+  A file has settled once it has not been written for settleTime seconds.
+  The changes made until then are merged in the pending sync items of the
+  file.
+  '''
+
+  _lastWrite = {}               # A hash of the time of the last write of the
+                                # files that did not settle yet.
+
+  _lock = threading.Lock()
+
+  def noteWrite(self, fusepath):
+    '''
+    Account for a write to fusepath through a file handle.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      self._lastWrite[fusepath] = time.time()
+
+    finally:
+      self._lock.release()
+
+  def noteRename(self, old, new):
+    '''
+    Carry the state of the file old, and of the files under it, over to new.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      for fusepath in self._lastWrite.keys():
+        if fusepath == old or fusepath.startswith(old + '/'):
+          renamed = new + fusepath[len(old):]
+
+          self._lastWrite[renamed] = self._lastWrite.pop(fusepath)
+
+    finally:
+      self._lock.release()
+
+  def forget(self, fusepath):
+    '''
+    Drop the state of fusepath, once unlinked.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      self._lastWrite.pop(fusepath, None)
+
+    finally:
+      self._lock.release()
+
+  def isSettled(self, fusepath):
+    '''
+    Check to see if fusepath has settled.
+
+    Returns:
+      Boolean
+
+    Raises:
+      Nothing
+    '''
+
+    self._lock.acquire()
+
+    try:
+      lastWrite = self._lastWrite.get(fusepath)
+      if lastWrite is None:
+        return True
+
+      if time.time() - lastWrite < tsumufs.settleTime:
+        return False
+
+      del self._lastWrite[fusepath]
+      return True
+
+    finally:
+      self._lock.release()
@@ -22,6 +22,7 @@ from dataregion import *
 
 from ufo.database import *
 from couchdb.design import FilterFunction
+from couchdb.mapping import ListField
 
 class SyncChangeDocument(UTF8Document):
   '''
@@ -33,7 +34,7 @@ class SyncChangeDocument(UTF8Document):
   doctype = TextField(default="SyncChangeDocument")
   date    = FloatField()
 
-  type      = TextField()     # 'new|'link|'unlink|'change|'rename
+  type      = TextField()     # 'new|'link|'unlink|'rmtree|'change|'rename
 
   file_type = TextField()     # 'file|'dir|'socket|'fifo|'device
   dev_type  = TextField()     # 'char|'block
@@ -42,19 +43,25 @@ class SyncChangeDocument(UTF8Document):
 
   old_fname = TextField()
   new_fname = TextField()
-  filename  = TextField()
+  filename  = TextField()     # The path of the file when the change was made.
+  fileid    = TextField()     # The id of the document of the file, if it
+                              # still existed.
 
   change    = DictField()
 
+  unlinked  = ListField(TextField())  # The paths of the files removed along
+                                      # with the tree of an rmtree.
+
   _REQUIRED_KEYS = {
     'new':    [ 'file_type', 'filename' ],
     'link':   [ 'filename' ],
     'change': [ 'filename' ],
     'unlink': [ 'filename' ],
+    'rmtree': [ 'filename' ],
     'rename': [ 'old_fname', 'new_fname' ],
     }
 
-  _VALID_TYPES      = [ 'new', 'link', 'unlink', 'change', 'rename' ]
+  _VALID_TYPES      = [ 'new', 'link', 'unlink', 'rmtree', 'change', 'rename' ]
   _VALID_FILE_TYPES = [ 'file', 'dir', 'symlink', 'socket', 'fifo', 'device' ]
   _VALID_DEV_TYPES  = [ 'char', 'block' ]
 
@@ -91,17 +98,18 @@ class SyncChangeDocument(UTF8Document):
                 "}" \
               "}")
 
-  by_dir_prefix = ViewField('syncchange',
+  by_fileid = ViewField('syncchange',
     language='javascript',
     map_fun="function (doc) {"
-              "if (doc.doctype === 'SyncChangeDocument') {" \
-                "var last = '';" \
-                "var current = doc.filename;" \
-                "while (current != '/' && current != last) {" \
-                  "emit(current, doc);" \
-                  "current = current.slice(0, current.lastIndexOf('/'));" \
-                "}" \
-              "}" \
+              "if (doc.doctype === 'SyncChangeDocument' && doc.fileid)" \
+                "emit([doc.fileid, doc.type, doc.date], doc);" \
+            "}")
+
+  by_type = ViewField('syncchange',
+    language='javascript',
+    map_fun="function (doc) {"
+              "if (doc.doctype === 'SyncChangeDocument')" \
+                "emit([doc.type, doc.date], doc);" \
             "}")
 
   changes = FilterFunction('syncchange',
@@ -79,6 +79,36 @@ class SyncLog(tsumufs.Debuggable):
   _changesSeqs   = None
 
   _lock          = threading.RLock()
+  _commitLock    = threading.Lock()   # Serializes the commits of the sync
+                                      # items, made outside of _lock so that
+                                      # the changes logged meanwhile do not
+                                      # wait for them.
+
+  _rmtreeRoots   = None     # A hash of the ids of the pending rmtree items to
+                            # the paths of the trees they remove, loaded on
+                            # first use.
+
+  _inFlight      = {}       # A hash of the ids of the sync items being
+                            # propagated from a snapshot to the items. Changes
+                            # made meanwhile are not merged into these items.
+
+  _deferredSeq   = None     # The sequence number of the oldest item deferred
+                            # until the files it involves settle.
+
+  _seqNumber       = None   # The sequence number of the last change consumed,
+                            # saved every _seqSaveEvents changes or
+                            # _seqSaveInterval seconds. The changes consumed
+                            # since are consumed again after a crash.
+  _savedSeqNumber  = None
+  _unsavedEvents   = 0
+  _lastSeqSave     = 0
+  _seqSaveEvents   = 100
+  _seqSaveInterval = 10
+
+  _compactionInterval = 60  # Minimum number of seconds between two
+                            # compactions of the synclog.
+  _lastCompaction     = 0
+  _compactionStats    = { 'passes': 0, 'folded': 0, 'removed': 0 }
 
 
   @benchmark
@@ -98,12 +128,13 @@ class SyncLog(tsumufs.Debuggable):
     Checkpoint the synclog to disk.
     '''
 
-    self._syncChanges.commit()
+    self._saveState(force=True)
 
   @benchmark
-  def isNewFile(self, fusepath):
+  def isNewFile(self, fusepath, fileid=None):
     '''
-    Check to see if fusepath is a file the user created locally.
+    Check to see if fusepath, or the file of id fileid, is a file the user
+    created locally.
 
     Returns:
       Boolean
@@ -115,7 +146,7 @@ class SyncLog(tsumufs.Debuggable):
     try:
       self._lock.acquire()
 
-      self.getChange(filename=fusepath, type='new', pk=True)
+      self._getPendingChange(filename=fusepath, type='new', fileid=fileid)
 
       return True
 
@@ -125,6 +156,29 @@ class SyncLog(tsumufs.Debuggable):
     finally:
       self._lock.release()
 
+  def isSyncing(self, fusepath):
+    '''
+    Check to see if fusepath is being propagated from a snapshot.
+
+    Returns:
+      Boolean
+
+    Raises:
+      Nothing
+    '''
+
+    self._lock.acquire()
+
+    try:
+      for syncitem in self._inFlight.values():
+        if syncitem.filename == fusepath:
+          return True
+
+      return False
+
+    finally:
+      self._lock.release()
+
   @benchmark
   def isUnlinkedFile(self, fusepath):
     '''
@@ -144,12 +198,21 @@ class SyncLog(tsumufs.Debuggable):
       for change in sorted(self.getChange(filename=fusepath),
                            lambda x, y: cmp(x.date, y.date)):
         if change.filename == fusepath:
-          if change.type == 'unlink':
+          if change.type in ('unlink', 'rmtree'):
             is_unlinked = True
           else:
             is_unlinked = False
 
-      return is_unlinked
+      if is_unlinked:
+        return True
+
+      # The unlinks of the files of a removed subtree are folded in the
+      # removal of the subtree.
+      for root in self._getRmtreeRoots().itervalues():
+        if fusepath.startswith(root + '/'):
+          return True
+
+      return False
 
     finally:
       self._lock.release()
@@ -179,12 +242,12 @@ class SyncLog(tsumufs.Debuggable):
       return True
 
     except tsumufs.DocumentException, e:
+      # The items are looked up by the path of the files when they were
+      # logged, which may be outdated for the files moved along with a new
+      # directory.
       if recursive and os.path.isdir(tsumufs.cachePathOf(fusepath)):
-        try:
-          self._syncChanges.by_dir_prefix(key=fusepath, pk=True)
+        for change in self._getChangesUnder(fusepath):
           return True
-        except tsumufs.DocumentException, e:
-          pass
 
       return False
 
@@ -232,13 +295,15 @@ class SyncLog(tsumufs.Debuggable):
       self._lock.release()
 
   @benchmark
-  def addUnlink(self, filename, type_):
+  def addUnlink(self, filename, type_, fileid=None):
     '''
     Add a change to unlink a file. Additionally removes all previous changes in
     the queue for that filename.
 
     Args:
       filename: the filename to unlink.
+      fileid: the id of the document of the file, that was removed from the
+        metadatas already.
 
     Raises:
       Nothing.
@@ -253,11 +318,15 @@ class SyncLog(tsumufs.Debuggable):
       # backwards, index numbers don't change after deletion (IOW, we're always
       # deleting the tail).
 
-      is_new_file = self.isNewFile(filename)
+      is_new_file = self.isNewFile(filename, fileid=fileid)
 
-      if self.isFileDirty(filename):
-        for change in sorted(self.getChange(filename=filename),
+      if self.getChange(filename=filename, fileid=fileid):
+        for change in sorted(self.getChange(filename=filename, fileid=fileid),
                              lambda x, y: cmp(x.date, y.date), reverse=True):
+          if self._inFlight.has_key(change.id):
+            # Being propagated, the unlink will follow.
+            continue
+
           if change.type in ('new', 'change', 'link'):
             # Remove the possible associated file change
             try:
@@ -294,7 +363,65 @@ class SyncLog(tsumufs.Debuggable):
       # Now add an additional syncitem to the queue to represent the unlink if
       # it wasn't a file that was created on the cache by the user.
       if not is_new_file:
-        self._appendToSyncQueue('unlink', file_type=type_, filename=filename)
+        unlinked = []
+        if type_ == 'dir':
+          unlinked = self._foldSubtreeUnlinks(filename)
+
+        if unlinked:
+          self._appendToSyncQueue('rmtree', file_type=type_, filename=filename,
+                                  unlinked=unlinked)
+        else:
+          self._appendToSyncQueue('unlink', file_type=type_, filename=filename)
+
+      tsumufs.settleTracker.forget(filename)
+
+    finally:
+      self._lock.release()
+
+  def _foldSubtreeUnlinks(self, fusepath):
+    '''
+    Remove the pending unlinks of the files under the directory fusepath, as
+    the directory is removed along with its whole subtree.
+
+    Returns:
+      The list of the paths of the files unlinked, so that the files added
+      to the tree on fs meanwhile are told apart.
+
+    Raises:
+      Nothing
+    '''
+
+    unlinked = []
+
+    for change in self._getChangesUnder(fusepath):
+      if (change.type in ('unlink', 'rmtree') and
+          not self._inFlight.has_key(change.id)):
+        unlinked.append(change.filename)
+
+        if change.type == 'rmtree':
+          unlinked.extend(change.unlinked or [])
+
+        self._removeFromSyncQueue(change)
+
+    return unlinked
+
+  def _getRmtreeRoots(self):
+    '''
+    Return the hash of the ids of the pending rmtree items to the paths of
+    the trees they remove, loading it from the synclog on first use.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      if self._rmtreeRoots is None:
+        self._rmtreeRoots = {}
+
+        for change in self._syncChanges.by_type(startkey=['rmtree'],
+                                                endkey=['rmtree', {}]):
+          self._rmtreeRoots[change.id] = change.filename
+
+      return self._rmtreeRoots
 
     finally:
       self._lock.release()
@@ -307,12 +434,13 @@ class SyncLog(tsumufs.Debuggable):
       self._lock.acquire()
 
       try:
-        syncchange = self.getChange(filename=fname, type='change', pk=True)
+        syncchange = self._getPendingChange(filename=fname, type='change')
 
       except tsumufs.DocumentException, e:
         syncchange = self._appendToSyncQueue('change', filename=fname)
 
       syncchange.filechange.addDataChange(start, end, data)
+      tsumufs.noteBatchedWrite()
 
     finally:
       self._lock.release()
@@ -330,14 +458,27 @@ class SyncLog(tsumufs.Debuggable):
       self._lock.acquire()
 
       try:
-        syncchange = self.getChange(filename=fname,
-                                    type='change',
-                                    pk=True)
+        syncchange = self._getPendingChange(filename=fname, type='change')
 
       except tsumufs.DocumentException, e:
         syncchange = self._appendToSyncQueue('change', filename=fname,
                                              change=metadata)
 
+      else:
+        # Merge the metadatas changed into the pending change, which may only
+        # carry data changes so far.
+        change = dict(syncchange.change or {})
+
+        for key, value in metadata.items():
+          if isinstance(value, list):
+            change[key] = list(set(change.get(key) or []) | set(value))
+          elif value:
+            change[key] = value
+
+        syncchange.change = change
+        self._syncChanges.update(syncchange)
+        tsumufs.noteBatchedWrite()
+
     finally:
       self._lock.release()
 
@@ -349,9 +490,7 @@ class SyncLog(tsumufs.Debuggable):
       self._lock.acquire()
 
       try:
-        change = self.getChange(filename=fusepath,
-                                type='change',
-                                pk=True)
+        change = self._getPendingChange(filename=fusepath, type='change')
         self._debug('Truncating data in %s' % repr(change))
         change.filechange.truncateLength(size)
         
@@ -369,74 +508,490 @@ class SyncLog(tsumufs.Debuggable):
     try:
       self._lock.acquire()
 
-      if self.isNewFile(old):
-        changes = []
-
-        # Change the filename of all sync changes corresponding to this file
-        # TODO: only rename the filename of sync changes made after the 'new'
-        for change in self._syncChanges.by_filename(filename=old, type='new'):
-          change.filename = new
-          changes.append(change)
-
-        # If the renamed document is a directory, change the filename of all
-        # sync changes corresponding to files located in the directory subtree.
-        # TODO: only rename the filename of sync changes made after the 'new'
-        renamed = tsumufs.fsOverlay[new]
-        if stat.S_ISDIR(renamed.mode):
-          for change in self._syncChanges.by_dir_prefix(key=old):
-            change.filename = change.filename.replace(old, new, 1)
-            changes.append(change)
+      # The sync items of a new file, and of the files under it, refer to
+      # their documents and are propagated to the paths the files have by
+      # then, so there is nothing to log.
+      fileid = self.fileIdOf(new)
 
-        self._syncChanges.update(changes)
-
-      else:
+      if not self.isNewFile(old, fileid=fileid):
         self._appendToSyncQueue('rename', old_fname=old, new_fname=new)
+      else:
+        self._foldReplacedUnlink(new, fileid)
+
+      tsumufs.settleTracker.noteRename(old, new)
+      tsumufs.openFileRegistry.noteRename(old, new)
 
     finally:
       self._lock.release()
 
-  @benchmark
-  def getChange(self, filename="", type='', pk=False):
-    if not filename and not type:
-      return self._syncChanges.by_filename()
+  def _foldReplacedUnlink(self, fusepath, fileid):
+    '''
+    Keep the unlink of the file replaced at fusepath by the rename of the new
+    file of id fileid from being propagated after the new file, which would
+    remove it on fs.
+
+    A regular file replaces the file on fs when it is propagated, so the
+    unlink is dropped and the data shared with the file replaced is kept
+    for the delta. Otherwise the items of the new file are queued again
+    after the unlink.
+    '''
+
+    try:
+      created = self._getPendingChange(None, 'new', fileid=fileid)
+    except tsumufs.DocumentException, e:
+      return
+
+    for unlink in self._iterChanges(fusepath, None, None):
+      if (unlink.type not in ('unlink', 'rmtree') or
+          unlink.filename != fusepath or unlink.date < created.date or
+          self._inFlight.has_key(unlink.id)):
+        continue
+
+      if created.file_type == 'file' and unlink.file_type != 'dir':
+        self._debug('Folding %s into %s' % (unlink, created))
+        self._removeFromSyncQueue(unlink)
+        continue
+
+      # Updating the items moves them to the end of the changes feed.
+      self._debug('Queueing %s after %s' % (created, unlink))
+
+      for change in sorted(self.getChange(fileid=fileid),
+                           lambda x, y: cmp(x.date, y.date)):
+        if not self._inFlight.has_key(change.id):
+          change.date = time.time()
+          self._syncChanges.update(change)
+          tsumufs.noteBatchedWrite()
+
+  def fileIdOf(self, fusepath):
+    '''
+    Return the id of the document of fusepath, or None if fusepath does not
+    exist.
+    '''
+
+    try:
+      return tsumufs.fsOverlay[fusepath].id
+    except (OSError, KeyError, tsumufs.DocumentException), e:
+      return None
+
+  def _pathOfFile(self, fileid):
+    '''
+    Return the current path of the file of id fileid, or None if the file
+    has been removed.
+    '''
+
+    try:
+      document = self._syncDocuments[fileid]
+    except (KeyError, tsumufs.DocumentException), e:
+      return None
+
+    return posixpath.join(document.dirpath, document.filename)
+
+  def _isRenamePending(self, fusepath):
+    '''
+    Check to see if fusepath, or a directory above it, has been renamed by a
+    rename that is still to be propagated.
+    '''
+
+    for change in self._syncChanges.by_type(startkey=['rename'],
+                                            endkey=['rename', {}]):
+      if (fusepath == change.new_fname or
+          fusepath.startswith(change.new_fname + '/')):
+        return True
+
+    return False
+
+  def _getChangesUnder(self, fusepath):
+    '''
+    Return the changes logged for the files under the directory fusepath.
+    '''
+
+    return self._syncChanges.by_filename(startkey=[fusepath + '/'],
+                                         endkey=[fusepath + u'/\u9999'])
+
+  def _iterChanges(self, filename, type, fileid):
+    '''
+    Yield the changes logged for a file, the ones found by the id of its
+    document first. The changes logged by path are only looked up once the
+    ones found by id are consumed.
+    '''
+
+    if fileid:
+      startkey = [ fileid ]
+      if type:
+        startkey.append(type)
 
-    startkey, endkey = [], []
+      for change in self._syncChanges.by_fileid(startkey=startkey,
+                                                endkey=startkey + [ {} ]):
+        yield change
 
     if filename:
-      startkey.append(filename)
-      endkey.append(filename)
+      startkey, endkey = [ filename ], [ filename ]
 
-    if type:
-      startkey.append(type)
-      endkey.append(type)
+      if type:
+        startkey.append(type)
+        endkey.append(type)
 
-    if endkey:
       endkey[-1] += '\u9999'
 
-    result = self._syncChanges.by_filename(startkey=startkey,
-                                           endkey=endkey)
+      # The changes of the file found by id already have been.
+      for change in self._syncChanges.by_filename(startkey=startkey,
+                                                  endkey=endkey):
+        if not fileid or not change.fileid:
+          yield change
+
+  @benchmark
+  def getChange(self, filename="", type='', pk=False, fileid=None):
+    '''
+    Return the changes logged for a file, the changes to the files that
+    still exist being looked up by the id of their document, so that the
+    changes made before the file was moved are found.
+    '''
+
+    if not filename and not type and not fileid:
+      return self._syncChanges.by_filename()
+
+    if filename and not fileid:
+      fileid = self.fileIdOf(filename)
 
     if pk:
-      for doc in result: return doc
-      raise DocumentException("Could not find primary key %s" % startkey)
+      for doc in self._iterChanges(filename, type, fileid): return doc
+      raise DocumentException("Could not find primary key %s, %s, %s"
+                              % (filename, type, fileid))
+
+    return list(self._iterChanges(filename, type, fileid))
+
+  def _getPendingChange(self, filename, type, fileid=None):
+    '''
+    Return the first change of the given type for filename that is not
+    being propagated.
+
+    Raises:
+      DocumentException if there is no such change.
+    '''
+
+    if filename and not fileid:
+      fileid = self.fileIdOf(filename)
+
+    for change in self._iterChanges(filename, type, fileid):
+      if not self._inFlight.has_key(change.id):
+        return change
+
+    raise DocumentException("Could not find pending change %s, %s"
+                            % (filename, type))
+
+  def _involves(self, syncitem, fusepath):
+    '''
+    Check to see if syncitem involves fusepath or a file under it.
+    '''
+
+    if syncitem.type == 'rename':
+      fusepaths = [ syncitem.old_fname, syncitem.new_fname ]
+    else:
+      fusepaths = [ syncitem.filename ]
+
+    for path in fusepaths:
+      if path == fusepath or path.startswith(fusepath + '/'):
+        return True
+
+    return False
+
+  def _carriesMetadata(self, syncitem):
+    '''
+    Check to see if the change syncitem records changes to the metadatas of
+    its file, that propagating the file does not carry.
+    '''
+
+    for value in (syncitem.change or {}).values():
+      if value:
+        return True
+
+    return False
+
+  def _removeCompacted(self, syncitem):
+    if syncitem.type == 'change':
+      try:
+        syncitem.filechange.clearDataChanges()
+
+      except tsumufs.DocumentException, e:
+        self._debug('No filechange found for %s' % syncitem.filename)
+
+    self._removeFromSyncQueue(syncitem)
+
+  def _foldRename(self, rename, following, removed, plan, inflight):
+    '''
+    Plan the folding of the rename with the next item involving its files,
+    if it is either a rename of its destination or an unlink of its
+    destination, and if no other item involves the files.
+
+    The renames replacing an existing file are preceded by an unlink of the
+    file replaced, so the destination of the renames folded never existed
+    but for the renamed file.
+
+    Returns:
+      True if the rename has been folded into its destination, or removed.
+    '''
 
-    return result
+    following = [ syncitem for syncitem in following
+                  if syncitem.id not in removed ]
+    involved = [ syncitem for syncitem in following
+                 if (self._involves(syncitem, rename.old_fname) or
+                     self._involves(syncitem, rename.new_fname)) ]
+
+    if len(involved) != 1 or involved[0].id in inflight:
+      return False
+
+    syncitem = involved[0]
+
+    if syncitem.type == 'rename' and syncitem.old_fname == rename.new_fname:
+      # file -> file' -> file'' becomes file -> file'', as long as nothing
+      # else involves file''.
+      for other in following:
+        if other is not syncitem and self._involves(other, syncitem.new_fname):
+          return False
+
+      self._debug('Folding %s and %s' % (rename, syncitem))
+
+      if syncitem.new_fname == rename.old_fname:
+        plan.append(([ rename, syncitem ], [ rename, syncitem ], [], []))
+        removed.add(rename.id)
+      else:
+        rename.new_fname = syncitem.new_fname
+        plan.append(([ rename, syncitem ], [ syncitem ], [ rename ], []))
+
+      removed.add(syncitem.id)
+
+      return True
+
+    if (syncitem.type in ('unlink', 'rmtree') and
+        syncitem.filename == rename.new_fname):
+      # file -> file' -> unlinked becomes file -> unlinked.
+      self._debug('Folding %s and %s' % (rename, syncitem))
+
+      syncitem.filename = rename.old_fname
+
+      if syncitem.type == 'rmtree':
+        syncitem.unlinked = [ rename.old_fname + path[len(rename.new_fname):]
+                              for path in syncitem.unlinked or [] ]
+
+      plan.append(([ rename, syncitem ], [ rename ], [ syncitem ], []))
+      removed.add(rename.id)
+
+      return True
+
+    return False
+
+  def _planCompaction(self, syncitems):
+    '''
+    Plan the compaction of syncitems, sorted by date, without writing them.
+
+    Returns:
+      A list of steps (checked, removed, updated, cleared), the items cleared
+      losing their data changes only. A step is to be applied only if the
+      items checked did not change since they were read.
+    '''
+
+    inflight = set(self._inFlight.keys())
+    removed = set()
+    plan = []
+
+    for index, syncitem in enumerate(syncitems):
+      if syncitem.id in removed or syncitem.id in inflight:
+        continue
+
+      following = syncitems[index + 1:]
+
+      if syncitem.type == 'new' and syncitem.file_type == 'file':
+        for other in following:
+          if other.id in removed:
+            continue
+
+          if not (self._involves(other, syncitem.filename) or
+                  (syncitem.fileid and other.fileid == syncitem.fileid)):
+            continue
+
+          if other.type != 'change' or other.id in inflight:
+            break
+
+          if self._carriesMetadata(other):
+            # Only the data of the change is dropped.
+            self._debug('Dropping the data changes of %s of new file' % other)
+            plan.append(([ syncitem, other ], [], [], [ other ]))
+            continue
+
+          self._debug('Dropping %s of new file' % other)
+          plan.append(([ syncitem, other ], [ other ], [], []))
+          removed.add(other.id)
+
+      elif syncitem.type == 'rename':
+        while (syncitem.id not in removed and
+               self._foldRename(syncitem, following, removed, plan, inflight)):
+          pass
+
+    # The items rewritten by several steps carry the changes of all of them,
+    # so these steps are applied together or not at all.
+    merged = []
+
+    for step in plan:
+      ids = set([ syncitem.id for syncitem in step[0] ])
+
+      for other in [ other for other in merged if other[0] & ids ]:
+        merged.remove(other)
+        ids |= other[0]
+        step = [ other[index] + step[index - 1] for index in range(1, 5) ]
+
+      merged.append([ ids ] + list(step))
+
+    return [ tuple(step[1:]) for step in merged ]
+
+  def _isUnchanged(self, syncitems, revisions):
+    '''
+    Check to see if syncitems are still logged as they were read, and are
+    not being propagated.
+    '''
+
+    for syncitem in dict([ (syncitem.id, syncitem)
+                           for syncitem in syncitems ]).values():
+      if self._inFlight.has_key(syncitem.id):
+        return False
+
+      try:
+        current = self._syncChanges[syncitem.id]
+      except tsumufs.DocumentException, e:
+        return False
+
+      if current.rev != revisions.get(syncitem.id):
+        return False
+
+    return True
+
+  @benchmark
+  def compact(self):
+    '''
+    Fold the redundant sequences of items of the synclog into their minimal
+    equivalent, to save round trips to the fs mount when propagating them:
+
+      - the data changes to a new file are dropped, as the whole file is
+        propagated, while the changes to its metadatas are kept;
+      - successive renames are merged, ie. file -> file' -> file'' becomes
+        file -> file'', and is dropped if file'' is file;
+      - a rename followed by an unlink becomes an unlink of the original
+        file.
+
+    The synclog is scanned and the compaction planned without holding the
+    lock, so that the changes logged meanwhile do not wait for the scan. The
+    plan is then applied under the lock, skipping the steps involving items
+    changed, removed or taken for propagation meanwhile. The items logged
+    meanwhile all come after the ones scanned, which keeps the other steps
+    valid.
+
+    Returns:
+      The number of items removed.
+
+    Raises:
+      Nothing
+    '''
+
+    syncitems = sorted(self.getChange(), lambda x, y: cmp(x.date, y.date))
+    plan = self._planCompaction(syncitems)
+
+    revisions = dict([ (syncitem.id, syncitem.rev) for syncitem in syncitems ])
+    removed = 0
+
+    self._lock.acquire()
+
+    try:
+      for checked, remove, update, clear in plan:
+        if not self._isUnchanged(checked, revisions):
+          self._debug('Skipping the compaction of %s' % checked)
+          continue
+
+        for syncitem in clear:
+          try:
+            syncitem.filechange.clearDataChanges()
+          except tsumufs.DocumentException, e:
+            self._debug('No filechange found for %s' % syncitem.filename)
+
+        written = set()
+
+        for syncitem in update:
+          if syncitem in remove or syncitem.id in written:
+            continue
+
+          self._syncChanges.update(syncitem)
+          tsumufs.noteBatchedWrite()
+          written.add(syncitem.id)
+
+          if syncitem.type == 'rmtree':
+            self._getRmtreeRoots()[syncitem.id] = syncitem.filename
+
+        for syncitem in remove:
+          self._removeCompacted(syncitem)
+          removed += 1
+
+        if [ syncitem for syncitem in checked if syncitem.type == 'rename' ]:
+          self._compactionStats['folded'] += 1
+
+      self._lastCompaction = time.time()
+      self._compactionStats['passes'] += 1
+      self._compactionStats['removed'] += removed
+
+      if removed:
+        self._debug('Compaction removed %d of %d items.'
+                    % (removed, len(syncitems)))
+
+      return removed
+
+    finally:
+      self._lock.release()
+
+  def compactIfDue(self):
+    '''
+    Compact the synclog, unless it has been compacted recently.
+    '''
+
+    if time.time() - self._lastCompaction >= self._compactionInterval:
+      self.compact()
+
+  def getCompactionStats(self):
+    return dict(self._compactionStats)
 
   @benchmark
   def popChanges(self):
+    self.compactIfDue()
+
     # Firstly retrieve the number of the last consumed changes sequence
-    try:
-      last_seq = self._changesSeqs.by_consumer(key="tsumufs-sync-thread", pk=True)
-    except tsumufs.DocumentException, e:
-      last_seq = self._changesSeqs.create(consumer="tsumufs-sync-thread",
-                                          seq_number=0)
+    if self._seqNumber is None:
+      try:
+        last_seq = self._changesSeqs.by_consumer(key="tsumufs-sync-thread",
+                                                 pk=True)
+      except tsumufs.DocumentException, e:
+        last_seq = self._changesSeqs.create(consumer="tsumufs-sync-thread",
+                                            seq_number=0)
 
-    self._debug('Waiting for changes since seq %d' % last_seq.seq_number)
+      self._seqNumber = self._savedSeqNumber = last_seq.seq_number
+      self._lastSeqSave = time.time()
+
+    elif time.time() - self._lastSeqSave >= self._seqSaveInterval:
+      self._saveState()
+
+    since = self._seqNumber
+
+    self._debug('Waiting for changes since seq %d' % since)
+
+    # The items deferred during this pass are seen again on the next one, as
+    # the sequence number kept does not go past them.
+    self._deferredSeq = None
+    deferred = set()
+    rescan = None
 
     for event in self._syncChanges.changes(feed="continuous",
-                                           since=last_seq.seq_number,
+                                           since=since,
                                            timeout=5000,
                                            include_docs=True):
+      if rescan and time.time() >= rescan:
+        self._debug('Rescanning the deferred changes.')
+        return
+
       if not event.has_key('id'):
         continue
 
@@ -469,6 +1024,15 @@ class SyncLog(tsumufs.Debuggable):
       removed = False
       filechange = None
 
+      doc = event.get('doc') or {}
+      if doc.get('doctype') == 'SyncDocument':
+        # The document of a file has been updated, the kernel page cache of
+        # the file is not valid anymore if the revision changed.
+        tsumufs.cacheManager.invalidatePageCache(event['id'], doc.get('_rev'))
+        self._refreshIfCached(event['id'], doc)
+        self.keepState(event['seq'])
+        continue
+
       try:
         syncitem = SyncChangeDocument(**event.get('doc'))
         # For CouchDB < 0.11
@@ -481,9 +1045,39 @@ class SyncLog(tsumufs.Debuggable):
 
       self._debug('Syncitem retrieved from a new change; %s' % syncitem)
 
+      # Propagate the changes to the files to the paths the files have now,
+      # once the renames of the directories above them have been propagated.
+      if syncitem.fileid and syncitem.type in ('new', 'link', 'change'):
+        fusepath = self._pathOfFile(syncitem.fileid)
+
+        if fusepath is not None:
+          if self._isRenamePending(fusepath):
+            self._debug('Waiting for %s to be renamed on fs.' % fusepath)
+            deferred.add(fusepath)
+
+            if self._deferredSeq is None:
+              self._deferredSeq = event['seq']
+              rescan = time.time() + tsumufs.settleTime
+
+            continue
+
+          syncitem.filename = fusepath
+
+      # Leave the files still open for writing alone until they are released
+      # and settle, so that the following writes get merged in the pending
+      # items.
+      if self._mustDefer(syncitem, deferred):
+        self._debug('Deferring %s until it settles.' % syncitem)
+
+        if self._deferredSeq is None:
+          self._deferredSeq = event['seq']
+          rescan = time.time() + tsumufs.settleTime
+
+        continue
+
       try:
         # Ensure the appropriate locks are locked
-        if syncitem.type in ('new', 'link', 'unlink', 'change'):
+        if syncitem.type in ('new', 'link', 'unlink', 'rmtree', 'change'):
           tsumufs.cacheManager.lockFile(syncitem.filename)
           tsumufs.fsMount.lockFile(syncitem.filename)
           tsumufs.fsOverlay[syncitem.filename]
@@ -496,8 +1090,11 @@ class SyncLog(tsumufs.Debuggable):
           tsumufs.fsOverlay[syncitem.old_fname]
 
         # Check that the SyncItem stills exists in the database
-        # now that locks have been taken
+        # now that locks have been taken, and keep propagating it to the
+        # path locked.
+        fusepath = syncitem.filename
         syncitem = self._syncChanges[event['id']]
+        syncitem.filename = fusepath
 
       except OSError, err:
         if err.errno == errno.ENOENT:
@@ -508,11 +1105,26 @@ class SyncLog(tsumufs.Debuggable):
       except DocumentException, e:
         removed = True
 
-      if removed and syncitem.type != 'unlink':
+      if removed and syncitem.type not in ('unlink', 'rmtree'):
         self._debug('Syncitem %s has been deleted since we first saw it' % syncitem)
         self.finishedWithChange(syncitem, remove_item=False)
         continue
 
+      # A directory above the file may have been renamed before the file got
+      # locked, try again on the next pass.
+      if (not removed and syncitem.fileid and
+          syncitem.type in ('new', 'link', 'change') and
+          self._pathOfFile(syncitem.fileid) not in (None, syncitem.filename)):
+        self._debug('%s has been moved meanwhile.' % syncitem.filename)
+        self.finishedWithChange(syncitem, remove_item=False)
+        deferred.add(syncitem.filename)
+
+        if self._deferredSeq is None:
+          self._deferredSeq = event['seq']
+          rescan = time.time() + tsumufs.settleTime
+
+        continue
+
       # Grab the associated inode changes if there are any.
       if syncitem.type == 'change':
         try:
@@ -526,25 +1138,176 @@ class SyncLog(tsumufs.Debuggable):
         finally:
           self._lock.release()
 
+      # Propagate the data from a snapshot of the cached file, and release the
+      # cache lock meanwhile so that the file can still be modified. The
+      # changes made to the file are logged in new sync items.
+      syncitem.snapshot = None
+
+      if (not removed and
+          (syncitem.type == 'change' or
+           (syncitem.type == 'new' and
+            syncitem.file_type not in ('dir', 'symlink')))):
+        try:
+          syncitem.snapshot = tsumufs.cacheManager.snapshotFile(syncitem.filename)
+
+        except OSError, e:
+          if e.errno != errno.ENOENT:
+            raise
+
+          self._debug('No cached copy of %s to snapshot' % syncitem.filename)
+
+        else:
+          self._lock.acquire()
+
+          try:
+            self._inFlight[syncitem.id] = syncitem
+          finally:
+            self._lock.release()
+
+          tsumufs.cacheManager.unlockFile(syncitem.filename)
+
       syncitem.seq_number = event['seq']
       self._debug('Yielding (syncchange, filechange), seq %d: (%s,%s)'
                   % (event['seq'], syncitem, str(syncitem.filechange)))
 
       yield (syncitem, syncitem.filechange)
 
+  def _refreshIfCached(self, fileid, doc):
+    '''
+    Queue the refresh of the cached copy of a regular file updated by an
+    other client, so that the next open does not wait for the download.
+    Whether the file is clean and still covered by the cachespec is checked
+    at refresh time.
+    '''
+
+    if not stat.S_ISREG(doc.get('mode', 0)):
+      return
+
+    try:
+      if tsumufs.fsOverlay.getCachedRevision(fileid)[0] == doc.get('_rev'):
+        return
+    except KeyError, e:
+      # Not cached, nothing to refresh.
+      return
+
+    fusepath = posixpath.join(doc['dirpath'], doc['filename'])
+
+    self._debug('Queueing the refresh of %s.' % fusepath)
+    tsumufs.cacheRefresher.refresh(fusepath)
+
+  def _mustDefer(self, syncitem, deferred):
+    '''
+    Check to see if syncitem has to wait for the files it involves to be
+    released, for the file it changes to settle, or for an item deferred
+    earlier involving the same files. The files involved in the deferred
+    items are added to deferred.
+
+    Returns:
+      Boolean
+
+    Raises:
+      Nothing
+    '''
+
+    if syncitem.type == 'rename':
+      fusepaths = [ syncitem.old_fname, syncitem.new_fname ]
+    else:
+      fusepaths = [ syncitem.filename ]
+
+    for fusepath in fusepaths:
+      for deferredpath in deferred:
+        if (deferredpath == fusepath or
+            deferredpath.startswith(fusepath + '/')):
+          deferred.update(fusepaths)
+          return True
+
+    for fusepath in fusepaths:
+      if tsumufs.openFileRegistry.isOpen(fusepath,
+                                         recursive=(syncitem.type == 'rename')):
+        deferred.update(fusepaths)
+        return True
+
+    if (syncitem.type in ('new', 'change') and
+        not tsumufs.settleTracker.isSettled(syncitem.filename)):
+      deferred.add(syncitem.filename)
+      return True
+
+    return False
+
   def keepState(self, seq_number):
-    self._debug('Last sequence number %s' % seq_number)
-    last_seq = self._changesSeqs.by_consumer(key="tsumufs-sync-thread", pk=True)
-    last_seq.seq_number = seq_number
-    self._changesSeqs.update(last_seq)
+    '''
+    Mark the changes up to seq_number as consumed. The sequence number is
+    only saved to the database from time to time.
+    '''
+
+    # Do not skip the deferred items.
+    if self._deferredSeq is not None:
+      seq_number = min(seq_number, self._deferredSeq - 1)
+
+    if seq_number <= self._seqNumber:
+      return
+
+    self._seqNumber = seq_number
+    self._unsavedEvents += 1
+
+    if (self._unsavedEvents >= self._seqSaveEvents or
+        time.time() - self._lastSeqSave >= self._seqSaveInterval):
+      if tsumufs.checkpointThread is not None:
+        # Saved by the checkpoint thread, as the lock may be held here.
+        tsumufs.checkpointThread.requestCheckpoint()
+      else:
+        self._saveState()
+
+  def _saveState(self, force=False):
+    '''
+    Commit the sync items, then save the sequence number of the last change
+    consumed. Nothing is committed if no change has been consumed since the
+    last save, unless force is set.
+
+    The commit is made without holding the lock of the synclog.
+    '''
+
+    seq_number = self._seqNumber
+
+    if not force and (seq_number is None or
+                      seq_number == self._savedSeqNumber):
+      return
+
+    self._commitLock.acquire()
+
+    try:
+      # The removals of the items consumed must not be lost.
+      self._syncChanges.commit()
+
+      if seq_number is None or seq_number <= self._savedSeqNumber:
+        return
+
+      self._debug('Last sequence number %s' % seq_number)
+      last_seq = self._changesSeqs.by_consumer(key="tsumufs-sync-thread",
+                                               pk=True)
+      last_seq.seq_number = seq_number
+      self._changesSeqs.update(last_seq)
+
+      self._savedSeqNumber = seq_number
+      self._unsavedEvents = 0
+      self._lastSeqSave = time.time()
+
+    finally:
+      self._commitLock.release()
 
   @benchmark
   def finishedWithChange(self, syncitem, remove_item=True):
     self._lock.acquire()
 
     try:
-      # Ensure the appropriate locks are unlocked
-      if syncitem.type in ('new', 'link', 'unlink', 'change'):
+      # Ensure the appropriate locks are unlocked, the cache lock of the items
+      # propagated from a snapshot being already released.
+      if self._inFlight.has_key(syncitem.id):
+        del self._inFlight[syncitem.id]
+        tsumufs.cacheManager.releaseSnapshot(syncitem.snapshot)
+        tsumufs.fsMount.unlockFile(syncitem.filename)
+
+      elif syncitem.type in ('new', 'link', 'unlink', 'rmtree', 'change'):
         tsumufs.cacheManager.unlockFile(syncitem.filename)
         tsumufs.fsMount.unlockFile(syncitem.filename)
 
@@ -573,11 +1336,28 @@ class SyncLog(tsumufs.Debuggable):
     params['type'] = type
     params['date'] = time.time()
 
-    return self._syncChanges.create(**params)
+    # Refer to the files that still exist by the id of their document.
+    if type not in ('unlink', 'rmtree'):
+      fileid = self.fileIdOf(params.get('filename') or params['new_fname'])
+
+      if fileid:
+        params['fileid'] = fileid
+
+    tsumufs.noteBatchedWrite()
+    change = self._syncChanges.create(**params)
+
+    if type == 'rmtree':
+      self._getRmtreeRoots()[change.id] = change.filename
+
+    return change
 
   def _removeFromSyncQueue(self, change):
+    tsumufs.noteBatchedWrite()
     self._syncChanges.delete(change)
 
+    if change.type == 'rmtree':
+      self._getRmtreeRoots().pop(change.id, None)
+
 
 # hash of inode changes:
 #   { <inode number>: { data: ( { data: "...",
@@ -599,3 +1379,12 @@ def xattr_synclogContents(type_, path, value=None):
     return -errno.EOPNOTSUPP
 
   return str(tsumufs.syncLog)
+
+@extendedattribute('root', 'tsumufs.synclog-compaction')
+def xattr_synclogCompaction(type_, path, value=None):
+  if value:
+    return -errno.EOPNOTSUPP
+
+  return ('passes: %(passes)d, items folded: %(folded)d, '
+          'items removed: %(removed)d'
+          % tsumufs.syncLog.getCompactionStats())
@@ -27,6 +27,7 @@ import traceback
 import fuse
 
 import tsumufs
+import dataregion
 from extendedattributes import extendedattribute
 
 from ufo.filesystem import DocumentHelper
@@ -62,6 +63,11 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
   Thread to handle cache and fs mount management.
   '''
 
+  backgroundTransfers = True  # Yield the bandwidth to the FUSE threads.
+
+  _disconnected = True        # Whether the cache has to be revalidated once
+                              # the fs mount is available.
+
   def __init__(self):
     self._debug('Initializing.')
 
@@ -72,6 +78,8 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
     self._debug('Setting up thread state.')
     threading.Thread.__init__(self, name='SyncThread')
 
+    self._delta = tsumufs.DeltaEngine()
+
     self._debug('Initialization complete.')
 
   def _attemptMount(self):
@@ -110,7 +118,7 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
 
   def _propagateNew(self, item, change):
     fusepath = item.filename
-    cachepath = tsumufs.cachePathOf(fusepath)
+    cachepath = item.snapshot or tsumufs.cachePathOf(fusepath)
 
     try:
       document = tsumufs.fsOverlay[fusepath]
@@ -122,21 +130,40 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
         return False
 
     try:
-      tsumufs.fsMount.lstat(fusepath)
+      fs_stat = tsumufs.fsMount.lstat(fusepath)
     except (OSError, IOError), e:
       if e.errno != errno.ENOENT:
         raise
 
+      fs_stat = None
+
     if item.file_type != 'dir':
       if item.file_type == 'symlink':
+        # The item may be propagated again after a crash.
+        if fs_stat and stat.S_ISLNK(fs_stat.st_mode):
+          tsumufs.fsMount.unlink(fusepath)
+
         tsumufs.fsMount.symlink(os.readlink(cachepath), fusepath, document=document)
-      else:
+
+      # A file replacing an existing one, as saved by most editors, is
+      # likely to share most of its data with it. Anything else replaced is
+      # removed rather than written through.
+      elif not (fs_stat and stat.S_ISREG(fs_stat.st_mode) and
+                self._propagateDelta(fusepath, cachepath, fs_stat)):
+        if (fs_stat and not stat.S_ISREG(fs_stat.st_mode) and
+            not stat.S_ISDIR(fs_stat.st_mode)):
+          tsumufs.fsMount.unlink(fusepath)
+
         tsumufs.fsMount.copy(open(cachepath, "rb"),
                              fusepath, document=document)
-          
+
+        if os.lstat(cachepath).st_size >= self._delta.threshold:
+          self._delta.saveSignatures(fusepath, tsumufs.fsMount.lstat(fusepath),
+                                     self._delta.signatures(cachepath))
+
       tsumufs.fsMount.chmod(fusepath, document.mode)
 
-    else:
+    elif not (fs_stat and stat.S_ISDIR(fs_stat.st_mode)):
       tsumufs.fsMount.mkdir(fusepath, document.mode, document=document)
 
     try:
@@ -146,6 +173,54 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
 
     return False
 
+  def _propagateDelta(self, fusepath, cachepath, fs_stat):
+    '''
+    Upload the blocks of a file that differ from the copy on the fs mount,
+    and truncate it to the size of the local copy.
+
+    Returns:
+      True if the delta has been propagated, False if the whole file has to
+      be copied.
+    '''
+
+    size = os.lstat(cachepath).st_size
+    if size < self._delta.threshold:
+      return False
+
+    reference = self._delta.loadSignatures(fusepath, fs_stat)
+
+    if reference is None:
+      self._debug('Computing signatures of %s on fs.' % fusepath)
+
+      try:
+        reference = self._delta.signatures(tsumufs.fsPathOf(fusepath))
+      except (IOError, OSError), e:
+        self._debug('Unable to read %s on fs (%s) -- copying the whole file.'
+                    % (fusepath, str(e)))
+        return False
+
+    ranges, signatures = self._delta.changedRanges(cachepath, reference)
+
+    source = os.open(cachepath, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+    try:
+      for start, end in ranges:
+        for chunkstart, chunkend in self._alignedChunks(start, end):
+          os.lseek(source, chunkstart, 0)
+          tsumufs.fsMount.writeFileRegion(fusepath, chunkstart, chunkend,
+                                          os.read(source, chunkend - chunkstart))
+
+    finally:
+      os.close(source)
+
+    if size != fs_stat.st_size:
+      tsumufs.fsMount.truncateFile(fusepath, size)
+
+    self._delta.saveSignatures(fusepath, tsumufs.fsMount.lstat(fusepath),
+                               signatures)
+
+    return True
+
   def _propagateLink(self, item, change):
     # TODO(jtg): Add in hardlink support
 
@@ -155,13 +230,103 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
     # TODO(conflicts): Conflict if the file type or inode have changed
     fusepath = item.filename
 
-    if item.file_type != 'dir':
-      tsumufs.fsMount.unlink(fusepath)
-    else:
-      tsumufs.fsMount.rmdir(fusepath)
+    try:
+      if item.file_type != 'dir':
+        tsumufs.fsMount.unlink(fusepath)
+        self._delta.removeSignatures(fusepath)
+      else:
+        tsumufs.fsMount.rmdir(fusepath)
+
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+      # Already propagated before a crash, or removed on fs.
+      self._debug('%s already removed from fs.' % fusepath)
 
     return False
 
+  def _propagateRmtree(self, item, change):
+    # The files added to the tree on fs since it was removed locally are kept,
+    # moved to the conflict dir.
+    try:
+      for fusepath in self._unknownEntries(item.filename,
+                                           set(item.unlinked or [])):
+        self._moveToConflictDir(fusepath)
+
+      tsumufs.fsMount.rmtree(item.filename)
+
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+      self._debug('%s already removed from fs.' % item.filename)
+
+    return False
+
+  def _unknownEntries(self, fusepath, known):
+    '''
+    Return the paths of the entries of the tree fusepath on the fs mount that
+    are not in known, without descending in the unknown directories.
+    '''
+
+    fspath = tsumufs.fsPathOf(fusepath)
+    unknown = []
+
+    def onerror(e):
+      raise e
+
+    for dirpath, dirnames, filenames in os.walk(fspath, onerror=onerror):
+      dirfusepath = fusepath + dirpath[len(fspath):]
+
+      for filename in filenames:
+        if os.path.join(dirfusepath, filename) not in known:
+          unknown.append(os.path.join(dirfusepath, filename))
+
+      # Symlinks to directories are listed along with the directories, and
+      # not descended into.
+      for dirname in dirnames[:]:
+        if os.path.join(dirfusepath, dirname) not in known:
+          unknown.append(os.path.join(dirfusepath, dirname))
+          dirnames.remove(dirname)
+
+    return unknown
+
+  def _moveToConflictDir(self, fusepath):
+    '''
+    Move fusepath to the conflict dir on the fs mount, under a name that is
+    not used yet.
+    '''
+
+    try:
+      tsumufs.fsMount.lstat(tsumufs.conflictDir)
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+      self._debug('Conflict dir missing on fs -- creating.')
+      tsumufs.fsMount.mkdir(tsumufs.conflictDir, 0700)
+
+    conflictpath = os.path.join(tsumufs.conflictDir,
+                                fusepath[1:].replace('/', '-'))
+    target = conflictpath
+    suffix = 0
+
+    while True:
+      try:
+        tsumufs.fsMount.lstat(target)
+      except OSError, e:
+        if e.errno != errno.ENOENT:
+          raise
+        break
+
+      suffix += 1
+      target = '%s.%d' % (conflictpath, suffix)
+
+    self._debug('%s was added to a removed tree -- moving it to %s.'
+                % (fusepath, target))
+    tsumufs.fsMount.rename(fusepath, target)
+
   def _propagateChange(self, item, change):
     # Rules:
     #   1. On conflict fs always wins.
@@ -196,55 +361,88 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
       self._debug('File type has completely changed -- conflicted.')
       return True
 
-    else:
-      # Iterate over each region, and verify the changes
-      for region in change.getDataChanges():
-        self._debug('Reading region %s,%s' % (region.start, region.end))
-        data = tsumufs.fsMount.readFileRegion(fusepath,
-                                              region.start,
-                                              region.end)
-
-        if len(data) < region.end - region.start:
-          data += '\x00' * ((region.end - region.start) - len(data))
-
-        if region.data != data:
-          self._debug('Region has changed -- entire changeset conflicted.')
-          self._debug('Data read was %s' % repr(data))
-          self._debug('Wanted %s' % repr(region.data))
-          return True
-
-    self._debug('No conflicts detected.')
-
-    # propagate changes
-    for region in change.getDataChanges():
-      data = tsumufs.cacheManager.readFile(fusepath,
-                                           region.start,
-                                           region.end - region.start,
-                                           os.O_RDONLY)
-
-      # Pad the region with nulls if we get a short read (EOF before the end of
-      # the real file. It means we ran into a truncate issue and that the file
-      # is shorter than it was originally -- we'll propagate the truncate down
-      # the line.
-      if len(data) < region.end - region.start:
-        data += '\x00' * ((region.end - region.start) - len(data))
-
-      self._debug('Writing to %s at [%d-%d] %s'
-                  % (fusepath, region.start,
-                     region.end, repr(data)))
+    # Sort the regions and group the adjacent ones, to propagate them with a
+    # single pass over the file.
+    spans = self._coalesceRegions(change.getDataChanges())
 
-      try:
+    # Read the data from the snapshot of the file taken by the synclog.
+    source = os.open(item.snapshot or tsumufs.cachePathOf(fusepath),
+                     os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+
+    try:
+      cache_size = os.fstat(source).st_size
+
+      if spans:
+        try:
           target = tsumufs.fsMount.open(fusepath, os.O_RDWR | os.O_BINARY)
-      except AttributeError, e:
+        except AttributeError, e:
           target = tsumufs.fsMount.open(fusepath, os.O_RDWR)
 
-      target.seek(region.start)
-      target.write(data)
-      target.close()
+        try:
+          # Verify that the regions on fs still match the checksums of the
+          # data they had when the changes were made.
+          for start, end, regions in spans:
+            self._debug('Reading span %s,%s' % (start, end))
+            data = self._readChunks(target.read, target.seek, start, end)
+
+            for region in regions:
+              current = data[region.start - start:region.end - start]
+
+              if dataregion.checksum(current) == region.getChecksum():
+                continue
+
+              # The change may have been propagated already, before a crash.
+              if current == self._readChunks(
+                  lambda length: os.read(source, length),
+                  lambda offset: os.lseek(source, offset, 0),
+                  region.start, region.end):
+                continue
+
+              self._debug('Region [%d-%d] has changed -- entire changeset '
+                          'conflicted.' % (region.start, region.end))
+              return True
+
+          self._debug('No conflicts detected.')
+
+          # propagate changes
+          for start, end, regions in spans:
+            self._debug('Writing to %s at [%d-%d]' % (fusepath, start, end))
+
+            target.seek(start)
+            for chunkstart, chunkend in self._alignedChunks(start, end):
+              os.lseek(source, chunkstart, 0)
+              data = os.read(source, chunkend - chunkstart)
+
+              # Pad the region with nulls if we get a short read (EOF before
+              # the end of the real file. It means we ran into a truncate issue
+              # and that the file is shorter than it was originally -- we'll
+              # propagate the truncate down the line.
+              if len(data) < chunkend - chunkstart:
+                data += '\x00' * ((chunkend - chunkstart) - len(data))
+
+              target.write(data)
+
+        finally:
+          target.close()
+
+    finally:
+      os.close(source)
 
     # Propagate truncations
-    if (cache_stat.st_size < fs_stat.st_size):
-      tsumufs.fsMount.ftruncate(fusepath, cache_stat.st_size)
+    if (cache_size < fs_stat.st_size):
+      tsumufs.fsMount.ftruncate(fusepath, cache_size)
+
+    # Keep the signatures of the file up to date for the next delta.
+    if cache_size >= self._delta.threshold:
+      signatures = self._delta.loadSignatures(fusepath, fs_stat)
+
+      if signatures is not None:
+        signatures = self._delta.updateSignatures(
+          signatures, item.snapshot or tsumufs.cachePathOf(fusepath),
+          [ (start, end) for start, end, regions in spans ])
+
+        self._delta.saveSignatures(fusepath, tsumufs.fsMount.lstat(fusepath),
+                                   signatures)
 
     # Propagate metadatas
     modechange, uidchange, gidchange, timeschange, acls, xattrschange = change.getMetaDataChanges()
@@ -268,9 +466,72 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
 
     return False
 
+  def _coalesceRegions(self, regions):
+    '''
+    Sort the data regions by offset and group the overlapping or adjacent
+    ones.
+
+    Returns:
+      A list of [start, end, regions] lists.
+    '''
+
+    spans = []
+
+    for region in sorted(regions, key=lambda r: (r.start, r.end)):
+      if spans and region.start <= spans[-1][1]:
+        spans[-1][1] = max(spans[-1][1], region.end)
+        spans[-1][2].append(region)
+      else:
+        spans.append([region.start, region.end, [region]])
+
+    return spans
+
+  def _alignedChunks(self, start, end):
+    '''
+    Split the range [start, end) in aligned chunks, sized after the link to
+    the fs mount.
+    '''
+
+    chunkSize = tsumufs.linkEstimator.chunkSize()
+
+    while start < end:
+      chunkend = min(end, (start / chunkSize + 1) * chunkSize)
+      yield start, chunkend
+      start = chunkend
+
+  def _readChunks(self, read, seek, start, end):
+    '''
+    Read the range [start, end) of a file by aligned chunks, padding the data
+    read with nulls past the end of the file.
+    '''
+
+    chunks = []
+    seek(start)
+
+    for chunkstart, chunkend in self._alignedChunks(start, end):
+      data = read(chunkend - chunkstart)
+      chunks.append(data)
+
+      if len(data) < chunkend - chunkstart:
+        break
+
+    data = ''.join(chunks)
+    return data + '\x00' * ((end - start) - len(data))
+
   def _propagateRename(self, item, change):
     # TODO(conflicts): Verify inode numbers here
-    tsumufs.fsMount.rename(item.old_fname, item.new_fname)
+    try:
+      tsumufs.fsMount.rename(item.old_fname, item.new_fname)
+
+    except OSError, e:
+      if e.errno != errno.ENOENT:
+        raise
+
+      # Already propagated before a crash.
+      tsumufs.fsMount.lstat(item.new_fname)
+      self._debug('%s already renamed on fs.' % item.old_fname)
+
+    self._delta.renameSignatures(item.old_fname, item.new_fname)
 
     return False
 
@@ -454,6 +715,7 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
     change_types = { 'new': self._propagateNew,
                      'link': self._propagateLink,
                      'unlink': self._propagateUnlink,
+                     'rmtree': self._propagateRmtree,
                      'change': self._propagateChange,
                      'rename': self._propagateRename }
 
@@ -493,6 +755,10 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
         while (not tsumufs.fsMount.fsMountCheckOK()
                and not tsumufs.unmounted.isSet()):
           self._debug('FS unavailable')
+          self._disconnected = True
+
+          # Keep the synclog small while offline.
+          tsumufs.syncLog.compactIfDue()
 
           if not tsumufs.forceDisconnect.isSet():
             self._debug('Trying to mount fs')
@@ -505,6 +771,11 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
                          'Not attempting mount.'))
             time.sleep(5)
 
+        if self._disconnected and tsumufs.fsAvailable.isSet():
+          self._debug('Reconnected, revalidating the cache.')
+          self._disconnected = False
+          tsumufs.cacheRefresher.revalidate()
+
         while (tsumufs.syncPause.isSet()
                and not tsumufs.unmounted.isSet()):
           self._debug('User requested sync pause. Sleeping.')
@@ -576,6 +847,9 @@ class SyncThread(tsumufs.Debuggable, threading.Thread):
       else:
         self._debug('fs unmount complete.')
 
+      self._debug('Stopping the signature workers.')
+      self._delta.close()
+
       self._debug('Syncing changes to disk.')
 
       try:
@@ -0,0 +1,193 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import time
+import threading
+
+import tsumufs
+
+
+def isBackgroundThread():
+  '''
+  Check whether the current thread transfers data in the background, ie. if
+  it is not serving a FUSE request. Such threads set the backgroundTransfers
+  attribute.
+  '''
+
+  return getattr(threading.currentThread(), 'backgroundTransfers', False)
+
+
+class TokenBucket(tsumufs.Debuggable):
+  '''
+  Token bucket limiting the rate of data transfers, in bytes per second.
+
+  Transfers from the foreground are never delayed by the ones from the
+  background: background transfers wait for the bucket to be refilled and
+  for the pending foreground transfers to complete, while foreground
+  transfers take their tokens right away.
+  '''
+
+  rate  = 0                     # In bytes per second, 0 for unlimited.
+  burst = 0                     # Maximum amount of tokens saved.
+
+  _tokens     = 0
+  _stamp      = 0
+  _foreground = 0               # Number of foreground transfers pending.
+
+  def __init__(self, rate=0, burst=None):
+    self._condition = threading.Condition()
+    self.setRate(rate, burst)
+
+  def setRate(self, rate, burst=None):
+    '''
+    Change the rate of the bucket. A rate of 0 disables the limitation.
+    '''
+
+    self._condition.acquire()
+
+    try:
+      self.rate = max(0, int(rate))
+      self.burst = burst or max(self.rate / 4, 64 * 1024)
+      self._tokens = self.burst
+      self._stamp = time.time()
+
+      self._condition.notifyAll()
+
+    finally:
+      self._condition.release()
+
+  def _refill(self):
+    now = time.time()
+    self._tokens = min(self.burst,
+                       self._tokens + (now - self._stamp) * self.rate)
+    self._stamp = now
+
+  def consume(self, count, foreground=None):
+    '''
+    Take count tokens from the bucket, sleeping as long as required to
+    respect the rate. Whether the transfer is run in the foreground is
+    guessed from the current thread if not given.
+
+    Returns:
+      None
+
+    Raises:
+      Nothing
+    '''
+
+    if not self.rate or count <= 0:
+      return
+
+    if foreground is None:
+      foreground = not isBackgroundThread()
+
+    self._condition.acquire()
+
+    try:
+      if foreground:
+        self._foreground += 1
+
+      else:
+        while self.rate:
+          self._refill()
+
+          if not self._foreground and self._tokens >= 0:
+            break
+
+          if self._foreground:
+            self._condition.wait(0.1)
+          else:
+            self._condition.wait(-self._tokens / float(self.rate))
+
+      if self.rate:
+        self._refill()
+        self._tokens -= count
+        delay = max(0, -self._tokens / float(self.rate))
+      else:
+        delay = 0
+
+    finally:
+      self._condition.release()
+
+    try:
+      if delay:
+        time.sleep(delay)
+
+    finally:
+      if foreground:
+        self._condition.acquire()
+
+        try:
+          self._foreground -= 1
+          self._condition.notifyAll()
+        finally:
+          self._condition.release()
+
+
+class ThrottledFile(object):
+  '''
+  File object proxy limiting the rate of reads and writes with token
+  buckets.
+  '''
+
+  _chunkSize = 64 * 1024
+
+  def __init__(self, fp, readBucket=None, writeBucket=None):
+    self._fp = fp
+    self._readBucket = readBucket
+    self._writeBucket = writeBucket
+
+  def __getattr__(self, name):
+    return getattr(self._fp, name)
+
+  def __iter__(self):
+    return iter(self.readline, '')
+
+  def read(self, size=-1):
+    if not self._readBucket or not self._readBucket.rate:
+      return self._fp.read(size)
+
+    # Read by chunks, so that the bucket paces the transfer.
+    chunks = []
+
+    while size < 0 or size > 0:
+      if size < 0:
+        length = self._chunkSize
+      else:
+        length = min(size, self._chunkSize)
+
+      self._readBucket.consume(length)
+
+      data = self._fp.read(length)
+      if not data:
+        break
+
+      chunks.append(data)
+      if size > 0:
+        size -= len(data)
+
+    return ''.join(chunks)
+
+  def write(self, data):
+    if not self._writeBucket or not self._writeBucket.rate:
+      return self._fp.write(data)
+
+    for offset in xrange(0, len(data), self._chunkSize):
+      chunk = data[offset:offset + self._chunkSize]
+      self._writeBucket.consume(len(chunk))
+      self._fp.write(chunk)
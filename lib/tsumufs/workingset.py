@@ -0,0 +1,158 @@
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''TsumuFS is a disconnected, offline caching filesystem.'''
+
+import os
+import time
+import cPickle
+import threading
+
+import tsumufs
+
+
+class WorkingSet(tsumufs.Debuggable):
+  '''
+  Bounded record of the files read, kept across mounts, to prefetch the ones
+  used the most at the next mount or reconnection. Stats are not recorded,
+  so that listing large directories does not flood the record.
+
+  Each file has a score, incremented on each read by one plus the number of
+  MiB read, and halved every _halfLife seconds. Once the record holds
+  more than _maxEntries files, the ones with the lowest scores are dropped.
+  '''
+
+  _maxEntries = 10000
+  _halfLife   = 3 * 24 * 3600   # In seconds.
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._entries = {}          # A hash of paths to lists of the score, the
+                                # time of the last access and the number of
+                                # bytes read.
+    self._dirty = False
+
+  def _decayed(self, entry, now):
+    return entry[0] * 0.5 ** ((now - entry[1]) / self._halfLife)
+
+  def noteAccess(self, fusepath, size=0):
+    '''
+    Account for an access to fusepath, reading size bytes.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      now = time.time()
+      entry = self._entries.get(fusepath)
+
+      if entry is None:
+        entry = self._entries[fusepath] = [0.0, now, 0]
+
+      entry[0] = self._decayed(entry, now) + 1 + size / (1024 * 1024.0)
+      entry[1] = now
+      entry[2] += size
+
+      self._dirty = True
+
+      if len(self._entries) > self._maxEntries:
+        self._evict(now)
+
+    finally:
+      self._lock.release()
+
+  def _evict(self, now):
+    # Drop a tenth of the entries at once, so that the sort is amortized.
+    scores = [ (self._decayed(entry, now), fusepath)
+               for fusepath, entry in self._entries.iteritems() ]
+    scores.sort()
+
+    for score, fusepath in scores[:len(scores) - self._maxEntries * 9 / 10]:
+      del self._entries[fusepath]
+
+  def top(self, count):
+    '''
+    Return the count files with the best scores, best first.
+
+    Returns:
+      A list of (fusepath, bytes read) tuples.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      now = time.time()
+      scores = [ (self._decayed(entry, now), fusepath, entry[2])
+                 for fusepath, entry in self._entries.iteritems() ]
+
+    finally:
+      self._lock.release()
+
+    scores.sort()
+    scores.reverse()
+
+    return [ (fusepath, size) for score, fusepath, size in scores[:count] ]
+
+  def load(self, path):
+    '''
+    Load the record saved by a previous mount, if any.
+    '''
+
+    try:
+      fp = open(path, 'rb')
+
+      try:
+        entries = cPickle.load(fp)
+      finally:
+        fp.close()
+
+    except (IOError, OSError, EOFError, ValueError, cPickle.UnpicklingError):
+      return
+
+    self._lock.acquire()
+
+    try:
+      self._entries = entries
+      self._dirty = False
+
+    finally:
+      self._lock.release()
+
+    self._debug('Loaded a working set of %d files.' % len(entries))
+
+  def save(self, path):
+    '''
+    Save the record, if it changed since the last save.
+    '''
+
+    self._lock.acquire()
+
+    try:
+      if not self._dirty:
+        return
+
+      fp = open(path + '.tmp', 'wb')
+
+      try:
+        cPickle.dump(self._entries, fp, cPickle.HIGHEST_PROTOCOL)
+      finally:
+        fp.close()
+
+      os.rename(path + '.tmp', path)
+      self._dirty = False
+
+    finally:
+      self._lock.release()
@@ -0,0 +1,81 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the CachedRevisionIndex.'''
+
+import sys
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.cachedrevisionindex as cachedrevisionindex
+
+
+class FakeStore(object):
+  def __init__(self, revisions):
+    self.revisions = revisions
+
+  def items(self):
+    return [ (fileid, revision, mtime)
+             for fileid, (revision, mtime) in self.revisions.items() ]
+
+  def set(self, fileid, revision, mtime):
+    self.revisions[fileid] = (revision, mtime)
+
+  def remove(self, fileid):
+    return self.revisions.pop(fileid)
+
+  def commit(self):
+    pass
+
+
+class CachedRevisionIndexCheck(unittest.TestCase):
+  def setUp(self):
+    self.store = FakeStore({ u'id': (u'1-abc', 10.0) })
+    self.index = cachedrevisionindex.CachedRevisionIndex(self.store)
+
+  def testLoad(self):
+    self.assertEqual(1, len(self.index))
+    self.assertEqual(('1-abc', 10.0), self.index.get('id'))
+    self.assert_(isinstance(self.index.get('id')[0], str))
+
+  def testWriteThrough(self):
+    self.index.set('id', '2-def', 20.0)
+    self.index.set('other', '1-ghi', 30.0)
+
+    self.assertEqual(('2-def', 20.0), self.index.get('id'))
+    self.assertEqual(('2-def', 20.0), self.store.revisions['id'])
+    self.assertEqual(('1-ghi', 30.0), self.store.revisions['other'])
+
+  def testRemove(self):
+    self.assertEqual(('1-abc', 10.0), self.index.remove('id'))
+    self.failIf('id' in self.index)
+    self.failIf('id' in self.store.revisions)
+
+    self.assertRaises(KeyError, self.index.get, 'id')
+    self.assertRaises(KeyError, self.index.remove, 'id')
+
+  def testSlots(self):
+    record = cachedrevisionindex.CachedRevision('1-abc', 10.0)
+    self.failIf(hasattr(record, '__dict__'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,200 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the CacheFill.'''
+
+import os
+import sys
+import errno
+import shutil
+import tempfile
+import threading
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.cachefill as cachefill
+
+tsumufs = cachefill.tsumufs
+
+
+class FakeStats(object):
+  st_mtime = 1234
+
+
+class FakeDocument(object):
+  id    = 'fileid'
+  rev   = '1-abc'
+  stats = FakeStats()
+
+
+class FakeSource(object):
+  '''
+  Source file of the fs mount, serving the data in chunks of chunkSize
+  bytes. Reads block while the gate is closed, or fail with error.
+  '''
+
+  def __init__(self, data, gate, error=None):
+    self._data = data
+    self._gate = gate
+    self._error = error
+
+  def read(self, size):
+    self._gate.wait()
+
+    if self._error:
+      raise self._error
+
+    buf, self._data = self._data[:size], self._data[size:]
+    return buf
+
+  def close(self):
+    pass
+
+
+class FakeMount(object):
+  error = None
+
+  def __init__(self, data):
+    self.data = data
+    self.gate = threading.Event()
+    self.gate.set()
+
+  def open(self, fusepath, flags):
+    return FakeSource(self.data, self.gate, self.error)
+
+
+class FakeLinkEstimator(object):
+  def concurrency(self):
+    return 2
+
+  def chunkSize(self):
+    return 4
+
+
+class FakeOverlay(object):
+  def __init__(self):
+    self.revisions = {}
+
+  def setCachedRevision(self, fileid, revision, mtime):
+    self.revisions[fileid] = (revision, mtime)
+
+
+class CacheFillCheck(unittest.TestCase):
+  def setUp(self):
+    self.saved = (getattr(tsumufs, 'cachePoint', None),
+                  getattr(tsumufs, 'fsMount', None),
+                  getattr(tsumufs, 'fsOverlay', None),
+                  getattr(tsumufs, 'fsAvailable', None),
+                  getattr(tsumufs, 'linkEstimator', None))
+
+    tsumufs.cachePoint = tempfile.mkdtemp()
+    tsumufs.fsMount = FakeMount('0123456789')
+    tsumufs.fsOverlay = FakeOverlay()
+    tsumufs.fsAvailable = threading.Event()
+    tsumufs.fsAvailable.set()
+    tsumufs.linkEstimator = FakeLinkEstimator()
+
+    self.finished = []
+
+  def tearDown(self):
+    shutil.rmtree(tsumufs.cachePoint)
+
+    (tsumufs.cachePoint, tsumufs.fsMount, tsumufs.fsOverlay,
+     tsumufs.fsAvailable, tsumufs.linkEstimator) = self.saved
+
+  def _startFill(self):
+    fill = cachefill.CacheFill('/file', FakeDocument(),
+                               callback=self.finished.append)
+    fill.start()
+
+    return fill
+
+  def testCompletion(self):
+    fill = self._startFill()
+    fill.wait()
+
+    self.assertEqual('0123456789',
+                     open(os.path.join(tsumufs.cachePoint, 'file')).read())
+    self.failIf(os.path.exists(fill.tmppath))
+    self.assertEqual(10, fill.size)
+    self.assertEqual({ 'fileid': ('1-abc', 1234) },
+                     tsumufs.fsOverlay.revisions)
+    self.assertEqual([ fill ], self.finished)
+    self.assertEqual(None, fill.read(0, 4))
+
+  def testCancellation(self):
+    tsumufs.fsMount.gate.clear()
+
+    # Cancel the copy while it is blocked reading from the fs mount.
+    fill = self._startFill()
+    fill.cancelled = True
+    tsumufs.fsMount.gate.set()
+
+    fill.cancel()
+
+    self.assert_(fill.done)
+    self.failIf(os.path.exists(os.path.join(tsumufs.cachePoint, 'file')))
+    self.failIf(os.path.exists(fill.tmppath))
+    self.assertEqual({}, tsumufs.fsOverlay.revisions)
+    self.assertEqual([ fill ], self.finished)
+
+  def testError(self):
+    tsumufs.fsMount.error = IOError(errno.EIO, 'Input/output error')
+
+    fill = self._startFill()
+
+    self.assertRaises(IOError, fill.wait)
+    self.assertRaises(IOError, fill.read, 0, 4)
+    self.failIf(os.path.exists(os.path.join(tsumufs.cachePoint, 'file')))
+    self.failIf(os.path.exists(fill.tmppath))
+    self.failIf(tsumufs.fsAvailable.isSet())
+    self.assertEqual([ fill ], self.finished)
+
+  def testSlotPriority(self):
+    background = cachefill.CacheFill('/background', FakeDocument(),
+                                     background=True)
+    foreground = cachefill.CacheFill('/foreground', FakeDocument())
+
+    self.assertEqual(0, cachefill.CacheFill._running)
+
+    try:
+      # A slot is kept for the fills somebody waits for.
+      cachefill.CacheFill._running = 1
+      self.failIf(background._mayStart())
+      self.assert_(foreground._mayStart())
+
+      # The waiting fills somebody waits for go first.
+      cachefill.CacheFill._running = 0
+      self.assert_(background._mayStart())
+
+      cachefill.CacheFill._waiting.add(foreground)
+      self.failIf(background._mayStart())
+
+      background.backgroundTransfers = False
+      self.assert_(background._mayStart())
+
+    finally:
+      cachefill.CacheFill._running = 0
+      cachefill.CacheFill._waiting.clear()
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -19,13 +19,18 @@
 
 '''Unit tests for the DataRegion class.'''
 
+import os as real_os
 import sys
+import time
+import shutil
+import tempfile
 
 sys.path.append('../lib')
 sys.path.append('lib')
 
 import unittest
 import tsumufs
+import tsumufs.cachemanager as cachemanager
 
 import os_mock as os
 
@@ -92,5 +97,207 @@ class CacheOpcodeCheck(unittest.TestCase):
     tsumufs.cachePoint    = '/tmp/tsumufs-cachepoint'
 
 
+class FakeWorkingSet(object):
+  def __init__(self):
+    self.accessed = []
+
+  def noteAccess(self, fusepath, size=0):
+    self.accessed.append(fusepath)
+
+
+class PrimedStatsCheck(unittest.TestCase):
+  def setUp(self):
+    self.attrTimeout = getattr(tsumufs, 'attrTimeout', None)
+    self.workingSet = getattr(tsumufs, 'workingSet', None)
+    tsumufs.attrTimeout = 1
+    tsumufs.workingSet = FakeWorkingSet()
+
+    self.manager = cachemanager.CacheManager.__new__(cachemanager.CacheManager)
+    self.manager._primedStats = {}
+    self.manager._fileLocks = {}
+
+  def tearDown(self):
+    tsumufs.attrTimeout = self.attrTimeout
+    tsumufs.workingSet = self.workingSet
+
+  def _list(self, dirpath, *filenames):
+    stats = self.manager._primeStats(dirpath)
+
+    for filename in filenames:
+      stats[filename] = 'stats of %s/%s' % (dirpath, filename)
+
+  def testPrimed(self):
+    self._list('/d', 'f')
+
+    self.assertEqual('stats of /d/f', self.manager.statFile('/d/f'))
+    self.assertEqual(None, self.manager._primedStat('/d/g'))
+
+    # Stats are not recorded in the working set.
+    self.assertEqual([], tsumufs.workingSet.accessed)
+    self.assertEqual(None, self.manager._primedStat('/e/f'))
+
+  def testExpiry(self):
+    self._list('/d', 'f')
+    self._list('/e', 'f')
+
+    stamp, stats = self.manager._primedStats['/d']
+    self.manager._primedStats['/d'] = (stamp - 2, stats)
+
+    self.assertEqual(None, self.manager._primedStat('/d/f'))
+    self.assertFalse('/d' in self.manager._primedStats)
+    self.assertEqual('stats of /e/f', self.manager._primedStat('/e/f'))
+
+    # Listing an other directory drops the expired listings as well.
+    stamp, stats = self.manager._primedStats['/e']
+    self.manager._primedStats['/e'] = (stamp - 2, stats)
+
+    self._list('/g', 'f')
+    self.assertEqual([ '/g' ], self.manager._primedStats.keys())
+
+  def testUnlock(self):
+    self._list('/d', 'f', 'g')
+    self._list('/d/f', 'h')
+    self._list('/d/f/h', 'i')
+    self._list('/d/fg', 'j')
+
+    self.manager.lockFile('/d/f')
+    self.manager.unlockFile('/d/f')
+
+    self.assertEqual(None, self.manager._primedStat('/d/f'))
+    self.assertEqual(None, self.manager._primedStat('/d/f/h'))
+    self.assertEqual(None, self.manager._primedStat('/d/f/h/i'))
+
+    self.assertEqual('stats of /d/g', self.manager._primedStat('/d/g'))
+    self.assertEqual('stats of /d/fg/j', self.manager._primedStat('/d/fg/j'))
+
+
+class FakeDoc(object):
+  def __init__(self, filename):
+    self.filename = filename
+
+
+class FakeOverlay(object):
+  '''
+  Database of the files, populated from the fs mount.
+  '''
+
+  def __init__(self):
+    self.filenames = []
+    self.listed = 0
+
+  def listdir(self, fusepath):
+    self.listed += 1
+    return [ FakeDoc(filename) for filename in self.filenames ]
+
+  def populate(self, fusepath):
+    self.filenames.append(real_os.path.basename(fusepath))
+
+
+class CacheDirCheck(unittest.TestCase):
+  _saved = ('fsPathOf', 'cachePathOf', 'fsOverlay', 'populateDb')
+
+  def setUp(self):
+    self.saved = [ getattr(tsumufs, name, None) for name in self._saved ]
+
+    self.fsdir = tempfile.mkdtemp()
+    self.cachedir = tempfile.mkdtemp()
+    self.overlay = FakeOverlay()
+
+    tsumufs.fsPathOf = lambda fusepath: self.fsdir + fusepath
+    tsumufs.cachePathOf = lambda fusepath: self.cachedir + fusepath
+    tsumufs.fsOverlay = self.overlay
+    tsumufs.populateDb = True
+
+    self.manager = cachemanager.CacheManager.__new__(cachemanager.CacheManager)
+    self.manager._reconciledDirs = {}
+    self.manager._primedStats = {}
+    self.manager._fileLocks = {}
+
+    real_os.mkdir(self.fsdir + '/d')
+    open(self.fsdir + '/d/a', 'w').close()
+
+  def tearDown(self):
+    for name, value in zip(self._saved, self.saved):
+      setattr(tsumufs, name, value)
+
+    shutil.rmtree(self.fsdir)
+    shutil.rmtree(self.cachedir)
+
+  def testUnchanged(self):
+    self.manager._cacheDir('/d')
+    self.assertEqual([ 'a' ], self.overlay.filenames)
+
+    self.manager._cacheDir('/d')
+    self.assertEqual(1, self.overlay.listed)
+
+  def testChanged(self):
+    self.manager._cacheDir('/d')
+
+    open(self.fsdir + '/d/b', 'w').close()
+    real_os.utime(self.fsdir + '/d', (1, 1))
+
+    self.manager._cacheDir('/d')
+    self.assertEqual(2, self.overlay.listed)
+    self.assertEqual([ 'a', 'b' ], self.overlay.filenames)
+
+
+class SnapshotCheck(unittest.TestCase):
+  _saved = ('cachePathOf', 'snapshotDir')
+
+  def setUp(self):
+    self.saved = [ getattr(tsumufs, name, None) for name in self._saved ]
+
+    self.cachedir = tempfile.mkdtemp()
+    self.snapshotdir = tempfile.mkdtemp()
+
+    tsumufs.cachePathOf = lambda fusepath: self.cachedir + fusepath
+    tsumufs.snapshotDir = self.snapshotdir
+
+    self.manager = cachemanager.CacheManager.__new__(cachemanager.CacheManager)
+    self.manager._reflinkSupported = False
+    self.manager._linkedSnapshots = {}
+    self.manager._primedStats = {}
+    self.manager._fileLocks = {}
+
+    for filename in ('a', 'b'):
+      fp = open(self.cachedir + '/' + filename, 'w')
+      fp.write(filename)
+      fp.close()
+
+  def tearDown(self):
+    for name, value in zip(self._saved, self.saved):
+      setattr(tsumufs, name, value)
+
+    shutil.rmtree(self.cachedir)
+    shutil.rmtree(self.snapshotdir)
+
+  def _inode(self, path):
+    return real_os.lstat(path).st_ino
+
+  def testBreakLink(self):
+    snapshot = self.manager.snapshotFile('/a')
+    self.assertEqual(self._inode(snapshot), self._inode(self.cachedir + '/a'))
+
+    self.manager._breakSnapshotLink('/a')
+    self.assertNotEqual(self._inode(snapshot),
+                        self._inode(self.cachedir + '/a'))
+    self.assertEqual('a', open(snapshot).read())
+
+    self.manager.releaseSnapshot(snapshot)
+    self.assertEqual({}, self.manager._linkedSnapshots)
+
+  def testOtherLinks(self):
+    # A file hardlinked by the user keeps its links while an other file is
+    # snapshotted.
+    real_os.link(self.cachedir + '/b', self.cachedir + '/c')
+    snapshot = self.manager.snapshotFile('/a')
+
+    self.manager._breakSnapshotLink('/b')
+    self.assertEqual(self._inode(self.cachedir + '/b'),
+                     self._inode(self.cachedir + '/c'))
+
+    self.manager.releaseSnapshot(snapshot)
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -0,0 +1,93 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the queue of the CacheRefresher.'''
+
+import sys
+import threading
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.cacherefresher as cacherefresher
+
+tsumufs = cacherefresher.tsumufs
+
+
+class FakeWorkingSet(object):
+  def __init__(self, *files):
+    self.files = files
+
+  def top(self, count):
+    return self.files[:count]
+
+
+class CacheRefresherCheck(unittest.TestCase):
+  _saved = ('fsAvailable', 'workingSet', 'prefetchCount')
+
+  def setUp(self):
+    self.saved = [ getattr(tsumufs, name, None) for name in self._saved ]
+
+    tsumufs.fsAvailable = threading.Event()
+    tsumufs.fsAvailable.set()
+
+    self.refresher = cacherefresher.CacheRefresher()
+
+  def tearDown(self):
+    for name, value in zip(self._saved, self.saved):
+      setattr(tsumufs, name, value)
+
+  def testOrder(self):
+    self.refresher.refresh('/a')
+    self.refresher.refresh('/b')
+    self.refresher.refresh('/a')
+
+    self.assertEqual((False, '/a'), self.refresher._next())
+    self.assertEqual((False, '/b'), self.refresher._next())
+
+  def testRevalidateFirst(self):
+    self.refresher.refresh('/a')
+    self.refresher.revalidate()
+
+    self.assertEqual((True, None), self.refresher._next())
+    self.assertEqual((False, '/a'), self.refresher._next())
+
+  def testDisconnected(self):
+    self.refresher.refresh('/a')
+    tsumufs.fsAvailable.clear()
+
+    self.assertEqual((False, None), self.refresher._next())
+
+    tsumufs.fsAvailable.set()
+    self.assertEqual((False, '/a'), self.refresher._next())
+
+  def testPrefetch(self):
+    tsumufs.workingSet = FakeWorkingSet(('/a', 10), ('/b', 0), ('/cold', 0))
+    tsumufs.prefetchCount = 2
+
+    self.refresher._prefetchWorkingSet()
+
+    self.assertEqual((False, '/a'), self.refresher._next())
+    self.assertEqual((False, '/b'), self.refresher._next())
+    self.assertEqual([], self.refresher._queue)
+
+
+if __name__ == '__main__':
+  unittest.main()
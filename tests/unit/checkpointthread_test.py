@@ -0,0 +1,116 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the CheckpointThread.'''
+
+import sys
+import time
+import threading
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.checkpointthread as checkpointthread
+
+tsumufs = checkpointthread.tsumufs
+
+
+class FakeLog(object):
+  checkpoints = 0
+  delay = 0
+
+  def checkpoint(self):
+    time.sleep(self.delay)
+    self.checkpoints += 1
+
+
+class FakeWorkingSet(object):
+  saves = 0
+
+  def save(self, path):
+    self.saves += 1
+
+
+class CheckpointThreadCheck(unittest.TestCase):
+  def setUp(self):
+    self.saved = (getattr(tsumufs, 'syncLog', None),
+                  getattr(tsumufs, 'fsOverlay', None),
+                  getattr(tsumufs, 'unmounted', None),
+                  getattr(tsumufs, 'checkpointTimeout', None),
+                  getattr(tsumufs, 'workingSet', None),
+                  getattr(tsumufs, 'workingSetPath', None))
+
+    tsumufs.syncLog = FakeLog()
+    tsumufs.fsOverlay = FakeLog()
+    tsumufs.unmounted = threading.Event()
+    tsumufs.checkpointTimeout = 3600
+    tsumufs.workingSet = FakeWorkingSet()
+    tsumufs.workingSetPath = None
+
+    self.thread = checkpointthread.CheckpointThread()
+    self.thread.start()
+
+  def tearDown(self):
+    tsumufs.unmounted.set()
+    self.thread.join()
+
+    (tsumufs.syncLog, tsumufs.fsOverlay,
+     tsumufs.unmounted, tsumufs.checkpointTimeout,
+     tsumufs.workingSet, tsumufs.workingSetPath) = self.saved
+
+  def testRequest(self):
+    self.assert_(self.thread.requestCheckpoint(wait=True))
+    self.assertEqual(1, tsumufs.syncLog.checkpoints)
+    self.assertEqual(1, tsumufs.fsOverlay.checkpoints)
+    self.assertEqual(1, tsumufs.workingSet.saves)
+
+  def testSizeThreshold(self):
+    self.thread.noteWrite(self.thread._maxPendingWrites - 1)
+    self.assertEqual(0, tsumufs.syncLog.checkpoints)
+
+    self.thread.noteWrite()
+    self.assert_(self.thread.requestCheckpoint(wait=True))
+    self.assert_(tsumufs.syncLog.checkpoints >= 1)
+
+  def testGroupCommit(self):
+    tsumufs.syncLog.delay = 0.2
+    results = []
+
+    def fsync():
+      results.append(self.thread.requestCheckpoint(wait=True))
+
+    fsyncs = [ threading.Thread(target=fsync) for i in range(8) ]
+    for thread in fsyncs:
+      thread.start()
+    for thread in fsyncs:
+      thread.join()
+
+    self.assertEqual([True] * 8, results)
+    self.assert_(tsumufs.syncLog.checkpoints <= 2)
+
+  def testFinalCheckpoint(self):
+    tsumufs.unmounted.set()
+    self.thread.join()
+
+    self.assertEqual(1, tsumufs.syncLog.checkpoints)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,90 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the block signatures of the DeltaEngine.'''
+
+import os
+import sys
+import tempfile
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.deltaengine as deltaengine
+
+
+class SignaturesCheck(unittest.TestCase):
+  def setUp(self):
+    self.blockSize = 16
+    self.data = ''.join([ chr(i) for i in range(100) ])
+
+    fd, self.path = tempfile.mkstemp()
+    os.write(fd, self.data)
+    os.close(fd)
+
+  def tearDown(self):
+    os.unlink(self.path)
+
+  def _signaturesOf(self, data):
+    fp = open(self.path, 'wb')
+    fp.write(data)
+    fp.close()
+
+    return deltaengine.blockSignatures(self.path, 0, len(data),
+                                       self.blockSize)
+
+  def testBlockCount(self):
+    signatures = self._signaturesOf(self.data)
+    self.assertEqual(7, len(signatures))
+
+  def testRangeSignatures(self):
+    signatures = self._signaturesOf(self.data)
+    self.assertEqual(signatures[2:4],
+                     deltaengine.blockSignatures(self.path, 32, 64,
+                                                 self.blockSize))
+
+  def testUnchanged(self):
+    reference = self._signaturesOf(self.data)
+    signatures = self._signaturesOf(self.data)
+
+    self.assertEqual([], deltaengine.changedBlocks(signatures, reference))
+
+  def testChangedBlock(self):
+    reference = self._signaturesOf(self.data)
+    signatures = self._signaturesOf(self.data[:40] + 'x' + self.data[41:])
+
+    self.assertEqual([2], deltaengine.changedBlocks(signatures, reference))
+
+  def testAppended(self):
+    reference = self._signaturesOf(self.data)
+    signatures = self._signaturesOf(self.data + 'x' * 20)
+
+    self.assertEqual([6, 7], deltaengine.changedBlocks(signatures, reference))
+    self.assertEqual([[96, 120]],
+                     deltaengine.blocksToRanges([6, 7], self.blockSize, 120))
+
+  def testRanges(self):
+    self.assertEqual([[0, 16], [32, 64], [96, 100]],
+                     deltaengine.blocksToRanges([0, 2, 3, 6],
+                                                self.blockSize, 100))
+
+
+if __name__ == '__main__':
+  unittest.main()
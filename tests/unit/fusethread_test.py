@@ -0,0 +1,124 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the FuseThread.'''
+
+import sys
+import stat
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.fusethread as fusethread
+
+tsumufs = fusethread.tsumufs
+
+
+class FakeDoc(object):
+  def __init__(self, filename):
+    self.filename = filename
+    self.mode = stat.S_IFREG | 0644
+
+
+class FakeManager(object):
+  '''
+  Manager listing the files of its directories, which can change.
+  '''
+
+  def __init__(self, *filenames):
+    self.filenames = list(filenames)
+    self.listed = 0
+
+  def getDirents(self, path):
+    self.listed += 1
+
+    for filename in self.filenames:
+      yield FakeDoc(filename)
+
+
+class ReaddirCheck(unittest.TestCase):
+  def setUp(self):
+    self.saved = (getattr(tsumufs, 'getManager', None),
+                  getattr(tsumufs, 'viewsPoint', None))
+
+    self.manager = FakeManager('a', 'b', 'c')
+
+    tsumufs.getManager = lambda path: self.manager
+    tsumufs.viewsPoint = '/views'
+
+    self.thread = fusethread.FuseThread.__new__(fusethread.FuseThread)
+    self.thread._listings = {}
+
+  def tearDown(self):
+    tsumufs.getManager, tsumufs.viewsPoint = self.saved
+
+  def _readdir(self, offset, count=None):
+    '''
+    Read count entries at offset, like the kernel filling its buffer.
+    '''
+
+    dirents = []
+
+    for dirent in self.thread.readdir('/d', offset):
+      if count is not None and len(dirents) == count:
+        break
+
+      dirents.append(dirent)
+
+    return dirents
+
+  def testResume(self):
+    dirents = self._readdir(0, 3)
+    self.assertEqual([ '.', '..', 'a' ], [ d.name for d in dirents ])
+
+    # The directory changes while it is being listed.
+    self.manager.filenames.append('d')
+
+    dirents = self._readdir(dirents[-1].offset)
+    self.assertEqual([ 'b', 'c' ], [ d.name for d in dirents ])
+    self.assertEqual(1, self.manager.listed)
+
+    # The listing is kept until the call past its last entry.
+    self.assertEqual(1, len(self.thread._listings))
+
+    self.assertEqual([], self._readdir(dirents[-1].offset))
+    self.assertEqual({}, self.thread._listings)
+
+  def testExpired(self):
+    dirents = self._readdir(0, 3)
+    self.thread._listings.clear()
+
+    self.assertEqual([], self._readdir(dirents[-1].offset))
+    self.assertEqual(1, self.manager.listed)
+    self.assertEqual({}, self.thread._listings)
+
+  def testTimeout(self):
+    dirents = self._readdir(0, 3)
+
+    listing, = self.thread._listings.keys()
+    path, stamp, entries = self.thread._listings[listing]
+    self.thread._listings[listing] = (path, stamp - 61, entries)
+
+    self.assertEqual([], self._readdir(dirents[-1].offset))
+    self.assertEqual({}, self.thread._listings)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the LinkEstimator.'''
+
+import sys
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.linkestimator as linkestimator
+
+
+class LinkEstimatorCheck(unittest.TestCase):
+  def setUp(self):
+    self.estimator = linkestimator.LinkEstimator()
+
+  def testDefaults(self):
+    self.assertEqual(64 * 1024, self.estimator.chunkSize())
+    self.assertEqual(2, self.estimator.concurrency())
+    self.assertEqual(1, self.estimator.prefetchDepth())
+
+  def testAverage(self):
+    self.estimator.noteLatency(0.1)
+    self.assertEqual(0.1, self.estimator.rtt)
+
+    self.estimator.noteLatency(0.2)
+    self.assertAlmostEqual(0.12, self.estimator.rtt)
+
+  def testSmallTransfer(self):
+    self.estimator.noteTransfer(1024, 0.05)
+
+    self.assertEqual(None, self.estimator.throughput)
+    self.assertEqual(0.05, self.estimator.rtt)
+
+  def testSlowLink(self):
+    self.estimator.noteTransfer(64 * 1024, 1.0)
+    self.assertEqual(16 * 1024, self.estimator.chunkSize())
+
+  def testFastLink(self):
+    self.estimator.noteTransfer(100 * 1024 * 1024, 1.0)
+    self.assertEqual(4 * 1024 * 1024, self.estimator.chunkSize())
+
+  def testHighLatency(self):
+    self.estimator.noteTransfer(10 * 1024 * 1024, 1.0)
+    self.estimator.noteLatency(0.5)
+
+    self.assertEqual(4, self.estimator.concurrency())
+    self.assertEqual(6, self.estimator.prefetchDepth())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,139 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the SQLite stores.'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.localstore as localstore
+
+
+class SQLiteRevisionStoreCheck(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'metadata')
+    self.store = localstore.SQLiteRevisionStore(self.path)
+
+  def tearDown(self):
+    self.store.close()
+    shutil.rmtree(self.dir)
+
+  def testSeeded(self):
+    self.failIf(self.store.isSeeded())
+
+    self.store.markSeeded()
+    self.assert_(self.store.isSeeded())
+
+  def testSeedingLost(self):
+    # A crash before the commit leaves the store unseeded.
+    self.store.set('id', '1-abc', 10.0)
+    self.store.markSeeded()
+    self.store._db.close()
+
+    self.store = localstore.SQLiteRevisionStore(self.path)
+    self.failIf(self.store.isSeeded())
+    self.assertEqual([], self.store.items())
+
+  def testSetGet(self):
+    self.assertRaises(KeyError, self.store.get, 'id')
+
+    self.store.set('id', '1-abc', 10.0)
+    self.assertEqual(('1-abc', 10.0), self.store.get('id'))
+
+    self.store.set('id', '2-def', 20.0)
+    self.assertEqual(('2-def', 20.0), self.store.get('id'))
+
+  def testRemove(self):
+    self.store.set('id', '1-abc', 10.0)
+
+    self.assertEqual(('1-abc', 10.0), self.store.remove('id'))
+    self.assertRaises(KeyError, self.store.remove, 'id')
+
+  def testCommit(self):
+    self.store.set('id', '1-abc', 10.0)
+    self.store.markSeeded()
+    self.store.commit()
+    self.store.close()
+
+    self.store = localstore.SQLiteRevisionStore(self.path)
+    self.assert_(self.store.isSeeded())
+    self.assertEqual([('id', '1-abc', 10.0)],
+                     [ tuple(row) for row in self.store.items() ])
+
+
+class SQLiteDocumentStoreCheck(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'documents')
+    self.store = localstore.SQLiteDocumentStore(self.path)
+
+  def tearDown(self):
+    self.store.close()
+    shutil.rmtree(self.dir)
+
+  def _put(self, docid, dirpath, filename):
+    self.store.put({ '_id': docid, 'dirpath': dirpath, 'filename': filename })
+
+  def testGet(self):
+    self._put('id', u'/d\xe9', u'f\xe9')
+
+    self.assertEqual('id', self.store.get('/d\xc3\xa9', 'f\xc3\xa9')['_id'])
+    self.assertRaises(KeyError, self.store.get, '/d', 'f')
+
+  def testListdir(self):
+    self._put('b', '/d', 'b')
+    self._put('a', '/d', 'a')
+    self._put('c', '/d/e', 'c')
+
+    self.assertEqual([ 'a', 'b' ],
+                     [ doc['filename'] for doc in self.store.listdir('/d') ])
+
+  def testMove(self):
+    self._put('id', '/d', 'a')
+    self._put('id', '/e', 'b')
+
+    self.assertEqual([], self.store.listdir('/d'))
+    self.assertEqual('id', self.store.get('/e', 'b')['_id'])
+
+    self.store.remove('id')
+    self.store.remove('id')
+    self.assertEqual([], self.store.listdir('/e'))
+
+  def testLastSeq(self):
+    self.assertEqual(0, self.store.lastSeq())
+
+    self._put('id', '/d', 'a')
+    self.store.setLastSeq(3)
+    self.store.commit()
+    self.store.close()
+
+    self.store = localstore.SQLiteDocumentStore(self.path)
+    self.assertEqual(3, self.store.lastSeq())
+    self.assertEqual('id', self.store.get('/d', 'a')['_id'])
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,127 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the MetadataBridge.'''
+
+import os
+import sys
+import shutil
+import tempfile
+import threading
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.localstore as localstore
+import tsumufs.metadatabridge as metadatabridge
+
+tsumufs = metadatabridge.tsumufs
+
+
+def _document(docid, dirpath, filename, rev='1-abc'):
+  return { '_id': docid, '_rev': rev, 'doctype': 'SyncDocument',
+           'dirpath': dirpath, 'filename': filename }
+
+
+class FakeDocuments(object):
+  '''
+  DocumentHelper replaying a changes feed.
+  '''
+
+  def __init__(self, *events):
+    self.events = list(events)
+    self.since = []
+
+  def changes(self, feed, since, timeout, include_docs):
+    self.since.append(since)
+
+    for event in self.events:
+      if event.get('seq', 0) > since:
+        yield event
+
+    yield { 'last_seq': since }
+
+
+class MetadataBridgeCheck(unittest.TestCase):
+  def setUp(self):
+    self.saved = getattr(tsumufs, 'unmounted', None)
+    tsumufs.unmounted = threading.Event()
+
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir, 'documents')
+    self.store = localstore.SQLiteDocumentStore(self.path)
+
+  def tearDown(self):
+    tsumufs.unmounted = self.saved
+
+    self.store.close()
+    shutil.rmtree(self.dir)
+
+  def testFollow(self):
+    documents = FakeDocuments(
+      { 'seq': 1, 'id': 'a', 'doc': _document('a', '/', 'a') },
+      { 'seq': 2, 'id': 'b', 'doc': _document('b', '/', 'b') },
+      { 'seq': 3, 'id': 'rev', 'doc': { '_id': 'rev',
+                                        'doctype': 'CachedRevisionDocument' } },
+      { 'seq': 4, 'id': 'a', 'doc': _document('a', '/d', 'a', '2-def') },
+      { 'seq': 5, 'id': 'b', 'deleted': True,
+        'doc': { '_id': 'b', '_deleted': True } })
+
+    bridge = metadatabridge.MetadataBridge(self.store, documents)
+    bridge._follow()
+
+    self.assertEqual([], self.store.listdir('/'))
+    self.assertEqual('2-def', self.store.get('/d', 'a')['_rev'])
+    self.assertRaises(KeyError, self.store.get, '/', 'b')
+    self.assertEqual(5, self.store.lastSeq())
+
+  def testResume(self):
+    self.store.setLastSeq(7)
+    self.store.commit()
+
+    documents = FakeDocuments()
+    bridge = metadatabridge.MetadataBridge(self.store, documents)
+    bridge._follow()
+
+    self.assertEqual([ 7 ], documents.since)
+
+  def testCurrent(self):
+    documents = FakeDocuments(
+      { 'seq': 1, 'id': 'a', 'doc': _document('a', '/', 'a') },
+      { 'seq': 2, 'id': 'b', 'doc': _document('b', '/', 'b') })
+
+    bridge = metadatabridge.MetadataBridge(self.store, documents)
+    bridge.require(2)
+    self.failIf(bridge.isCurrent())
+
+    bridge.apply(documents.events[0])
+    self.failIf(bridge.isCurrent())
+
+    bridge.apply(documents.events[1])
+    self.assert_(bridge.isCurrent())
+
+    # The mirror is not trusted anymore once a change could be missed.
+    bridge.require(None)
+    bridge.require(2)
+    self.failIf(bridge.isCurrent())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,70 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the OpenFileRegistry.'''
+
+import sys
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.openfileregistry as openfileregistry
+
+
+class OpenFileRegistryCheck(unittest.TestCase):
+  def setUp(self):
+    self.registry = openfileregistry.OpenFileRegistry()
+
+  def testRefcount(self):
+    first = self.registry.open('/dir/file')
+    second = self.registry.open('/dir/file')
+
+    self.registry.release(first)
+    self.assert_(self.registry.isOpen('/dir/file'))
+
+    self.registry.release(second)
+    self.failIf(self.registry.isOpen('/dir/file'))
+
+  def testRecursive(self):
+    handle = self.registry.open('/dir/file')
+
+    try:
+      self.failIf(self.registry.isOpen('/dir'))
+      self.assert_(self.registry.isOpen('/dir', recursive=True))
+      self.failIf(self.registry.isOpen('/di', recursive=True))
+    finally:
+      self.registry.release(handle)
+
+  def testRename(self):
+    first = self.registry.open('/dir/file')
+    second = self.registry.open('/dir/file')
+
+    self.registry.noteRename('/dir', '/other')
+    self.failIf(self.registry.isOpen('/dir/file'))
+    self.assert_(self.registry.isOpen('/other/file'))
+
+    self.registry.release(first)
+    self.assert_(self.registry.isOpen('/other/file'))
+
+    self.registry.release(second)
+    self.failIf(self.registry.isOpen('/other/file'))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the SettleTracker.'''
+
+import sys
+import time
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs
+import tsumufs.settletracker as settletracker
+
+
+class SettleTrackerCheck(unittest.TestCase):
+  def setUp(self):
+    tsumufs.settleTime = 0.1
+    self.tracker = settletracker.SettleTracker()
+
+  def tearDown(self):
+    self.tracker.forget('/file')
+    self.tracker.forget('/dir/file')
+    self.tracker.forget('/other/file')
+
+  def testUntouched(self):
+    self.assert_(self.tracker.isSettled('/file'))
+
+  def testQuietPeriod(self):
+    self.tracker.noteWrite('/file')
+    self.failIf(self.tracker.isSettled('/file'))
+
+    time.sleep(0.2)
+    self.assert_(self.tracker.isSettled('/file'))
+
+  def testRename(self):
+    self.tracker.noteWrite('/dir/file')
+    self.tracker.noteRename('/dir', '/other')
+
+    self.assert_(self.tracker.isSettled('/dir/file'))
+    self.failIf(self.tracker.isSettled('/other/file'))
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,502 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the SyncLog.'''
+
+import sys
+import time
+import errno
+import threading
+import itertools
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.synclog as synclog
+
+tsumufs = synclog.tsumufs
+
+
+class FakeFileChange(object):
+  cleared = 0
+
+  def clearDataChanges(self):
+    self.cleared += 1
+
+  def addDataChange(self, start, end, data):
+    pass
+
+
+class FakeItem(object):
+  '''
+  Sync item, the items created later having later dates.
+  '''
+
+  _ids = itertools.count(1)
+
+  def __init__(self, type, **fields):
+    number = self._ids.next()
+
+    self.id        = 'item%d' % number
+    self.rev       = 1
+    self.date      = float(number)
+    self.type      = type
+    self.seq_number = None
+    self.file_type = 'file'
+    self.filename  = None
+    self.old_fname = None
+    self.new_fname = None
+    self.fileid    = None
+    self.change    = {}
+
+    self.filechange = FakeFileChange()
+    self.__dict__.update(fields)
+
+  def copy(self):
+    item = FakeItem.__new__(FakeItem)
+    item.__dict__.update(self.__dict__)
+
+    return item
+
+
+class FakeChanges(object):
+  '''
+  DocumentHelper of the sync items, returning copies of the items logged.
+  '''
+
+  def __init__(self, items):
+    self.items = list(items)
+    self.queries = 0
+
+  def _collate(self, key):
+    # Objects sort after the other values, as in CouchDB.
+    return [ (isinstance(value, dict), value) for value in key ]
+
+  def _query(self, key, startkey, endkey):
+    self.queries += 1
+
+    return [ item.copy() for item in self.items
+             if ((startkey is None or
+                  self._collate(key(item)) >= self._collate(startkey)) and
+                 (endkey is None or
+                  self._collate(key(item)) <= self._collate(endkey))) ]
+
+  def by_filename(self, startkey=None, endkey=None):
+    def key(item):
+      if item.filename:
+        return [ item.filename, item.type, item.date ]
+      return [ item.new_fname, item.type ]
+
+    return self._query(key, startkey, endkey)
+
+  def by_fileid(self, startkey=None, endkey=None):
+    return self._query(lambda item: [ item.fileid, item.type, item.date ],
+                       startkey, endkey)
+
+  def by_type(self, startkey=None, endkey=None):
+    return self._query(lambda item: [ item.type, item.date ],
+                       startkey, endkey)
+
+  def create(self, **fields):
+    item = FakeItem(**fields)
+    self.items.append(item)
+
+    return item
+
+  def update(self, item):
+    # Updating an item moves it to the end of the changes feed.
+    self.delete(item)
+
+    item.rev += 1
+    self.items.append(item.copy())
+
+  def delete(self, item):
+    self.items = [ other for other in self.items if other.id != item.id ]
+
+  def __getitem__(self, id):
+    for item in self.items:
+      if item.id == id:
+        return item.copy()
+
+    raise tsumufs.DocumentException(id)
+
+  def changes(self, **params):
+    for seq, item in enumerate(self.items):
+      doc = { '_id': item.id, 'doctype': 'SyncChangeDocument' }
+
+      for key in ('type', 'date', 'file_type', 'filename', 'old_fname',
+                  'new_fname', 'fileid', 'change'):
+        doc[key] = getattr(item, key)
+
+      yield { 'id': item.id, 'seq': seq + 1, 'doc': doc }
+
+
+def rename(old, new):
+  return FakeItem('rename', old_fname=old, new_fname=new)
+
+def unlink(filename):
+  return FakeItem('unlink', filename=filename)
+
+def rmtree(filename, unlinked):
+  return FakeItem('rmtree', file_type='dir', filename=filename,
+                  unlinked=unlinked)
+
+
+class FakeDocument(object):
+  def __init__(self, id, dirpath, filename):
+    self.id = id
+    self.dirpath = dirpath
+    self.filename = filename
+
+
+class FakeOverlay(object):
+  '''
+  Metadatas of the files, by path.
+  '''
+
+  def __init__(self, *documents):
+    self.documents = documents
+
+  def __getitem__(self, fusepath):
+    for document in self.documents:
+      if fusepath == '%s/%s' % (document.dirpath.rstrip('/'), document.filename):
+        return document
+
+    raise OSError(errno.ENOENT, fusepath)
+
+
+class FakeLocks(object):
+  '''
+  File locks of the cacheManager and of the fsMount.
+  '''
+
+  def __init__(self):
+    self.locked = []
+
+  def lockFile(self, fusepath):
+    self.locked.append(fusepath)
+
+  def unlockFile(self, fusepath):
+    self.locked.remove(fusepath)
+
+  def snapshotFile(self, fusepath):
+    raise OSError(errno.ENOENT, fusepath)
+
+
+class FakeRegistry(object):
+  def isOpen(self, fusepath, recursive=False):
+    return False
+
+  def isSettled(self, fusepath):
+    return True
+
+  def noteRename(self, old, new):
+    pass
+
+  def forget(self, fusepath):
+    pass
+
+
+class FakeCheckpointThread(object):
+  def __init__(self, requests):
+    self.requests = requests
+
+  def requestCheckpoint(self, wait=False):
+    self.requests.append(wait)
+
+
+class SyncLogCheck(unittest.TestCase):
+  _saved = ('fsOverlay', 'cacheManager', 'fsMount', 'openFileRegistry',
+            'settleTracker', 'settleTime', 'checkpointThread')
+
+  def setUp(self):
+    self.saved = [ getattr(tsumufs, name, None) for name in self._saved ]
+
+    tsumufs.fsOverlay = FakeOverlay()
+    tsumufs.cacheManager = FakeLocks()
+    tsumufs.fsMount = FakeLocks()
+    tsumufs.openFileRegistry = FakeRegistry()
+    tsumufs.settleTracker = FakeRegistry()
+    tsumufs.settleTime = 0
+    tsumufs.checkpointThread = None
+
+  def tearDown(self):
+    for name, value in zip(self._saved, self.saved):
+      setattr(tsumufs, name, value)
+
+  def _syncLog(self, *items):
+    log = synclog.SyncLog.__new__(synclog.SyncLog)
+    log._syncChanges = FakeChanges(items)
+
+    return log
+
+
+class PopChangesCheck(SyncLogCheck):
+  def _popChanges(self, log):
+    log._seqNumber = log._savedSeqNumber = 0
+    log._lastSeqSave = log._lastCompaction = time.time()
+
+    return log.popChanges()
+
+  def testRenamedNewFile(self):
+    # The new file /a has been renamed to /b before it synced.
+    document = FakeDocument('a', '/', 'b')
+    tsumufs.fsOverlay = FakeOverlay(document)
+
+    log = self._syncLog(FakeItem('new', filename='/a', fileid='a'))
+    log._syncDocuments = { 'a': document }
+
+    popped = []
+
+    for syncitem, filechange in self._popChanges(log):
+      self.assertEqual('/b', syncitem.filename)
+      self.assertEqual([ '/b' ], tsumufs.cacheManager.locked)
+      self.assertEqual([ '/b' ], tsumufs.fsMount.locked)
+
+      log.finishedWithChange(syncitem)
+      popped.append(syncitem)
+
+    self.assertEqual(1, len(popped))
+    self.assertEqual([], tsumufs.cacheManager.locked)
+    self.assertEqual([], tsumufs.fsMount.locked)
+    self.assertEqual([], log._syncChanges.items)
+
+  def testRenamePending(self):
+    # The directory /d of the file has been renamed to /e, which is not
+    # propagated yet: the file and the later items involving it wait.
+    document = FakeDocument('a', '/e', 'f')
+    tsumufs.fsOverlay = FakeOverlay(FakeDocument('d', '/', 'd'), document)
+
+    log = self._syncLog(rename('/d', '/e'),
+                        FakeItem('change', filename='/d/f', fileid='a'),
+                        unlink('/e/f'))
+    log._syncDocuments = { 'a': document }
+
+    popped = [ syncitem.type for syncitem, filechange
+               in self._popChanges(log) ]
+
+    self.assertEqual([ 'rename' ], popped)
+
+
+class ReplaceCheck(PopChangesCheck):
+  '''
+  Saving a file the way most editors do: writing a new file, and renaming it
+  over the file saved.
+  '''
+
+  def _save(self, type_, replaced_type):
+    created = FakeDocument('new', '/', 'foo.tmp')
+    replaced = FakeDocument('old', '/', 'foo')
+    tsumufs.fsOverlay = FakeOverlay(created, replaced)
+
+    log = self._syncLog()
+    log._syncDocuments = { 'new': created }
+
+    log.addNew(type_, filename='/foo.tmp')
+
+    # As done by FuseThread.rename.
+    created.filename = 'foo'
+    tsumufs.fsOverlay = FakeOverlay(created)
+
+    log.addUnlink('/foo', replaced_type, fileid='old')
+    log.addRename('/foo.tmp', '/foo')
+
+    popped = []
+
+    for syncitem, filechange in self._popChanges(log):
+      popped.append((syncitem.type, syncitem.filename))
+      log.finishedWithChange(syncitem)
+
+    return popped
+
+  def testReplaceFile(self):
+    # The upload replaces the file, the unlink would remove it.
+    self.assertEqual([ ('new', '/foo') ], self._save('file', 'file'))
+
+  def testReplaceDir(self):
+    self.assertEqual([ ('unlink', '/foo'), ('new', '/foo') ],
+                     self._save('dir', 'dir'))
+
+
+class CheckpointCheck(SyncLogCheck):
+  def testSlowCommit(self):
+    log = self._syncLog()
+    log._seqNumber = log._savedSeqNumber = 0
+
+    started = threading.Event()
+    finish = threading.Event()
+
+    def commit():
+      started.set()
+      finish.wait(5)
+
+    log._syncChanges.commit = commit
+
+    thread = threading.Thread(target=log.checkpoint)
+    thread.start()
+    started.wait(5)
+
+    try:
+      # Logging a change does not wait for the commit.
+      log.addChange('/a', 0, 1, 'a')
+      self.assert_(thread.isAlive())
+
+    finally:
+      finish.set()
+      thread.join()
+
+    self.assertEqual([ ('change', '/a') ],
+                     [ (item.type, item.filename)
+                       for item in log._syncChanges.items ])
+
+  def testKeepState(self):
+    log = self._syncLog()
+    log._seqNumber = log._savedSeqNumber = 0
+    log._unsavedEvents = log._seqSaveEvents
+
+    requests = []
+    tsumufs.checkpointThread = FakeCheckpointThread(requests)
+
+    def commit():
+      self.fail('Committed while consuming a change.')
+
+    log._syncChanges.commit = commit
+
+    # The state is saved by the checkpoint thread, as the lock may be held.
+    log.keepState(1)
+    self.assertEqual(1, log._seqNumber)
+    self.assertEqual([ False ], requests)
+
+
+class RmtreeCheck(SyncLogCheck):
+  def testUnlinkedUnderRoot(self):
+    item = rmtree('/d', [ '/d/x' ])
+    log = self._syncLog(item)
+
+    self.assert_(log.isUnlinkedFile('/d'))
+    self.assert_(log.isUnlinkedFile('/d/x/y'))
+    self.failIf(log.isUnlinkedFile('/dx'))
+
+    # The roots are kept in memory once loaded.
+    queries = log._syncChanges.queries
+    log.isUnlinkedFile('/d/x/y/z')
+    self.assertEqual(queries + 1, log._syncChanges.queries)
+
+    log._removeFromSyncQueue(item)
+    self.failIf(log.isUnlinkedFile('/d/x/y'))
+
+  def testFoldRename(self):
+    log = self._syncLog(rename('/a', '/b'), rmtree('/b', [ '/b/x' ]))
+    log.compact()
+
+    item, = log._syncChanges.items
+    self.assertEqual(('rmtree', '/a', [ '/a/x' ]),
+                     (item.type, item.filename, item.unlinked))
+    self.assertEqual({ item.id: '/a' }, log._getRmtreeRoots())
+
+
+class CompactCheck(SyncLogCheck):
+  def _compact(self, *items):
+    log = self._syncLog(*items)
+    log.compact()
+
+    self._compacted = log._syncChanges.items
+
+    return [ (item.type, item.filename or item.old_fname, item.new_fname)
+             for item in log._syncChanges.items ]
+
+  def testRenameBack(self):
+    self.assertEqual([], self._compact(rename('/a', '/b'), rename('/b', '/a')))
+
+  def testRenameChain(self):
+    self.assertEqual([ ('rename', '/a', '/c') ],
+                     self._compact(rename('/a', '/b'), rename('/b', '/c')))
+
+  def testRenameUnlink(self):
+    self.assertEqual([ ('unlink', '/a', None) ],
+                     self._compact(rename('/a', '/b'), unlink('/b')))
+
+  def testReplacedDestination(self):
+    # The unlink of the file replaced by the rename is kept.
+    self.assertEqual([ ('unlink', '/b', None) ],
+                     self._compact(unlink('/b'),
+                                   rename('/a', '/b'),
+                                   rename('/b', '/a')))
+
+    self.assertEqual([ ('unlink', '/b', None), ('unlink', '/a', None) ],
+                     self._compact(unlink('/b'),
+                                   rename('/a', '/b'),
+                                   unlink('/b')))
+
+  def testUnrelatedItems(self):
+    # Something was made of the destination in between, do not fold.
+    items = [ rename('/a', '/b'),
+              FakeItem('change', filename='/b'),
+              rename('/b', '/c') ]
+
+    self.assertEqual([ ('rename', '/a', '/b'), ('change', '/b', None),
+                       ('rename', '/b', '/c') ],
+                     self._compact(*items))
+
+  def testChangedMeanwhile(self):
+    new = FakeItem('new', filename='/a', fileid='a')
+    data = FakeItem('change', filename='/a', fileid='a')
+    log = self._syncLog(new, data, rename('/b', '/c'), rename('/c', '/d'))
+
+    plan = log._planCompaction
+
+    def planCompaction(syncitems):
+      # The scan does not hold the lock of the synclog.
+      thread = threading.Thread(target=log.addMetadataChange,
+                                args=('/a',), kwargs={ 'times': True })
+      thread.start()
+      thread.join(5)
+
+      self.failIf(thread.isAlive())
+      return plan(syncitems)
+
+    log._planCompaction = planCompaction
+
+    # The change merged meanwhile is kept, the renames are folded.
+    self.assertEqual(1, log.compact())
+    self.assertEqual([ ('new', '/a', None), ('change', '/a', None),
+                       ('rename', '/b', '/d') ],
+                     [ (item.type, item.filename or item.old_fname,
+                        item.new_fname)
+                       for item in log._syncChanges.items ])
+    self.assertEqual({ 'times': True }, log._syncChanges.items[1].change)
+
+  def testNewFileChanges(self):
+    new = FakeItem('new', filename='/a', fileid='a')
+    data = FakeItem('change', filename='/a', fileid='a')
+    times = FakeItem('change', filename='/a', fileid='a',
+                     change={ 'times': True })
+
+    self.assertEqual([ ('new', '/a', None), ('change', '/a', None) ],
+                     self._compact(new, data, times))
+    self.assertEqual({ 'times': True }, self._compacted[-1].change)
+
+    # The data of the changes carrying metadatas is dropped.
+    self.assertEqual(1, data.filechange.cleared)
+    self.assertEqual(1, times.filechange.cleared)
+
+
+if __name__ == '__main__':
+  unittest.main()
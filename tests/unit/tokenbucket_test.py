@@ -0,0 +1,85 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the TokenBucket.'''
+
+import sys
+import time
+import StringIO
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.tokenbucket as tokenbucket
+
+
+class TokenBucketCheck(unittest.TestCase):
+  def testUnlimited(self):
+    bucket = tokenbucket.TokenBucket()
+
+    start = time.time()
+    bucket.consume(100 * 1024 * 1024)
+    self.assert_(time.time() - start < 0.1)
+
+  def testBurst(self):
+    bucket = tokenbucket.TokenBucket(1024, 4096)
+
+    start = time.time()
+    bucket.consume(4096)
+    self.assert_(time.time() - start < 0.1)
+
+  def testRate(self):
+    bucket = tokenbucket.TokenBucket(100 * 1024, 1024)
+    bucket.consume(1024)
+
+    start = time.time()
+    bucket.consume(20 * 1024)
+    self.assert_(time.time() - start >= 0.15)
+
+  def testDisable(self):
+    bucket = tokenbucket.TokenBucket(1024, 1024)
+    bucket.setRate(0)
+
+    start = time.time()
+    bucket.consume(1024 * 1024)
+    self.assert_(time.time() - start < 0.1)
+
+
+class ThrottledFileCheck(unittest.TestCase):
+  def testRead(self):
+    data = 'x' * (200 * 1024)
+    bucket = tokenbucket.TokenBucket(100 * 1024 * 1024)
+
+    fp = tokenbucket.ThrottledFile(StringIO.StringIO(data), bucket)
+    self.assertEqual(data[:100000], fp.read(100000))
+    self.assertEqual(data[100000:], fp.read())
+
+  def testWrite(self):
+    data = 'x' * (200 * 1024)
+    bucket = tokenbucket.TokenBucket(100 * 1024 * 1024)
+
+    target = StringIO.StringIO()
+    fp = tokenbucket.ThrottledFile(target, writeBucket=bucket)
+    fp.write(data)
+    self.assertEqual(data, fp.getvalue())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python2.4
+# -*- python -*-
+#
+# Copyright (C) 2008  Google, Inc. All Rights Reserved.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along
+# with this program; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA.
+
+'''Unit tests for the WorkingSet.'''
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.append('../lib')
+sys.path.append('lib')
+
+import unittest
+import tsumufs.workingset as workingset
+
+
+class WorkingSetCheck(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.path = os.path.join(self.tmpdir, 'workingset')
+    self.set = workingset.WorkingSet()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testOrdering(self):
+    self.set.noteAccess('/a')
+    self.set.noteAccess('/b')
+    self.set.noteAccess('/b')
+    self.set.noteAccess('/c', 4 * 1024 * 1024)
+
+    self.assertEqual([('/c', 4 * 1024 * 1024), ('/b', 0), ('/a', 0)],
+                     self.set.top(10))
+    self.assertEqual([('/c', 4 * 1024 * 1024)], self.set.top(1))
+
+  def testEviction(self):
+    self.set._maxEntries = 10
+
+    self.set.noteAccess('/hot')
+    self.set.noteAccess('/hot')
+
+    for i in range(10):
+      self.set.noteAccess('/cold%d' % i)
+
+    paths = [ fusepath for fusepath, size in self.set.top(100) ]
+
+    self.assert_(len(paths) <= 10)
+    self.assertEqual('/hot', paths[0])
+
+  def testSaveLoad(self):
+    self.set.noteAccess('/a', 10)
+    self.set.save(self.path)
+
+    loaded = workingset.WorkingSet()
+    loaded.load(self.path)
+
+    self.assertEqual([('/a', 10)], loaded.top(10))
+
+  def testLoadMissing(self):
+    self.set.load(self.path)
+    self.assertEqual([], self.set.top(10))
+
+
+if __name__ == '__main__':
+  unittest.main()